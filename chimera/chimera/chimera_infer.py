@@ -1,16 +1,30 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import torch
 import torchvision.transforms as T
 from PIL import Image
 from torchvision.transforms.functional import InterpolationMode
-from transformers import AutoModel, AutoTokenizer
+from transformers import AutoModel, AutoTokenizer, TextIteratorStreamer
 
 from transformers import Pix2StructImageProcessor
 from transformers import  CLIPImageProcessor
 from chimera.model.kosmos2_5 import Kosmos2_5ImageProcessor
-from chimera.model.chimera import ChimeraChatModel, ChimeraProcessor
+from chimera.model.chimera import ChimeraChatConfig, ChimeraChatModel, ChimeraProcessor
+from chimera.model.chimera.modeling_intern_vit import has_flash_attn
+from chimera.model.chimera.modeling_chimera import merge_stopping_criteria, stream_generate
 from chimera.model.got import GOTImageProcessor
-from typing import List
+from chimera.feature_cache import FeatureCache, image_hash
+from chimera.generation_engine import ContinuousBatchingEngine
+from chimera.paged_kv_cache import PagedKVCache
+from chimera.image_tiling import (dynamic_preprocess_tensor, estimate_image_tokens, find_closest_aspect_ratio,
+                                  get_target_ratios, plan_tile_budget)
+from chimera.conversation import get_conv_template
+from chimera.prompt_builder import PromptBuilder
+from typing import List, Optional, Tuple, Union
 
 
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
@@ -26,30 +40,12 @@ def build_transform(input_size):
     ])
     return transform
 
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    return best_ratio
-
 def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
 
     # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_ratios = get_target_ratios(min_num, max_num)
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
@@ -81,20 +77,59 @@ def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbna
 
 def load_image(image, input_size=448, max_num=12):
     # image = Image.open(image_file).convert('RGB')
-    transform = build_transform(input_size=input_size)
-    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
-    pixel_values = [transform(image) for image in images]
-    pixel_values = torch.stack(pixel_values)
+    # 等价于对dynamic_preprocess的每个tile做build_transform，但只转换、resize一次，所有tile一起归一化
+    pixel_values = dynamic_preprocess_tensor(image, image_size=input_size, use_thumbnail=True, max_num=max_num,
+                                             mean=IMAGENET_MEAN, std=IMAGENET_STD)
     return pixel_values
 
 
+def select_attn_implementation(config, device):
+    """
+    Keep flash attention on CUDA when it is installed, otherwise use the SDPA attention of the LLM where it has one
+    (eager for the rest) and the naive attention of InternViT.
+    """
+    if device.type == 'cuda' and has_flash_attn:
+        return config
+    config.vision_config.use_flash_attn = False
+    llm_config = config.llm_config
+    if llm_config.architectures[0] == 'InternLM2ForCausalLM':
+        llm_config.attn_implementation = 'sdpa'
+    else:
+        # Phi3/Qwen2/Llama都有SDPA实现
+        llm_config._attn_implementation = 'sdpa'
+    return config
+
+
+def preprocess_images(input_images: List, max_num=12, pin_memory=False, dtype=None):
+    """
+    CPU half of `get_response`: decode (paths are opened here) and tile every image.
+    Returns the decoded images and their `load_image` tiles; runs in the worker pool of `PipelinedExecutor`.
+    dtype: cast the tiles to the model dtype here, so the pinned tensors are the ones copied to the device.
+    """
+    images = [Image.open(x).convert('RGB') if isinstance(x, str) else x for x in input_images]
+    pixel_values_list = [load_image(image, max_num=max_num) for image in images]
+    if dtype is not None:
+        pixel_values_list = [x.to(dtype) for x in pixel_values_list]
+    if pin_memory:
+        pixel_values_list = [x.pin_memory() for x in pixel_values_list]
+    return images, pixel_values_list
+
   
-def expert_preprocess(images, expert_processor_list):
+def expert_preprocess(images, expert_processor_list, expert_domain_ids=None):
+    # expert_domain_ids为router的输出(0为null)，给定时每个processor只处理路由到对应expert的图片，没有图片的expert输出None
     
     expert_encoder_pixel_value_list, expert_encoder_attention_mask_list = [], []
 
-    for processor in expert_processor_list:
-        output = processor(images, return_tensors="pt")
+    for i, processor in enumerate(expert_processor_list):
+        if expert_domain_ids is not None:
+            cur_images = [image for image, domain_id in zip(images, expert_domain_ids) if domain_id - 1 == i]
+            if len(cur_images) == 0:
+                expert_encoder_pixel_value_list.append(None)
+                expert_encoder_attention_mask_list.append(None)
+                continue
+        else:
+            cur_images = images
+        output = processor(cur_images, return_tensors="pt")
         if processor.image_processor_type in ("Kosmos2_5ImageProcessor", "Pix2StructImageProcessor"):
             expert_encoder_pixel_value_list.append(output.flattened_patches)
             expert_encoder_attention_mask_list.append(output.attention_mask)
@@ -109,19 +144,47 @@ def expert_preprocess(images, expert_processor_list):
 
 
 class Chimera4easyuse:
-    def __init__(self, model_path, dtype= torch.bfloat16, generation_config = None) -> None:
+    def __init__(
+            self,
+            model_path,
+            dtype= torch.bfloat16,
+            generation_config = None,
+            feature_cache_size = 0,
+            device = None,
+            num_threads = None,
+            quantize = False) -> None:
+        """
+        feature_cache_size: 缓存图片特征(vit_embeds、路由结果、expert特征)的显存上限(bytes)，0表示不缓存。
+        device: 默认有GPU时用cuda，否则用cpu。
+        num_threads: CPU推理时torch.set_num_threads的线程数。
+        quantize: 对language_model、mlp1和expert mlp的Linear做torch.ao动态int8量化，仅支持cpu + float32。
+        """
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        if quantize:
+            assert self.device.type == 'cpu' and dtype == torch.float32, \
+                f'dynamic int8 quantization only supports cpu + torch.float32, but get {self.device} + {dtype}'
 
         self.dtype = dtype
+        self.feature_cache = FeatureCache(feature_cache_size) if feature_cache_size > 0 else None
         path = model_path
         if generation_config is not None:
             self.generation_config = generation_config
         else:
             self.generation_config = dict(max_new_tokens=1024, do_sample=False)
+        config = select_attn_implementation(ChimeraChatConfig.from_pretrained(path), self.device)
         self.model = ChimeraChatModel.from_pretrained(
             path,
+            config=config,
             torch_dtype=dtype,
             low_cpu_mem_usage=True,
-            trust_remote_code=True).eval().cuda()
+            trust_remote_code=True).eval().to(self.device)
+        if quantize:
+            self.model.quantize_dynamic_int8()
         self.tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True, use_fast=False)
 
 
@@ -130,17 +193,107 @@ class Chimera4easyuse:
 
         self.num_expert_token_all = [x.max_patches for x in expert_processor_list]
         self.expert_processor_list = expert_processor_list
+        self.draft_model = None
+        self.num_draft_tokens = 4
+
+    def load_draft_model(self, model_path, num_draft_tokens: int = 4):
+        """
+        Load a smaller Chimera model (same tokenizer) as the drafter of speculative decoding in `get_response`, see
+        `chimera.speculative_decoding`. It reuses the tiles and the routing of the target model.
+        """
+        config = select_attn_implementation(ChimeraChatConfig.from_pretrained(model_path), self.device)
+        self.draft_model = ChimeraChatModel.from_pretrained(
+            model_path,
+            config=config,
+            torch_dtype=self.dtype,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True).eval().to(self.device)
+        # drafter的context token与target一致，只在加载时设置一次
+        self.draft_model.img_context_token_id = self.tokenizer.convert_tokens_to_ids('<IMG_CONTEXT>')
+        if self.draft_model.num_expert_encoder == self.model.num_expert_encoder:
+            self.draft_model.set_domain_context_token_ids(self.tokenizer.convert_tokens_to_ids(
+                [f'<DOMAIN_{i}_CONTEXT>' for i in range(self.draft_model.num_expert_encoder)]))
+        self.num_draft_tokens = num_draft_tokens
+        return self.draft_model
+
+    def estimate_tokens(
+            self,
+            input_images: List,
+            token_budget: Optional[int] = None,
+            expert_domain_ids: Optional[List[int]] = None,
+            max_num: int = 12) -> List[dict]:
+        """
+        Visual tokens (`<IMG_CONTEXT>` and expert tokens) every image of a request will take, from the image sizes
+        alone, see `estimate_image_tokens`. Nothing is tiled or encoded.
+
+        expert_domain_ids: routing of the images (e.g. from `route_images`); when None every image is charged the
+            largest expert token count, an upper bound.
+        token_budget: lower the tiling of the images until the request fits, see `plan_tile_budget`.
+        """
+        sizes = []
+        for x in input_images:
+            if isinstance(x, str):
+                # Image.open只读文件头，拿到size不解码；with及时关闭文件
+                with Image.open(x) as image:
+                    sizes.append(image.size)
+            else:
+                sizes.append(x.size)
+        if expert_domain_ids is None:
+            num_expert_tokens = [max(self.num_expert_token_all, default=0)] * len(sizes)
+        else:
+            num_expert_tokens = [self.num_expert_token_all[x - 1] if x > 0 else 0 for x in expert_domain_ids]
+        if token_budget is None:
+            return [estimate_image_tokens(width, height, self.model.num_image_token, num_expert_token, max_num=max_num)
+                    for (width, height), num_expert_token in zip(sizes, num_expert_tokens)]
+        return plan_tile_budget(sizes, token_budget, self.model.num_image_token, num_expert_tokens, max_num=max_num)
+
+    def plan_tiling(
+            self,
+            input_images: List,
+            token_budget: Optional[int] = None,
+            pixel_values_list: Optional[List[torch.FloatTensor]] = None) -> Tuple[List, Optional[List[int]], List[int]]:
+        """
+        (images, expert_domain_ids, max_num of every image) for `token_budget`; no routing and max_num 12 without budget.
+        With a budget the paths in input_images are decoded once here, and the returned images are meant to be tiled
+        and encoded instead of input_images.
+        """
+        if token_budget is None or len(input_images) == 0:
+            return input_images, None, [12] * len(input_images)
+        assert pixel_values_list is None, 'the tiling is chosen by token_budget, pixel_values_list must not be given'
+        images = [Image.open(x).convert('RGB') if isinstance(x, str) else x for x in input_images]
+        # 预算中的expert token数取决于路由：先只在thumbnail上路由，tile特征不再重复路由
+        expert_domain_ids = self.route_images(images)
+        plans = self.estimate_tokens(images, token_budget, expert_domain_ids)
+        return images, expert_domain_ids, [x['max_num'] for x in plans]
 
 
     def get_response(
             self, 
             user_prompt, 
-            input_images: List):
-
+            input_images: List,
+            streamer = None,
+            pixel_values_list: Optional[List[torch.FloatTensor]] = None,
+            token_budget: Optional[int] = None,
+            stopping_criteria = None):
+        """
+        pixel_values_list: 已经用`load_image`处理好的每张图的tile(例如来自`PipelinedExecutor`的预处理线程)，为None时在这里处理。
+        token_budget: 所有图片的视觉token(<IMG_CONTEXT>和expert token)上限，按`estimate_tokens`缩小每张图的tile网格。
+        stopping_criteria: 追加到generation_config中已有条件之后传给`generate`的StoppingCriteriaList，例如`stream_response`提前结束时停止生成。
+        """
+
+        if self.feature_cache is not None:
+            return self.get_responses([(user_prompt, input_images)], streamer=streamer, pixel_values_list=pixel_values_list,
+                                      token_budget=token_budget, stopping_criteria=stopping_criteria)[0]
+
+        input_images, expert_domain_ids, max_num_list = self.plan_tiling(input_images, token_budget, pixel_values_list)
         pixel_values, thumbnail = [], []
 
-        for cur_image in input_images:
-            cur_pixel_value = load_image(cur_image, max_num=12).to(self.dtype).cuda()
+        for i, cur_image in enumerate(input_images):
+            if pixel_values_list is not None:
+                # 先从pinned内存异步拷贝，再在device上转dtype(dtype一致时不做任何事)
+                cur_pixel_value = pixel_values_list[i].to(self.device, non_blocking=True).to(self.dtype)
+            else:
+                cur_pixel_value = load_image(cur_image, max_num=max_num_list[i]).to(self.device, self.dtype)
 
             cur_thumbnail = cur_pixel_value[-1:]
             pixel_values.append(cur_pixel_value)
@@ -150,31 +303,532 @@ class Chimera4easyuse:
         num_patches_list = [x.shape[0] for x in pixel_values]
         pixel_values = torch.cat(pixel_values,dim=0)
         thumbnail = torch.cat(thumbnail,dim=0)
-        expert_processed = expert_preprocess(input_images, self.expert_processor_list)
+
+        # 先路由，再只对路由到的expert做预处理；路由与tile特征共用一次ViT前向
+        with torch.no_grad():
+            if expert_domain_ids is None:
+                vit_embeds, route_logits = self.model.extract_feature_and_route(pixel_values, num_patches_list)
+                expert_domain_ids = route_logits.argmax(dim=-1).tolist()
+            else:
+                vit_embeds = self.model.extract_feature(pixel_values)
+        expert_processed = expert_preprocess(input_images, self.expert_processor_list, expert_domain_ids)
 
 
         for k in expert_processed.keys():
             v = expert_processed[k]
             for i in range(len(v)):
                 if v[i] is not None:
-                    v[i] = v[i].to(self.dtype).cuda()
+                    v[i] = v[i].to(self.device, self.dtype)
 
         # single-image single-round conversation (单图单轮对话)
 
+        generation_config = self.generation_config
+        if self.draft_model is not None:
+            generation_config = dict(generation_config, draft_model=self.draft_model, num_draft_tokens=self.num_draft_tokens)
+        generation_config = merge_stopping_criteria(generation_config, stopping_criteria)
 
         response = self.model.chat(
             self.tokenizer, 
             pixel_values, 
             user_prompt, 
-            self.generation_config,
+            generation_config,
             expert_encoder_pixel_value_list = expert_processed['expert_encoder_pixel_value_list'],
             expert_encoder_attention_mask_list = expert_processed['expert_encoder_attention_mask_list'],
             thumbnail = thumbnail,
             num_expert_token_all = self.num_expert_token_all,
-            num_patches_list = num_patches_list
+            expert_domain_ids = expert_domain_ids,
+            visual_features = vit_embeds,
+            num_patches_list = num_patches_list,
+            streamer = streamer
             )
 
         return response
 
 
+    def encode_images(
+            self,
+            images: List,
+            max_num: Union[int, List[int]] = 12,
+            pixel_values_list: Optional[List[torch.FloatTensor]] = None,
+            expert_domain_ids: Optional[List[int]] = None):
+        """
+        Tile, encode and route `images` with one ViT pass and one `uni_encode` call per expert.
+        max_num can be given per image; with expert_domain_ids the images are already routed.
+
+        Returns (visual_features, num_patches_list, expert_domain_ids, expert_visual_features), where
+        expert_visual_features[i] stacks the features of the images routed to expert i in image order (None if there is
+        none). With the feature cache enabled only images whose content was not seen before are encoded.
+        pixel_values_list optionally holds the already tiled `load_image` output of every image.
+        """
+        max_num_list = max_num if isinstance(max_num, list) else [max_num] * len(images)
+        if self.feature_cache is not None:
+            keys = [image_hash(image, input_size=448, max_num=max_num_list[i], dtype=str(self.dtype),
+                               num_image_token=self.model.num_image_token) for i, image in enumerate(images)]
+            entries = [self.feature_cache.get(key) for key in keys]
+        else:
+            keys = [None] * len(images)
+            entries = [None] * len(images)
+
+        # 同一batch中重复的图片只编码一次
+        missing = {}
+        for i, entry in enumerate(entries):
+            if entry is None:
+                missing.setdefault(keys[i] if keys[i] is not None else i, []).append(i)
+
+        if len(missing) > 0:
+            miss_images = [images[indices[0]] for indices in missing.values()]
+            if pixel_values_list is not None:
+                pixel_values = [pixel_values_list[indices[0]].to(self.device, non_blocking=True).to(self.dtype)
+                                for indices in missing.values()]
+            else:
+                pixel_values = [load_image(images[indices[0]], max_num=max_num_list[indices[0]]).to(self.device, self.dtype)
+                                for indices in missing.values()]
+            num_patches_list = [x.shape[0] for x in pixel_values]
+            pixel_values = torch.cat(pixel_values,dim=0)
+
+            with torch.no_grad():
+                if expert_domain_ids is None:
+                    vit_embeds, route_logits = self.model.extract_feature_and_route(pixel_values, num_patches_list)
+                    domain_ids = route_logits.argmax(dim=-1).tolist()
+                else:
+                    vit_embeds = self.model.extract_feature(pixel_values)
+                    domain_ids = [expert_domain_ids[indices[0]] for indices in missing.values()]
+                expert_processed = expert_preprocess(miss_images, self.expert_processor_list, domain_ids)
+
+                # 按expert把路由到它的图片放在一起，每个expert只编码一次
+                expert_features = [None] * len(miss_images)
+                for i in range(len(self.expert_processor_list)):
+                    cur_pixel_value = expert_processed['expert_encoder_pixel_value_list'][i]
+                    if cur_pixel_value is None:
+                        continue
+                    cur_attention_mask = expert_processed['expert_encoder_attention_mask_list'][i]
+                    cur_feature = self.model.expert_encoder.uni_encode(
+                        encoder_index = i,
+                        pixel_values = cur_pixel_value.to(self.device, self.dtype),
+                        attention_mask = cur_attention_mask.to(self.device, self.dtype) if cur_attention_mask is not None else None,
+                    )
+                    cur_indices = [j for j, domain_id in enumerate(domain_ids) if domain_id - 1 == i]
+                    for j, feature in zip(cur_indices, cur_feature):
+                        expert_features[j] = feature[None]
+
+            # clone: 缓存的切片不持有整个batch的存储，字节数统计才准确
+            for j, (indices, cur_vit_embeds) in enumerate(zip(missing.values(), vit_embeds.split(num_patches_list))):
+                entry = dict(
+                    vit_embeds = cur_vit_embeds.clone(),
+                    domain_id = domain_ids[j],
+                    expert_feature = expert_features[j].clone() if expert_features[j] is not None else None,
+                )
+                for i in indices:
+                    entries[i] = entry
+                if self.feature_cache is not None:
+                    self.feature_cache.put(keys[indices[0]], entry)
+
+        if len(entries) == 0:
+            return None, [], None, None
+
+        visual_features = torch.cat([entry['vit_embeds'] for entry in entries],dim=0)
+        num_patches_list = [entry['vit_embeds'].shape[0] for entry in entries]
+        expert_domain_ids = [entry['domain_id'] for entry in entries]
+        expert_visual_features = []
+        for i in range(len(self.expert_processor_list)):
+            cur_features = [entry['expert_feature'] for entry in entries if entry['domain_id'] - 1 == i]
+            expert_visual_features.append(torch.cat(cur_features,dim=0) if len(cur_features) > 0 else None)
+
+        return visual_features, num_patches_list, expert_domain_ids, expert_visual_features
+
+
+    def get_responses(
+            self,
+            inputs: List[Tuple[str, List]],
+            streamer = None,
+            pixel_values_list: Optional[List[torch.FloatTensor]] = None,
+            token_budget: Optional[int] = None,
+            stopping_criteria = None):
+        """
+        Batched `get_response`. inputs is a list of (user_prompt, input_images); token_budget applies to every request.
+
+        All tiles go through the ViT and the router in one pass, each expert encodes the images routed to it across
+        the whole batch at once, and the left-padded prompts are decoded by a single `generate`. A drafter from
+        `load_draft_model` is used for a single request only, speculative decoding does not batch.
+        """
+        if self.draft_model is not None:
+            assert len(inputs) == 1, f'speculative decoding supports one request at a time but got {len(inputs)}'
+
+        user_prompts, all_images, num_images_list = [], [], []
+        routed_domain_ids, max_num_list = [], []
+        for user_prompt, input_images in inputs:
+            user_prompts.append(user_prompt)
+            cur_images, cur_domain_ids, cur_max_num = self.plan_tiling(input_images, token_budget, pixel_values_list)
+            all_images.extend(cur_images)
+            num_images_list.append(len(input_images))
+            routed_domain_ids.extend(cur_domain_ids or [])
+            max_num_list.extend(cur_max_num)
+
+        visual_features, num_patches_list, expert_domain_ids, expert_visual_features = self.encode_images(
+            all_images, max_num=max_num_list, pixel_values_list=pixel_values_list,
+            expert_domain_ids=routed_domain_ids if token_budget is not None else None)
+
+        generation_config = dict(self.generation_config)
+        if self.draft_model is not None:
+            generation_config.update(draft_model=self.draft_model, num_draft_tokens=self.num_draft_tokens)
+        generation_config = merge_stopping_criteria(generation_config, stopping_criteria)
+        responses = self.model.batch_chat(
+            self.tokenizer,
+            None,
+            user_prompts,
+            generation_config,
+            num_patches_list = num_patches_list,
+            num_images_list = num_images_list,
+            expert_domain_ids = expert_domain_ids,
+            num_expert_token_all = self.num_expert_token_all,
+            visual_features = visual_features,
+            expert_visual_features = expert_visual_features,
+            streamer = streamer,
+            )
+
+        return responses
+
+    def stream_response(
+            self,
+            user_prompt,
+            input_images: List):
+        """Generator version of `get_response`: yields the response text incrementally as tokens are generated."""
+        template = get_conv_template(self.model.template)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        return stream_generate(
+            lambda stopping_criteria: self.get_response(
+                user_prompt, input_images, streamer=streamer, stopping_criteria=stopping_criteria),
+            streamer,
+            template.sep)
+
+    def route_images(self, input_images: List) -> List[int]:
+        """
+        Expert domain id (0 for null) of every image from its thumbnail alone, without tiling or encoding it, e.g. for
+        an admission tier that decides which expert a request needs. Uses the fast router when the model config sets
+        `router_exit_layer`/`router_image_size` (see `ChimeraChatModel.route`).
+        """
+        images = [Image.open(x).convert('RGB') if isinstance(x, str) else x for x in input_images]
+        # 单个tile即thumbnail
+        thumbnail = torch.cat([dynamic_preprocess_tensor(image, max_num=1) for image in images])
+        with torch.no_grad():
+            route_logits = self.model.route(thumbnail.to(self.device, self.dtype))
+        return route_logits.argmax(dim=-1).tolist()
+
+    def start_session(self):
+        """Multi-turn conversation that keeps the KV cache between turns, see `ChimeraChatSession`."""
+        return ChimeraChatSession(self)
+
+    def start_engine(self, max_batch_size: int = 8, num_kv_blocks: Optional[int] = None, kv_block_size: Optional[int] = None):
+        """
+        Continuous batching over a stream of requests, see `ChimeraBatchingEngine`. With `num_kv_blocks` the running
+        requests share a `PagedKVCache` of that many blocks of `kv_block_size` tokens (InternLM2 and Phi3 backbones),
+        by default 256 with flash attention (read in place through the block tables) and 16 otherwise.
+        """
+        return ChimeraBatchingEngine(
+            self, max_batch_size=max_batch_size, num_kv_blocks=num_kv_blocks, kv_block_size=kv_block_size)
+
+
+class ChimeraChatSession:
+    """
+    Multi-turn chat that keeps `past_key_values` between turns.
+
+    `ChimeraChatModel.chat(history=...)` re-renders and re-prefills the whole conversation, including every image, on
+    each turn. A session keeps the token ids and the KV cache of the conversation so far, so a follow-up question only
+    prefills the new user turn (and the images it brings).
+    """
+
+    def __init__(
+            self,
+            chimera: Chimera4easyuse,
+            IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'):
+
+        self.chimera = chimera
+        self.model = chimera.model
+        self.tokenizer = chimera.tokenizer
+        self.prompt_builder = PromptBuilder.from_tokenizer(self.tokenizer)
+
+        self.model.img_context_token_id = self.tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+        self.expert_token_list = [f"<DOMAIN_{i}_CONTEXT>" for i in range(self.model.num_expert_encoder)]
+        self.model.set_domain_context_token_ids(self.tokenizer.convert_tokens_to_ids(self.expert_token_list))
+
+        self.template = get_conv_template(self.model.template)
+        self.template.system_message = self.model.system_message
+        self.eos_token_id = self.tokenizer.convert_tokens_to_ids(self.template.sep)
+        self.reset()
+
+    def reset(self):
+        self.history = []
+        # 对话到目前为止的全部token，以及其中前num_cached_tokens个token的KV cache
+        self.input_ids = None
+        self.past_key_values = None
+
+    @property
+    def num_cached_tokens(self):
+        if self.past_key_values is None:
+            return 0
+        if hasattr(self.past_key_values, 'get_seq_length'):
+            return self.past_key_values.get_seq_length()
+        return self.past_key_values[0][0].shape[2]
+
+    def _turn_text(self, question):
+        """Template text of the new turn: the full prompt on the first turn, otherwise what follows the last answer."""
+        template = self.template.copy()
+        template.messages = []
+        if len(self.history) == 0:
+            template.append_message(template.roles[0], question)
+            template.append_message(template.roles[1], None)
+            return template.get_prompt()
+        # 以占位回答渲染上一轮，新一轮的文本即两次渲染结果的差
+        template.append_message(template.roles[0], 'Q')
+        template.append_message(template.roles[1], 'A')
+        prev_prompt = template.get_prompt()
+        template.append_message(template.roles[0], question)
+        template.append_message(template.roles[1], None)
+        return template.get_prompt()[len(prev_prompt):]
+
+    def chat(
+            self,
+            user_prompt: str,
+            input_images: Optional[List] = None,
+            DOMAIN_START_TOKEN = '<domain>',
+            DOMAIN_END_TOKEN = '</domain>'):
+
+        input_images = [] if input_images is None else input_images
+        if len(input_images) > 0 and '<image>' not in user_prompt:
+            user_prompt = '<image>\n' * len(input_images) + user_prompt
+        assert user_prompt.count('<image>') == len(input_images), \
+            f'there are {user_prompt.count("<image>")} <image> token in question but get {len(input_images)} input images'
+
+        visual_features, num_patches_list, expert_domain_ids, expert_visual_features = self.chimera.encode_images(input_images)
+        image_spans = []
+        for num_patches, domain_id in zip(num_patches_list, expert_domain_ids or []):
+            if domain_id > 0:
+                domain_context_token, num_domain_token = self.expert_token_list[domain_id-1], self.chimera.num_expert_token_all[domain_id-1]
+            else:
+                domain_context_token, num_domain_token = None, 0
+            image_spans.append(self.prompt_builder.image_span(
+                self.model.num_image_token * num_patches, domain_context_token, num_domain_token,
+                DOMAIN_START_TOKEN=DOMAIN_START_TOKEN, DOMAIN_END_TOKEN=DOMAIN_END_TOKEN))
+
+        num_cached = self.num_cached_tokens
+        if self.input_ids is None:
+            new_ids, runs = self.prompt_builder.encode(self._turn_text(user_prompt), image_spans, return_runs=True)
+            new_ids = new_ids.to(self.chimera.device)
+            input_ids = new_ids
+            num_pending = 0
+        else:
+            # 上一轮因max_new_tokens截断时补上结束符，保证cache中的文本和模板一致
+            if self.input_ids[-1].item() != self.eos_token_id:
+                self.input_ids = torch.cat([self.input_ids, self.input_ids.new_tensor([self.eos_token_id])])
+            turn_ids, runs = self.prompt_builder.encode(
+                self._turn_text(user_prompt), image_spans, add_special_tokens=False, anchor=self.eos_token_id,
+                return_runs=True)
+            # 上一轮生成的最后一个token还没有进入cache
+            num_pending = self.input_ids.shape[0] - num_cached
+            new_ids = torch.cat([self.input_ids[num_cached:], turn_ids.to(self.input_ids.device)])
+            input_ids = torch.cat([self.input_ids[:num_cached], new_ids])
+
+        # 只prefill新的token(最后一个token留给generate)，图片特征只在这一段里替换
+        with torch.no_grad():
+            if new_ids.shape[0] > 1:
+                placement_index = self.prompt_builder.placement_index(
+                    [runs], self.model.context_token_ids(), new_ids.shape[0] - 1, offsets=[num_pending])
+                input_embeds = self.model.get_input_embeds(
+                    new_ids[None, :-1],
+                    visual_features=visual_features,
+                    expert_visual_features=expert_visual_features,
+                    placement_index=placement_index.to(new_ids.device))
+                outputs = self.model.language_model(
+                    inputs_embeds=input_embeds,
+                    attention_mask=torch.ones((1, input_ids.shape[0] - 1), dtype=torch.long, device=input_ids.device),
+                    position_ids=torch.arange(num_cached, input_ids.shape[0] - 1, device=input_ids.device)[None],
+                    past_key_values=self.past_key_values,
+                    use_cache=True,
+                    return_dict=True)
+                self.past_key_values = outputs.past_key_values
+
+            generation_config = dict(self.chimera.generation_config)
+            generation_config['eos_token_id'] = self.eos_token_id
+            generation_output = self.model.language_model.generate(
+                input_ids=input_ids[None],
+                attention_mask=torch.ones_like(input_ids)[None],
+                past_key_values=self.past_key_values,
+                use_cache=True,
+                return_dict_in_generate=True,
+                **generation_config)
+
+        self.input_ids = generation_output.sequences[0]
+        self.past_key_values = generation_output.past_key_values
+        response = self.tokenizer.decode(self.input_ids[input_ids.shape[0]:], skip_special_tokens=True)
+        response = response.split(self.template.sep)[0].strip()
+        self.history.append((user_prompt, response))
+        return response
+
+
+class ChimeraBatchingEngine:
+    """
+    Continuous batching of (user_prompt, input_images) requests.
+
+    `submit` runs the multimodal part of a request right away (ViT, router, experts and the injection of the visual
+    features into `input_embeds`) and queues it; `step` lets `ContinuousBatchingEngine` admit queued requests into the
+    running batch, decode one token for every running request and return the (request_id, response) pairs that
+    finished, so short answers leave the batch without waiting for long ones.
+    """
+
+    def __init__(
+            self,
+            chimera: Chimera4easyuse,
+            max_batch_size: int = 8,
+            num_kv_blocks: Optional[int] = None,
+            kv_block_size: Optional[int] = None,
+            IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'):
+
+        self.chimera = chimera
+        self.model = chimera.model
+        self.tokenizer = chimera.tokenizer
+        self.prompt_builder = PromptBuilder.from_tokenizer(self.tokenizer)
+
+        self.kv_cache = None
+        if num_kv_blocks is not None:
+            llm_config = self.model.config.llm_config
+            assert llm_config.architectures[0] in ('InternLM2ForCausalLM', 'Phi3ForCausalLM'), \
+                f'the paged KV cache does not support {llm_config.architectures[0]}'
+            if kv_block_size is None:
+                # flash attention只有block大小是256的倍数时才能按block table原地读取cache，否则要gather
+                lm_config = self.model.language_model.config
+                use_flash_attn = 'flash_attention_2' in (getattr(lm_config, 'attn_implementation', None), lm_config._attn_implementation)
+                kv_block_size = 256 if use_flash_attn else 16
+            self.kv_cache = PagedKVCache.from_config(
+                llm_config, num_kv_blocks,
+                block_size = kv_block_size,
+                dtype = self.model.language_model.dtype,
+                device = chimera.device)
+
+        self.model.img_context_token_id = self.tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+        expert_token_list = [f"<DOMAIN_{i}_CONTEXT>" for i in range(self.model.num_expert_encoder)]
+        self.model.set_domain_context_token_ids(self.tokenizer.convert_tokens_to_ids(expert_token_list))
+
+        self.template = get_conv_template(self.model.template)
+        generation_config = dict(chimera.generation_config)
+        generation_config['eos_token_id'] = self.tokenizer.convert_tokens_to_ids(self.template.sep)
+        self.engine = ContinuousBatchingEngine(
+            self.model.language_model, max_batch_size=max_batch_size, kv_cache=self.kv_cache, **generation_config)
+
+    def has_unfinished_requests(self) -> bool:
+        return self.engine.has_unfinished_requests()
+
+    def submit(self, user_prompt: str, input_images: List, token_budget: Optional[int] = None) -> int:
+        """
+        Encode the images of the request, build its `input_embeds` and queue it. Returns the request id.
+        token_budget caps the visual tokens of the request, see `Chimera4easyuse.estimate_tokens`.
+        """
+        input_images, routed_domain_ids, max_num_list = self.chimera.plan_tiling(input_images, token_budget)
+        visual_features, num_patches_list, expert_domain_ids, expert_visual_features = self.chimera.encode_images(
+            input_images, max_num=max_num_list, expert_domain_ids=routed_domain_ids)
+        queries, runs_list, _ = self.model.build_queries(
+            self.tokenizer, [user_prompt], num_patches_list, [len(input_images)],
+            expert_domain_ids = expert_domain_ids,
+            num_expert_token_all = self.chimera.num_expert_token_all)
+        input_ids = queries[0].to(self.chimera.device)
+        placement_index = self.prompt_builder.placement_index(runs_list, self.model.context_token_ids(), input_ids.shape[0])
+        with torch.no_grad():
+            input_embeds = self.model.get_input_embeds(
+                input_ids[None],
+                visual_features=visual_features,
+                expert_visual_features=expert_visual_features,
+                placement_index=placement_index.to(input_ids.device))
+        return self.engine.add_request(inputs_embeds=input_embeds[0])
+
+    def step(self) -> List[Tuple[int, str]]:
+        responses = []
+        for request in self.engine.step():
+            response = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+            responses.append((request.request_id, response.split(self.template.sep)[0].strip()))
+        return responses
+
+    def run(self, inputs: List[Tuple[str, List]]) -> List[str]:
+        """Answer a list of (user_prompt, input_images), returns the responses in order."""
+        request_ids = [self.submit(user_prompt, input_images) for user_prompt, input_images in inputs]
+        responses = {}
+        while self.has_unfinished_requests():
+            responses.update(self.step())
+        return [responses[x] for x in request_ids]
+
+
+class PipelinedExecutor:
+    """
+    Overlap CPU preprocessing with model execution for a stream of requests.
+
+    Decoding and tiling (`preprocess_images`) run in a pool of `num_workers` threads or processes, while a single model
+    thread runs the ViT, the router, the expert branch and the LLM, so request N+1 is preprocessed while request N
+    is on the device. At most `max_pending` preprocessed requests wait for the model; `submit` blocks beyond that.
+
+    Usage:
+        with PipelinedExecutor(chimera, num_workers=4) as executor:
+            for response in executor.map(requests):  # requests: iterable of (user_prompt, input_images)
+                ...
+    """
+
+    def __init__(
+            self,
+            chimera: Chimera4easyuse,
+            num_workers = 2,
+            use_processes = False,
+            max_pending = 4,
+            max_num = 12):
+
+        self.chimera = chimera
+        self.max_num = max_num
+        self.max_pending = max_pending
+        # 进程间传递的tensor无法保持pinned，只在线程模式下pin
+        self.pin_memory = not use_processes and chimera.device.type == 'cuda'
+        if use_processes:
+            self.pool = ProcessPoolExecutor(max_workers=num_workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+        self._requests = queue.Queue(maxsize=max_pending)
+        self._model_thread = threading.Thread(target=self._model_loop, daemon=True)
+        self._model_thread.start()
+
+    def submit(self, user_prompt, input_images: List) -> Future:
+        """Queue one request, returns a future of its response. Blocks while `max_pending` requests are waiting."""
+        preprocessed = self.pool.submit(preprocess_images, input_images, self.max_num, self.pin_memory, self.chimera.dtype)
+        response = Future()
+        self._requests.put((user_prompt, preprocessed, response))
+        return response
 
+    def map(self, requests):
+        """Yield the responses of an iterable of (user_prompt, input_images) in order."""
+        pending = deque()
+        for user_prompt, input_images in requests:
+            pending.append(self.submit(user_prompt, input_images))
+            while len(pending) > self.max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _model_loop(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            user_prompt, preprocessed, response = item
+            if not response.set_running_or_notify_cancel():
+                continue
+            try:
+                images, pixel_values_list = preprocessed.result()
+                response.set_result(self.chimera.get_response(user_prompt, images, pixel_values_list=pixel_values_list))
+            except Exception as e:
+                response.set_exception(e)
+
+    def shutdown(self):
+        self._requests.put(None)
+        self._model_thread.join()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -0,0 +1,78 @@
+"""
+Content-addressed LRU cache for encoded images.
+
+Asking several questions about the same chart or document re-runs tiling, the InternViT, the router and the expert
+encoder on identical pixels. `FeatureCache` stores, per image, the projected `vit_embeds`, the routing decision and the
+projected expert feature, keyed by a hash of the image content and the preprocessing parameters. Entries are evicted
+least-recently-used first once the cached tensors exceed `max_bytes`.
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import torch
+
+
+def image_hash(image, **params) -> str:
+    """Hash of the decoded pixels of a PIL image plus the preprocessing parameters that produced its features."""
+    h = hashlib.sha1()
+    h.update(f'{image.mode}:{image.size}:{sorted(params.items())}'.encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def _num_bytes(entry: Dict[str, Any]) -> int:
+    return sum(v.numel() * v.element_size() for v in entry.values() if isinstance(v, torch.Tensor))
+
+
+class FeatureCache:
+    """Byte-bounded LRU mapping of image hash -> dict(vit_embeds=..., domain_id=..., expert_feature=...)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        size = _num_bytes(entry)
+        if size > self.max_bytes:
+            # 单个条目超过上限时不缓存，避免把整个缓存清空
+            return
+        if key in self._entries:
+            self.num_bytes -= _num_bytes(self._entries.pop(key))
+        self._entries[key] = entry
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= _num_bytes(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            entries=len(self._entries),
+            num_bytes=self.num_bytes,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
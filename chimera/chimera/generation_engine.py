@@ -0,0 +1,304 @@
+"""
+Iteration-level (continuous) batching for the Chimera language models.
+
+`language_model.generate` keeps a batch together from the first token to the last: short answers wait for the longest
+one and new requests wait for the whole batch. `ContinuousBatchingEngine` schedules at the granularity of one decode
+step instead. A request is prefilled on its own as soon as a slot is free (its `inputs_embeds` already contain the
+visual features), its KV cache joins the running batch, every step decodes one token for all active sequences, and
+sequences leave the batch as soon as they hit EOS or `max_new_tokens`.
+
+The running batch keeps one legacy `(key, value)` tuple per layer, left padded to the longest sequence, plus a 2D
+attention mask and the per-sequence positions, which is the cache format InternLM2, Phi3 and Qwen2 all accept. The
+cache is only re-packed when a sequence joins or leaves. For InternLM2 and Phi3 a `PagedKVCache` can be given
+instead: every request then owns a block table in the shared pool, joining and leaving the batch needs no copy, and
+requests wait in the queue while the pool is too full to hold their prompt.
+"""
+
+import itertools
+from collections import deque
+from typing import List, Optional, Tuple, Union
+
+import torch
+from transformers.generation.logits_process import (
+    LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper, TopKLogitsWarper,
+    TopPLogitsWarper)
+
+from chimera.paged_kv_cache import PagedKVCache
+
+
+def build_logits_processor(
+        do_sample: bool = False,
+        temperature: float = 1.0,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        repetition_penalty: float = 1.0) -> LogitsProcessorList:
+    """The logits processors HF `generate` would apply for these generation settings."""
+    # 与HF generate相同的logits处理；输入只有inputs_embeds时重复惩罚只作用于生成的token
+    logits_processor = LogitsProcessorList()
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        logits_processor.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    if do_sample:
+        if temperature is not None and temperature != 1.0:
+            logits_processor.append(TemperatureLogitsWarper(temperature))
+        if top_k is not None and top_k != 0:
+            logits_processor.append(TopKLogitsWarper(top_k))
+        if top_p is not None and top_p < 1.0:
+            logits_processor.append(TopPLogitsWarper(top_p))
+    return logits_processor
+
+
+class GenerationRequest:
+    """A queued or running sequence of `ContinuousBatchingEngine`."""
+
+    def __init__(
+            self,
+            request_id: int,
+            inputs_embeds: torch.FloatTensor,
+            max_new_tokens: int = 512,
+            eos_token_id: Union[int, List[int], None] = None,
+            do_sample: bool = False,
+            temperature: float = 1.0,
+            top_k: int = 0,
+            top_p: float = 1.0,
+            repetition_penalty: float = 1.0,
+            **kwargs):
+        self.request_id = request_id
+        self.inputs_embeds = inputs_embeds
+        self.max_new_tokens = max_new_tokens
+        if eos_token_id is None:
+            eos_token_id = []
+        self.eos_token_ids = set([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id)
+        self.do_sample = do_sample
+        self.num_tokens = inputs_embeds.shape[0]
+        self.output_ids = []
+
+        self.logits_processor = build_logits_processor(do_sample, temperature, top_k, top_p, repetition_penalty)
+
+    @property
+    def finished(self) -> bool:
+        return len(self.output_ids) >= self.max_new_tokens or (
+            len(self.output_ids) > 0 and self.output_ids[-1] in self.eos_token_ids)
+
+    def next_token(self, logits: torch.FloatTensor) -> int:
+        """Pick the next token from the (vocab,) logits of this sequence."""
+        if len(self.logits_processor) > 0:
+            output_ids = torch.tensor([self.output_ids], dtype=torch.long, device=logits.device)
+            logits = self.logits_processor(output_ids, logits[None].float())[0]
+        if self.do_sample:
+            return torch.multinomial(logits.float().softmax(-1), num_samples=1).item()
+        return logits.argmax(-1).item()
+
+
+class ContinuousBatchingEngine:
+    """
+    Continuous batching around a causal LM backbone (`InternLM2ForCausalLM`, `Phi3ForCausalLM`, `Qwen2ForCausalLM`).
+
+    `add_request` queues a prompt given as `inputs_embeds` (or `input_ids`), `step` admits queued requests while
+    fewer than `max_batch_size` are running, decodes one token for all running sequences and returns the requests
+    that finished in this step. `generate` runs a list of prompts to completion.
+
+    With `kv_cache` (a `PagedKVCache` built for the backbone, InternLM2 or Phi3 only) the running sequences keep
+    their keys/values in its blocks instead of in padded tuples.
+    """
+
+    def __init__(
+            self,
+            language_model,
+            max_batch_size: int = 8,
+            kv_cache: Optional[PagedKVCache] = None,
+            **generation_config):
+        self.language_model = language_model
+        self.max_batch_size = max_batch_size
+        self.kv_cache = kv_cache
+        self.generation_config = generation_config
+        self._request_ids = itertools.count()
+        self.waiting = deque()
+        self.running: List[GenerationRequest] = []
+
+        # 运行中batch的状态：每层左padding的(key, value)、2D attention mask、下一个token的位置
+        self.past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None
+        self.attention_mask: Optional[torch.LongTensor] = None
+        self.position_ids: Optional[torch.LongTensor] = None
+        self.num_steps = 0
+
+    @property
+    def device(self):
+        return self.language_model.get_input_embeddings().weight.device
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    def add_request(
+            self,
+            inputs_embeds: Optional[torch.FloatTensor] = None,
+            input_ids: Optional[torch.LongTensor] = None,
+            **generation_config) -> int:
+        """Queue a prompt of shape (L, C) (`inputs_embeds`) or (L,) (`input_ids`); returns its request id."""
+        assert (inputs_embeds is None) != (input_ids is None), 'exactly one of inputs_embeds and input_ids is needed'
+        if inputs_embeds is None:
+            with torch.no_grad():
+                inputs_embeds = self.language_model.get_input_embeddings()(input_ids.to(self.device))
+        config = dict(self.generation_config)
+        config.update(generation_config)
+        request = GenerationRequest(next(self._request_ids), inputs_embeds, **config)
+        self.waiting.append(request)
+        return request.request_id
+
+    @torch.no_grad()
+    def step(self) -> List[GenerationRequest]:
+        """Admit waiting requests, decode one token for every running sequence and retire the finished ones."""
+        finished = []
+        while self.waiting and len(self.running) < self.max_batch_size and self._can_admit(self.waiting[0]):
+            request = self.waiting.popleft()
+            past_key_values = self._prefill(request)
+            if request.finished:
+                finished.append(request)
+            else:
+                self._join(request, past_key_values)
+
+        if self.running:
+            self._decode()
+            finished += self._retire()
+        self.num_steps += 1
+        return finished
+
+    def generate(self, prompts: List[torch.FloatTensor], **generation_config) -> List[List[int]]:
+        """Run `prompts` (inputs_embeds of shape (L, C) each) to completion, returns the generated ids in order."""
+        request_ids = [self.add_request(inputs_embeds=x, **generation_config) for x in prompts]
+        outputs = {}
+        while self.has_unfinished_requests():
+            for request in self.step():
+                outputs[request.request_id] = request.output_ids
+        return [outputs[x] for x in request_ids]
+
+    def _can_admit(self, request: GenerationRequest) -> bool:
+        if self.kv_cache is None:
+            return True
+        # 留出每个运行中序列下一步可能需要的一个新block
+        num_blocks = self.kv_cache.num_blocks_needed(request.request_id, request.num_tokens) + len(self.running) + 1
+        if not self.running:
+            assert self.kv_cache.allocator.num_blocks >= num_blocks, \
+                f'the KV cache pool ({self.kv_cache.num_blocks} blocks) cannot hold a prompt of {request.num_tokens} tokens'
+        return self.kv_cache.allocator.can_allocate(num_blocks)
+
+    def _forward(self, inputs_embeds, attention_mask, position_ids, past_key_values):
+        outputs = self.language_model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True)
+        past_key_values = outputs.past_key_values
+        if self.kv_cache is None and hasattr(past_key_values, 'to_legacy_cache'):
+            past_key_values = past_key_values.to_legacy_cache()
+        return outputs.logits[:, -1, :], past_key_values
+
+    def _prefill(self, request: GenerationRequest):
+        inputs_embeds = request.inputs_embeds.to(self.device)[None]
+        length = inputs_embeds.shape[1]
+        if self.kv_cache is not None:
+            attention_mask = self.kv_cache.prepare([request.request_id], [length])
+        else:
+            attention_mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+        try:
+            logits, past_key_values = self._forward(
+                inputs_embeds,
+                attention_mask,
+                torch.arange(length, device=self.device)[None],
+                self.kv_cache)
+        except Exception:
+            if self.kv_cache is not None:
+                # forward失败时归还新请求的block，cache中不留没写入的token
+                self.kv_cache.free_sequence(request.request_id)
+            raise
+        if self.kv_cache is not None:
+            self.kv_cache.commit()
+        request.inputs_embeds = None
+        request.output_ids.append(request.next_token(logits[0]))
+        if self.kv_cache is not None and request.finished:
+            self.kv_cache.free_sequence(request.request_id)
+        return past_key_values
+
+    def _join(self, request: GenerationRequest, past_key_values):
+        """Merge the prefilled cache of `request` into the running batch, left padding to the longest sequence."""
+        if self.kv_cache is not None:
+            position = torch.tensor([[request.num_tokens]], dtype=torch.long, device=self.device)
+            self.position_ids = position if not self.running else torch.cat([self.position_ids, position])
+            self.running.append(request)
+            return
+        length = past_key_values[0][0].shape[2]
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+        position = torch.tensor([[request.num_tokens]], dtype=torch.long, device=self.device)
+        if not self.running:
+            self.past_key_values, self.attention_mask, self.position_ids = past_key_values, mask, position
+        else:
+            max_length = max(length, self.attention_mask.shape[1])
+            self.past_key_values = tuple(
+                (torch.cat([_left_pad(k, max_length), _left_pad(new_k, max_length)]),
+                 torch.cat([_left_pad(v, max_length), _left_pad(new_v, max_length)]))
+                for (k, v), (new_k, new_v) in zip(self.past_key_values, past_key_values))
+            self.attention_mask = torch.cat([_left_pad(self.attention_mask, max_length), _left_pad(mask, max_length)])
+            self.position_ids = torch.cat([self.position_ids, position])
+        self.running.append(request)
+
+    def _decode(self):
+        input_ids = torch.tensor([[x.output_ids[-1]] for x in self.running], dtype=torch.long, device=self.device)
+        inputs_embeds = self.language_model.get_input_embeddings()(input_ids)
+        if self.kv_cache is not None:
+            attention_mask = self.kv_cache.prepare([x.request_id for x in self.running], [1] * len(self.running))
+            logits, _ = self._forward(inputs_embeds, attention_mask, self.position_ids, self.kv_cache)
+            self.kv_cache.commit()
+        else:
+            attention_mask = torch.cat(
+                [self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))], dim=1)
+            logits, self.past_key_values = self._forward(
+                inputs_embeds, attention_mask, self.position_ids, self.past_key_values)
+            self.attention_mask = attention_mask
+        self.position_ids = self.position_ids + 1
+
+        if all(not x.do_sample and len(x.logits_processor) == 0 for x in self.running):
+            # 全部greedy时一次argmax，只同步一次
+            for request, token in zip(self.running, logits.argmax(-1).tolist()):
+                request.output_ids.append(token)
+        else:
+            for request, cur_logits in zip(self.running, logits):
+                request.output_ids.append(request.next_token(cur_logits))
+
+    def _retire(self) -> List[GenerationRequest]:
+        finished = [x for x in self.running if x.finished]
+        if not finished:
+            return []
+        keep = [i for i, x in enumerate(self.running) if not x.finished]
+        self.running = [self.running[i] for i in keep]
+        if self.kv_cache is not None:
+            # 分页cache只需归还block
+            for request in finished:
+                self.kv_cache.free_sequence(request.request_id)
+            self.position_ids = self.position_ids.index_select(
+                0, torch.tensor(keep, dtype=torch.long, device=self.device)) if keep else None
+            return finished
+        if not keep:
+            self.past_key_values, self.attention_mask, self.position_ids = None, None, None
+            return finished
+
+        keep = torch.tensor(keep, dtype=torch.long, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, keep)
+        # 去掉剩余序列都不需要的左侧padding
+        start = attention_mask.shape[1] - (self.position_ids.index_select(0, keep).max().item())
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(
+            (k.index_select(0, keep)[:, :, start:], v.index_select(0, keep)[:, :, start:])
+            for k, v in self.past_key_values)
+        self.position_ids = self.position_ids.index_select(0, keep)
+        return finished
+
+
+def _left_pad(x: torch.Tensor, length: int) -> torch.Tensor:
+    """Left pad the sequence dimension (dim 2 of (B, H, L, D) caches, dim 1 of (B, L) masks) with zeros."""
+    dim = 2 if x.dim() == 4 else 1
+    if x.shape[dim] == length:
+        return x
+    shape = list(x.shape)
+    shape[dim] = length - x.shape[dim]
+    return torch.cat([x.new_zeros(shape), x], dim=dim)
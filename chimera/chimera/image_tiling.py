@@ -0,0 +1,155 @@
+"""
+Tensor-native dynamic tiling.
+
+`dynamic_preprocess` picks a tile grid whose aspect ratio is closest to the image, resizes the image to that grid and
+cuts it into `image_size` tiles (plus a thumbnail of the whole image). The PIL implementation crops every tile and
+pushes it through `Resize` + `ToTensor` + `Normalize` one at a time; here the resized image is converted to a tensor
+once, cut into tiles with a reshape view and all tiles are normalized in one batched op.
+
+Resizing itself stays in PIL: its uint8 bicubic resampler is faster on CPU than the antialiased torch kernel and keeps
+the output identical to the PIL path.
+
+`estimate_image_tokens` and `plan_tile_budget` work on the image size alone: they report how many LLM tokens an image
+will take and lower `max_num` per image so that a request fits a token budget, before anything is resized or encoded.
+"""
+
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import torch
+import torchvision.transforms.functional as F
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+@lru_cache(maxsize=None)
+def get_target_ratios(min_num: int = 1, max_num: int = 12) -> Tuple[Tuple[int, int], ...]:
+    """All (cols, rows) grids with `min_num <= cols * rows <= max_num`, sorted by number of tiles."""
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+
+def get_tile_grid(width, height, min_num=1, max_num=12, image_size=448) -> Tuple[int, int]:
+    """(cols, rows) of the tile grid `dynamic_preprocess` uses for a `width` x `height` image."""
+    return find_closest_aspect_ratio(
+        width / height, get_target_ratios(min_num, max_num), width, height, image_size)
+
+
+def dynamic_preprocess_tensor(
+        image,
+        min_num=1,
+        max_num=12,
+        image_size=448,
+        use_thumbnail=False,
+        mean=IMAGENET_MEAN,
+        std=IMAGENET_STD,
+) -> torch.FloatTensor:
+    """Tensor equivalent of `build_transform` applied to every image of `dynamic_preprocess`.
+
+    Returns normalized tiles of shape (num_tiles, 3, image_size, image_size), in the same order as the PIL path:
+    row-major tiles followed by the thumbnail.
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    orig_width, orig_height = image.size
+    cols, rows = get_tile_grid(orig_width, orig_height, min_num, max_num, image_size)
+
+    # (3, rows*S, cols*S) uint8 -> (rows*cols, 3, S, S), row-major like the PIL crops
+    resized = F.pil_to_tensor(image.resize((cols * image_size, rows * image_size)))
+    tiles = resized.reshape(3, rows, image_size, cols, image_size).permute(1, 3, 0, 2, 4)
+    if use_thumbnail and rows * cols != 1:
+        thumbnail = F.pil_to_tensor(image.resize((image_size, image_size)))
+        tiles = torch.cat([tiles.reshape(rows * cols, 3, image_size, image_size), thumbnail[None]])
+
+    pixel_values = tiles.reshape(-1, 3, image_size, image_size).float().div_(255)
+    mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+    std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+    return pixel_values.sub_(mean).div_(std)
+
+
+def count_tiles(cols: int, rows: int, use_thumbnail: bool = True) -> int:
+    """Number of tiles `dynamic_preprocess` outputs for a (cols, rows) grid, thumbnail included."""
+    return cols * rows + (1 if use_thumbnail and cols * rows != 1 else 0)
+
+
+def estimate_image_tokens(
+        width: int,
+        height: int,
+        num_image_token: int,
+        num_expert_token: int = 0,
+        min_num: int = 1,
+        max_num: int = 12,
+        image_size: int = 448,
+        use_thumbnail: bool = True) -> dict:
+    """
+    LLM tokens of one image tiled with `max_num`, from its size alone: `num_image_token` `<IMG_CONTEXT>` per tile plus
+    the `num_expert_token` tokens of the expert it is routed to (0 for none). Nothing is resized or encoded.
+    """
+    cols, rows = get_tile_grid(width, height, min_num, max_num, image_size)
+    num_tiles = count_tiles(cols, rows, use_thumbnail)
+    return dict(
+        grid = (cols, rows),
+        max_num = max_num,
+        num_tiles = num_tiles,
+        image_tokens = num_tiles * num_image_token,
+        expert_tokens = num_expert_token,
+        num_tokens = num_tiles * num_image_token + num_expert_token)
+
+
+def plan_tile_budget(
+        image_sizes: List[Tuple[int, int]],
+        token_budget: int,
+        num_image_token: int,
+        num_expert_tokens: Optional[List[int]] = None,
+        min_num: int = 1,
+        max_num: int = 12,
+        image_size: int = 448,
+        use_thumbnail: bool = True) -> List[dict]:
+    """
+    Pick the `max_num` of every image of a request so that all their tokens fit in `token_budget`.
+
+    Every image starts from the grid `max_num` gives it; while the request is over budget, the image with the most
+    tiles is re-tiled with a smaller `max_num` (the closest aspect ratio among the smaller grids). Expert tokens are
+    fixed by the routing and are not reduced. If the request does not fit even with one tile per image, every image
+    gets one tile. Returns the `estimate_image_tokens` of every image, whose `max_num` is the one to pass to
+    `load_image`.
+    """
+    if num_expert_tokens is None:
+        num_expert_tokens = [0] * len(image_sizes)
+    assert len(num_expert_tokens) == len(image_sizes), \
+        f'got {len(image_sizes)} images but {len(num_expert_tokens)} expert token counts'
+
+    def estimate(i, cur_max_num):
+        width, height = image_sizes[i]
+        return estimate_image_tokens(
+            width, height, num_image_token, num_expert_tokens[i], min(min_num, cur_max_num), cur_max_num, image_size,
+            use_thumbnail)
+
+    plans = [estimate(i, max_num) for i in range(len(image_sizes))]
+    while sum(x['num_tokens'] for x in plans) > token_budget:
+        # 每次缩小tile最多的图片，tile数严格减少，最多循环sum(max_num)次
+        i = max(range(len(plans)), key=lambda j: plans[j]['num_tiles'])
+        cols, rows = plans[i]['grid']
+        if cols * rows == 1:
+            break
+        plans[i] = estimate(i, cols * rows - 1)
+    return plans
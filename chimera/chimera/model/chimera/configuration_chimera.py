@@ -42,6 +42,10 @@ class ChimeraChatConfig(PretrainedConfig):
             ps_version='v1',
             min_dynamic_patch=1,
             max_dynamic_patch=6,
+            router_exit_layer=-1,
+            router_image_size=None,
+            router_confidence_threshold=0.0,
+            visual_token_budget=None,
             **kwargs):
         super().__init__(**kwargs)
 
@@ -85,6 +89,15 @@ class ChimeraChatConfig(PretrainedConfig):
         self.ps_version = ps_version  # pixel shuffle version
         self.min_dynamic_patch = min_dynamic_patch
         self.max_dynamic_patch = max_dynamic_patch
+        # 快速路由：在InternViT第router_exit_layer层的输出(hidden_states下标，-1为最后一层)、
+        # router_image_size分辨率的thumbnail上路由，置信度低于router_confidence_threshold时回退到完整的expert_router。
+        # 中间层需要训练好的fast_expert_router：checkpoint中没有时(例如已发布的模型)只用完整的expert_router，
+        # 先用tools/eval_fast_router.py --fit-steps蒸馏并--save，再通过ChimeraChatModel.load_fast_router加载
+        self.router_exit_layer = router_exit_layer
+        self.router_image_size = router_image_size
+        self.router_confidence_threshold = router_confidence_threshold
+        # 每个tile经token merging后保留的视觉token数，None为不合并(pixel_shuffle后的全部token)
+        self.visual_token_budget = visual_token_budget
 
         
 
@@ -116,6 +129,10 @@ class ChimeraChatConfig(PretrainedConfig):
         output['ps_version'] = self.ps_version
         output['min_dynamic_patch'] = self.min_dynamic_patch
         output['max_dynamic_patch'] = self.max_dynamic_patch
+        output['router_exit_layer'] = self.router_exit_layer
+        output['router_image_size'] = self.router_image_size
+        output['router_confidence_threshold'] = self.router_confidence_threshold
+        output['visual_token_budget'] = self.visual_token_budget
 
         
         if self.expert_encoder_config is None:
@@ -1,3 +1,4 @@
+import threading
 import warnings
 from typing import Any, List, Optional, Tuple, Union
 
@@ -5,13 +6,18 @@ import torch.distributed as dist
 import torch.utils.checkpoint
 import transformers
 from chimera.conversation import get_conv_template
+from chimera.prompt_builder import PromptBuilder
+from chimera.sequence_packing import packed_causal_mask
+from chimera.speculative_decoding import speculative_generate
+from chimera.token_merging import merge_tokens
 from chimera.model.internlm2.modeling_internlm2 import InternLM2ForCausalLM
 from chimera.model.phi3.modeling_phi3 import Phi3ForCausalLM
 from peft import LoraConfig, get_peft_model
 from torch import nn
 from torch.nn import CrossEntropyLoss
 from transformers import (AutoModel, GenerationConfig, LlamaForCausalLM,
-                          LlamaTokenizer, Qwen2ForCausalLM)
+                          LlamaTokenizer, Qwen2ForCausalLM, StoppingCriteria,
+                          StoppingCriteriaList, TextIteratorStreamer)
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import ModelOutput, logging
@@ -29,6 +35,68 @@ import pdb
 logger = logging.get_logger(__name__)
 
 
+class EventStoppingCriteria(StoppingCriteria):
+    """Stops `generate` at the next token once `event` is set (from another thread)."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def merge_stopping_criteria(generation_config: dict, stopping_criteria: Optional[StoppingCriteriaList]) -> dict:
+    """`generation_config` with `stopping_criteria` appended to the `stopping_criteria` the caller already set in it."""
+    if stopping_criteria is None:
+        return generation_config
+    existing = generation_config.get('stopping_criteria')
+    if isinstance(existing, StoppingCriteria):
+        existing = [existing]
+    return dict(generation_config, stopping_criteria=StoppingCriteriaList([*(existing or []), *stopping_criteria]))
+
+
+def stream_generate(generate_fn, streamer: TextIteratorStreamer, stop_str: Optional[str] = None):
+    """
+    Run `generate_fn(stopping_criteria)` (which passes `streamer` and `stopping_criteria` to `generate`) in a
+    background thread and yield the decoded text as it arrives, up to `stop_str`. Exceptions raised by `generate_fn`
+    are re-raised in the caller. When the caller stops early (at `stop_str`, or by closing the generator), generation
+    is stopped at the next token and the thread is joined before returning.
+    """
+    error = []
+    stop_event = threading.Event()
+
+    def producer():
+        try:
+            generate_fn(StoppingCriteriaList([EventStoppingCriteria(stop_event)]))
+        except Exception as e:
+            error.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        response = ''
+        for new_text in streamer:
+            if response == '':
+                new_text = new_text.lstrip()
+            if stop_str is not None and stop_str in response + new_text:
+                # sep不是special token时会出现在解码结果里，截断到sep为止
+                new_text = (response + new_text).split(stop_str)[0][len(response):]
+                if new_text:
+                    yield new_text
+                return
+            response += new_text
+            if new_text:
+                yield new_text
+    finally:
+        # 提前结束时停止生成，避免后台线程继续占用device直到max_new_tokens
+        stop_event.set()
+        thread.join()
+    if error:
+        raise error[0]
+
+
 def version_cmp(v1, v2, op='eq'):
     import operator
 
@@ -54,7 +122,10 @@ class ChimeraChatModel(PreTrainedModel):
         self.patch_size = patch_size
         self.select_layer = config.select_layer
         self.template = config.template
-        self.num_image_token = int((image_size // patch_size) ** 2 * (config.downsample_ratio ** 2))
+        # pixel_shuffle后每个tile的token数；设置visual_token_budget时num_image_token为合并后的token数，prompt按它构造
+        self.num_image_token_full = int((image_size // patch_size) ** 2 * (config.downsample_ratio ** 2))
+        self.num_image_token = self.num_image_token_full
+        self.set_visual_token_budget(config.visual_token_budget)
         self.downsample_ratio = config.downsample_ratio
         self.ps_version = config.ps_version
         self.llm_arch_name = config.llm_config.architectures[0]
@@ -94,6 +165,18 @@ class ChimeraChatModel(PreTrainedModel):
                 for i in range(self.num_expert_encoder):
                     setattr(self, f'domain_{i}_context_token_id', 0)
         #/pts
+
+        # 快速路由：提前退出的ViT层/低分辨率thumbnail，置信度不足时回退到完整的expert_router
+        self.router_exit_layer = config.router_exit_layer
+        self.router_image_size = config.router_image_size
+        self.router_confidence_threshold = config.router_confidence_threshold
+        # 中间层的class token和最后一层的分布不同，需要单独的router
+        if self.expert_router is not None and self.router_exit_layer not in (-1, config.vision_config.num_hidden_layers):
+            self.fast_expert_router = nn.Linear(config.vision_config.hidden_size, self.num_expert_encoder + 1, bias=False)
+        else:
+            self.fast_expert_router = None
+        # checkpoint中没有fast_expert_router权重时由from_pretrained置为False，此时只用完整的expert_router
+        self.fast_router_ready = True
         
         # self.table_context_token_id = None
         # self.chart_context_token_id = None
@@ -142,6 +225,28 @@ class ChimeraChatModel(PreTrainedModel):
         if config.use_llm_lora:
             self.wrap_llm_lora(r=config.use_llm_lora, lora_alpha=2 * config.use_llm_lora)
 
+    def quantize_dynamic_int8(self):
+        """
+        Dynamic int8 quantization (`torch.ao`) of the linear layers of `language_model`, `mlp1` and the expert MLPs,
+        for CPU inference in float32. The vision encoders keep their float weights.
+        """
+        from torch.ao.quantization import quantize_dynamic
+        quantize_dynamic(self.language_model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        quantize_dynamic(self.mlp1, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        if self.expert_encoder is not None:
+            quantize_dynamic(self.expert_encoder.mlp, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        return self
+
+    def set_visual_token_budget(self, budget: Optional[int] = None):
+        """
+        Merge the visual tokens of every tile down to `budget` in `extract_feature` (see `chimera.token_merging`),
+        `None` to keep all of them. Prompts built afterwards use the reduced `num_image_token`.
+        """
+        assert budget is None or 0 < budget <= self.num_image_token_full, \
+            f'the visual token budget must be in (0, {self.num_image_token_full}], got {budget}'
+        self.config.visual_token_budget = budget
+        self.num_image_token = budget or self.num_image_token_full
+
     def set_domain_context_token_ids(self, token_ids):
         assert len(token_ids) == self.num_expert_encoder, f"Got {len(token_ids)} to set, but supports {self.num_expert_encoder} domain"
         for i in range(self.num_expert_encoder):
@@ -187,6 +292,7 @@ class ChimeraChatModel(PreTrainedModel):
             expert_encoder_attention_mask_list: List[torch.FloatTensor] = [],
             expert_domain_ids: Optional[torch.Tensor] = None,
             thumbnail: torch.FloatTensor = None,
+            thumbnail_indices: Optional[torch.LongTensor] = None,
             input_ids: torch.LongTensor = None,
             attention_mask: Optional[torch.Tensor] = None,
             position_ids: Optional[torch.LongTensor] = None,
@@ -197,45 +303,41 @@ class ChimeraChatModel(PreTrainedModel):
             output_attentions: Optional[bool] = None,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
+            cu_seqlens: Optional[torch.Tensor] = None,
+            placement_index: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
+        r"""
+        cu_seqlens (`torch.Tensor`, *optional*):
+            Boundaries of the samples packed into the rows of `input_ids` by `packed_data_collator`, over the flattened
+            (B * N) tokens. The visual inputs are concatenated in sample order, so they need no remapping.
+        placement_index (`torch.LongTensor`, *optional*):
+            Positions of all context tokens in the flattened (B * N) `input_ids`, grouped by ascending token id, as the
+            collators build it from the prompt builder runs (`context_placement_index`). Without it, or when its length
+            does not match the visual features (e.g. truncated prompts), the positions are recomputed from `input_ids`.
+        """
         
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
-        # <-------------------------------- 获取general image feature并替换 -------------------------------->
+        # <-------------------------------- 获取general image feature -------------------------------->
         image_flags = image_flags.squeeze(-1)
-        input_embeds = self.language_model.get_input_embeddings()(input_ids).clone()
+        input_embeds = self.language_model.get_input_embeddings()(input_ids)
 
-        vit_embeds = self.extract_feature(pixel_values)
+        # thumbnail_indices给定时(thumbnail在pixel_values中的行号)，router直接复用这次ViT前向的pooler_output
+        vit_embeds, pooled_output = self.extract_feature(pixel_values, return_pooled=True)
         vit_embeds = vit_embeds[image_flags == 1]
         vit_batch_size = pixel_values.shape[0]
 
         B, N, C = input_embeds.shape
-        input_embeds = input_embeds.reshape(B * N, C)
 
         
         if torch.distributed.is_initialized() and torch.distributed.get_rank() == 0:
             print(f'dynamic ViT batch size: {vit_batch_size}, images per sample: {vit_batch_size / B}, dynamic token length: {N}')
             
       
+        token_ids = [self.img_context_token_id]
+        features = [vit_embeds.reshape(-1, C)]
 
-        input_ids = input_ids.reshape(B * N)
-        selected = (input_ids == self.img_context_token_id)
-
-        try:
-            input_embeds[selected] = input_embeds[selected] * 0.0 + vit_embeds.reshape(-1, C)
-            ignore_flag = False
-        except Exception as e:
-            vit_embeds = vit_embeds.reshape(-1, C)
-            print(f'warning: {e}, input_embeds[selected].shape={input_embeds[selected].shape}, '
-                  f'vit_embeds.shape={vit_embeds.shape}')
-            n_token = selected.sum()
-            input_embeds[selected] = input_embeds[selected] * 0.0 + vit_embeds[:n_token]
-            ignore_flag = True
-
-
-        input_embeds = input_embeds.reshape(B, N, C)
-
-        # <-------------------------------- 获取domain image feature并替换 -------------------------------->
+        # <-------------------------------- 获取domain image feature -------------------------------->
         
         assert len(expert_encoder_pixel_value_list)== len(expert_encoder_attention_mask_list) and expert_domain_ids.shape[0] == thumbnail.shape[0], \
         f"for expert encoder branch, number of pixel_value and attention must be consistant, expert_domain_ids and thumbnail must be consistant, but get {len(expert_encoder_pixel_value_list)} pixel value, {len(expert_encoder_attention_mask_list)} attention mask, domain id of shape {expert_domain_ids.shape} and thumbnail of shape {thumbnail.shape}"
@@ -243,50 +345,83 @@ class ChimeraChatModel(PreTrainedModel):
 
         route_logits = None
         route_labels = None
+        fast_route_logits = None
+        unused_params = []
         if len(expert_encoder_pixel_value_list)>0 and len(expert_encoder_attention_mask_list)>0 and expert_domain_ids is not None and thumbnail is not None:
             # !! 只有从router中输出的index以及训练使用的label需要-1 shift，其余编号全是0~num_encoder-1 !!
             # B,N_encoder
-            route_logits = self.expert_route(thumbnail)
+            if thumbnail_indices is not None:
+                route_logits = self.expert_route(pooled_feature=pooled_output[thumbnail_indices])
+            else:
+                route_logits = self.expert_route(thumbnail)
             # B,
             route_labels = expert_domain_ids
+            if self.fast_expert_router is not None:
+                # 快速路由只训练router本身，输入与推理时一致
+                with torch.no_grad():
+                    fast_pooled_feature = self.fast_route_feature(thumbnail)
+                fast_route_logits = self.fast_expert_route(pooled_feature=fast_pooled_feature)
             # list, len=num_encoder
+            # shift -1 ,null类对应-1，其余index和expert encoder一致
+            # 每个encoder只编码路由到该domain的图片(按原顺序)，没有图片的encoder返回None
             expert_visual_features = self.expert_encoder(
                 pixel_value_list = expert_encoder_pixel_value_list,
                 attention_mask_list = expert_encoder_attention_mask_list,
                 domain_ids = expert_domain_ids-1
             )
 
-            B, N, C = input_embeds.shape
-            input_embeds = input_embeds.reshape(B * N, C)
-            input_ids = input_ids.reshape(B * N)
-
-            # 按照不同的模态分别替换特征
-            # shift -1 ,null类对应-1，其余index和expert encoder一致
-            domain_mask = expert_domain_ids-1
+            # 按照不同的模态分别收集特征
             for i in range(self.num_expert_encoder):
-                # pdb.set_trace()
-                cur_domain_context_token_id = getattr(self, f"domain_{i}_context_token_id")
-                cur_domain_mask = domain_mask==i
+                if expert_visual_features[i] is None:
+                    # 没有用到的encoder(解冻训练时)和mlp也要参与loss，避免分布式训练时出现没有梯度的参数
+                    uni_encoder, mlp, _ = self.expert_encoder.get_uni_encoder(index=i)
+                    unused_params.extend(p for p in [*uni_encoder.parameters(), *mlp.parameters()] if p.requires_grad)
+                    continue
                 # (any, L, D)
-                cur_select_domain_feature = expert_visual_features[i][cur_domain_mask]
-
-                cur_selected = (input_ids == cur_domain_context_token_id)
-                try:
-                    input_embeds[cur_selected] = input_embeds[cur_selected] * 0.0 + cur_select_domain_feature.reshape(-1, C)
-                    ignore_flag = False
-                except Exception as e:
-                    cur_select_domain_feature = cur_select_domain_feature.reshape(-1, C)
-                    print(f'warning: {e}, input_embeds[cur_selected].shape={input_embeds[cur_selected].shape}, '
-                        f'cur_select_domain_feature.shape={cur_select_domain_feature.shape}')
-                    n_token = cur_selected.sum()
-                    input_embeds[cur_selected] = input_embeds[cur_selected] * 0.0 + cur_select_domain_feature[:n_token]
-                    ignore_flag = True
-            
-          
-            input_embeds = input_embeds.reshape(B, N, C)
+                token_ids.append(getattr(self, f"domain_{i}_context_token_id"))
+                features.append(expert_visual_features[i].reshape(-1, C))
+
+        # <-------------------------------- 一次index_copy_替换所有视觉特征 -------------------------------->
+
+        ignore_flag = False
+        if placement_index is not None and placement_index.shape[0] == sum(x.shape[0] for x in features):
+            # collator给出的位置按token id升序分组，特征按相同顺序拼接；不需要遍历input_ids，也没有同步
+            features = [x for _, x in sorted(zip(token_ids, features), key=lambda item: item[0])]
+            placement_index = placement_index.to(input_ids.device)
+        else:
+            # 每个来源的特征按context_token_ids()的顺序拼接，和placement index一一对应
+            matched = input_ids.reshape(1, B * N) == torch.tensor(token_ids, dtype=input_ids.dtype, device=input_ids.device)[:, None]
+            placement_index = matched.nonzero()[:, 1]
+            ignore_flag = placement_index.shape[0] != sum(x.shape[0] for x in features)
+        if ignore_flag:
+            # 截断导致token数和特征数不一致时，每个来源只填前n_token个特征，并忽略这个batch的loss
+            num_tokens = matched.sum(-1).tolist()
+            print(f'warning: got {num_tokens} context tokens but {[x.shape[0] for x in features]} visual features')
+            features = [x[:n_token] for x, n_token in zip(features, num_tokens)]
+        features = features[0] if len(features) == 1 else torch.cat(features)
+
+        # embedding的backward不依赖其输出，可以直接原地替换，不需要clone；
+        # 只有enable_input_require_grads把输出标成需要梯度的叶子节点时才用非原地版本
+        inplace = not (input_embeds.is_leaf and input_embeds.requires_grad)
+        input_embeds = input_embeds.reshape(B * N, C)
+        if not inplace:
+            input_embeds = input_embeds.index_copy(0, placement_index, features.to(input_embeds.dtype))
+        else:
+            input_embeds.index_copy_(0, placement_index, features.to(input_embeds.dtype))
+        input_embeds = input_embeds.reshape(B, N, C)
 
         # <-------------------------------- 输入Decoder 进行后续损失计算 -------------------------------->
 
+        packed_kwargs = {}
+        if cu_seqlens is not None:
+            # 打包训练：InternLM2/Phi3直接用cu_seqlens；HF的flash attention从position_ids的重置推断样本边界；
+            # 其余实现用块对角的因果mask
+            attention_mask = None
+            if self.llm_arch_name in ['InternLM2ForCausalLM', 'Phi3ForCausalLM']:
+                packed_kwargs['cu_seqlens'] = cu_seqlens
+            elif self.language_model.config._attn_implementation != 'flash_attention_2':
+                attention_mask = packed_causal_mask(cu_seqlens, B, N, input_embeds.dtype, input_embeds.device)
+
         outputs = self.language_model(
             inputs_embeds=input_embeds,
             attention_mask=attention_mask,
@@ -296,6 +431,7 @@ class ChimeraChatModel(PreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            **packed_kwargs,
         )
         logits = outputs.logits
 
@@ -313,12 +449,16 @@ class ChimeraChatModel(PreTrainedModel):
             loss = loss_fct(shift_logits, shift_labels)
             if ignore_flag:
                 loss = loss * 0.0
+            if unused_params:
+                loss = loss + sum(p.sum() for p in unused_params) * 0.0
 
         
         if route_labels is not None and route_logits is not None:
             # 尺寸分别为(B)和(B,num_encoder),不需要调整
             route_loss = loss_fct(route_logits, route_labels)
             loss = loss + route_loss
+            if fast_route_logits is not None:
+                loss = loss + loss_fct(fast_route_logits, route_labels)
         
         
         if not return_dict:
@@ -350,39 +490,183 @@ class ChimeraChatModel(PreTrainedModel):
             x = x.permute(0, 2, 1, 3).contiguous()
         return x
 
-    def extract_feature(self, pixel_values):
+    def extract_feature(self, pixel_values, return_pooled=False):
         if self.select_layer == -1:
-            vit_embeds = self.vision_model(
+            vision_outputs = self.vision_model(
                 pixel_values=pixel_values,
                 output_hidden_states=False,
-                return_dict=True).last_hidden_state
+                return_dict=True)
+            vit_embeds = vision_outputs.last_hidden_state
         else:
-            vit_embeds = self.vision_model(
+            vision_outputs = self.vision_model(
                 pixel_values=pixel_values,
                 output_hidden_states=True,
-                return_dict=True).hidden_states[self.select_layer]
+                return_dict=True)
+            vit_embeds = vision_outputs.hidden_states[self.select_layer]
         vit_embeds = vit_embeds[:, 1:, :]
 
         h = w = int(vit_embeds.shape[1] ** 0.5)
         vit_embeds = vit_embeds.reshape(vit_embeds.shape[0], h, w, -1)
         vit_embeds = self.pixel_shuffle(vit_embeds, scale_factor=self.downsample_ratio)
         vit_embeds = vit_embeds.reshape(vit_embeds.shape[0], -1, vit_embeds.shape[-1])
+        if self.num_image_token < vit_embeds.shape[1]:
+            # 在mlp1之前合并，mlp1也只处理保留的token
+            vit_embeds = merge_tokens(vit_embeds, self.num_image_token)
         vit_embeds = self.mlp1(vit_embeds)
+        if return_pooled:
+            # pooler_output即router的输入，与tile特征共用同一次ViT前向
+            return vit_embeds, vision_outputs.pooler_output
         return vit_embeds
     
-    def expert_route(self, pixel_values):
-        pooled_feature = self.vision_model(
-                pixel_values=pixel_values,
-                output_hidden_states=False,
-                return_dict=True).pooler_output
+    def expert_route(self, pixel_values=None, pooled_feature=None):
+        if pooled_feature is None:
+            pooled_feature = self.vision_model(
+                    pixel_values=pixel_values,
+                    output_hidden_states=False,
+                    return_dict=True).pooler_output
         logits = self.expert_router(pooled_feature)
         # pdb.set_trace()
         return logits
 
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        output_loading_info = kwargs.pop('output_loading_info', False)
+        model, loading_info = super().from_pretrained(*args, output_loading_info=True, **kwargs)
+        if model.fast_expert_router is not None and \
+                any(key.startswith('fast_expert_router.') for key in loading_info['missing_keys']):
+            # 随机初始化的router会随机路由
+            logger.warning(
+                f'router_exit_layer={model.router_exit_layer} needs fast_expert_router weights, which the checkpoint '
+                f'does not have; routing with the full expert_router. Distill them with tools/eval_fast_router.py '
+                f'--fit-steps and load them with `load_fast_router`.')
+            model.fast_router_ready = False
+        return (model, loading_info) if output_loading_info else model
+
+    def load_fast_router(self, state_dict):
+        """Load trained `fast_expert_router` weights (e.g. saved by tools/eval_fast_router.py) and route with them."""
+        self.fast_expert_router.load_state_dict(state_dict)
+        self.fast_router_ready = True
+
+    def use_fast_router(self):
+        if self.fast_expert_router is not None and not self.fast_router_ready:
+            return False
+        return self.router_exit_layer != -1 or self.router_image_size is not None
+
+    def fast_route_feature(self, pixel_values):
+        """Class token after `router_exit_layer` ViT layers, on thumbnails resized to `router_image_size`."""
+        if self.router_image_size is not None and pixel_values.shape[-1] != self.router_image_size:
+            # thumbnail按完整router的分辨率给出，回退时可以直接复用
+            pixel_values = nn.functional.interpolate(
+                pixel_values, size=(self.router_image_size, self.router_image_size), mode='bicubic',
+                align_corners=False, antialias=True)
+        # router_exit_layer和select_layer一样是hidden_states的下标
+        num_layers = self.router_exit_layer if self.router_exit_layer >= 0 \
+            else self.config.vision_config.num_hidden_layers + 1 + self.router_exit_layer
+        return self.vision_model(
+                pixel_values=pixel_values,
+                output_hidden_states=False,
+                return_dict=True,
+                num_layers=num_layers).pooler_output
+
+    def fast_expert_route(self, pixel_values=None, pooled_feature=None):
+        if pooled_feature is None:
+            pooled_feature = self.fast_route_feature(pixel_values)
+        router = self.fast_expert_router if self.fast_expert_router is not None else self.expert_router
+        return router(pooled_feature)
+
+    def route(self, thumbnail, confidence_threshold=None, return_fallback=False):
+        """
+        Router logits for the (full resolution) thumbnails, using the fast router when `router_exit_layer` or
+        `router_image_size` is set.
+
+        Thumbnails whose fast routing confidence (max softmax probability) is below `confidence_threshold` (defaults
+        to `router_confidence_threshold`) are routed again with the full `expert_route`. With `return_fallback=True`
+        the boolean mask of those thumbnails is returned as well.
+        """
+        if not self.use_fast_router():
+            logits = self.expert_route(thumbnail)
+            fallback = torch.zeros(logits.shape[0], dtype=torch.bool, device=logits.device)
+            return (logits, fallback) if return_fallback else logits
+
+        if confidence_threshold is None:
+            confidence_threshold = self.router_confidence_threshold
+        logits = self.fast_expert_route(thumbnail)
+        fallback = logits.float().softmax(-1).amax(-1) < confidence_threshold
+        if confidence_threshold > 0:
+            fallback_indices = fallback.nonzero().squeeze(-1)
+            if fallback_indices.numel() > 0:
+                logits = logits.clone()
+                logits[fallback_indices] = self.expert_route(thumbnail[fallback_indices]).to(logits.dtype)
+        return (logits, fallback) if return_fallback else logits
+
+    def extract_feature_and_route(self, pixel_values, num_patches_list):
+        """Encode all tiles once and route every image on the pooled output of its thumbnail.
+
+        The thumbnail of an image is its last tile in `pixel_values` (see `load_image`), so its pooled output is
+        a by-product of `extract_feature` and no second ViT pass is needed.
+        """
+        vit_embeds, pooled_output = self.extract_feature(pixel_values, return_pooled=True)
+        thumbnail_indices = torch.tensor(num_patches_list, device=pooled_output.device).cumsum(0) - 1
+        route_logits = self.expert_route(pooled_feature=pooled_output[thumbnail_indices])
+        return vit_embeds, route_logits
+
+
+    def build_queries(self, tokenizer, questions, num_patches_list, num_images_list,
+                      expert_domain_ids: Optional[List[int]] = None, num_expert_token_all: List = [],
+                      IMG_START_TOKEN='<img>', IMG_END_TOKEN='</img>', IMG_CONTEXT_TOKEN='<IMG_CONTEXT>',
+                      DOMAIN_START_TOKEN='<domain>', DOMAIN_END_TOKEN='</domain>'):
+        """
+        Prompt `input_ids` of every question, with the spans of its `num_images_list[i]` images, and the runs
+        `PromptBuilder.placement_index` needs. Returns (input_ids_list, runs_list, template).
+        """
+        prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+        expert_token_list = [f"<DOMAIN_{i}_CONTEXT>" for i in range(self.num_expert_encoder or 0)]
+        image_spans = []
+        for i, num_patches in enumerate(num_patches_list):
+            domain_id = expert_domain_ids[i] if expert_domain_ids is not None else 0
+            if domain_id > 0:
+                domain_context_token, num_domain_token = expert_token_list[domain_id-1], num_expert_token_all[domain_id-1]
+            else:
+                domain_context_token, num_domain_token = None, 0
+            image_spans.append(prompt_builder.image_span(
+                self.num_image_token * num_patches, domain_context_token, num_domain_token,
+                IMG_START_TOKEN=IMG_START_TOKEN, IMG_END_TOKEN=IMG_END_TOKEN, IMG_CONTEXT_TOKEN=IMG_CONTEXT_TOKEN,
+                DOMAIN_START_TOKEN=DOMAIN_START_TOKEN, DOMAIN_END_TOKEN=DOMAIN_END_TOKEN))
+
+        queries, runs_list = [], []
+        start = 0
+        for question, num_images in zip(questions, num_images_list):
+            if num_images > 0 and '<image>' not in question:
+                question = '<image>\n' * num_images + question
+            assert question.count('<image>') == num_images, f'there are {question.count("<image>")} <image> token in question but get {num_images} input images'
+            template = get_conv_template(self.template)
+            template.system_message = self.system_message
+            template.append_message(template.roles[0], question)
+            template.append_message(template.roles[1], None)
+            query = template.get_prompt()
+            input_ids, runs = prompt_builder.encode(query, image_spans[start:start + num_images], return_runs=True)
+            queries.append(input_ids)
+            runs_list.append(runs)
+            start += num_images
+        return queries, runs_list, template
 
     def batch_chat(self, tokenizer, pixel_values, questions, generation_config, num_patches_list=None,
                    history=None, return_history=False, IMG_START_TOKEN='<img>', IMG_END_TOKEN='</img>',
-                   IMG_CONTEXT_TOKEN='<IMG_CONTEXT>', verbose=False, image_counts=None):
+                   IMG_CONTEXT_TOKEN='<IMG_CONTEXT>', verbose=False, image_counts=None,
+                   num_images_list: Optional[List[int]] = None,
+                   expert_encoder_pixel_value_list: List[torch.FloatTensor] = [],
+                   expert_encoder_attention_mask_list: List[torch.FloatTensor] = [],
+                   expert_domain_ids: Optional[List[int]] = None,
+                   num_expert_token_all: List = [],
+                   visual_features: Optional[torch.FloatTensor] = None,
+                   expert_visual_features: Optional[List[torch.FloatTensor]] = None,
+                   DOMAIN_START_TOKEN='<domain>', DOMAIN_END_TOKEN='</domain>', streamer=None):
+        """
+        num_patches_list为每张图的tile数，num_images_list为每个问题的图片数(默认每个问题一张图)。
+        expert_domain_ids为每张图的路由结果(0为null)，此时expert输入应按图片顺序只包含路由到该expert的图片(见`expert_preprocess`)，
+        整个batch中每个expert只做一次编码。
+        visual_features/expert_visual_features为已编码的特征时，pixel_values和expert输入可以为None。
+        """
         if history is not None or return_history:
             print('Now multi-turn chat is not supported in batch_chat.')
             raise NotImplementedError
@@ -391,38 +675,56 @@ class ChimeraChatModel(PreTrainedModel):
             num_patches_list = image_counts
             print('Warning: `image_counts` is deprecated. Please use `num_patches_list` instead.')
 
+        has_image = pixel_values is not None or visual_features is not None
+        if num_patches_list is None:
+            num_patches_list = [] if not has_image else [len(pixel_values if pixel_values is not None else visual_features)]
+        if num_images_list is None:
+            num_images_list = [1] * len(questions) if has_image else [0] * len(questions)
+        assert len(num_images_list) == len(questions) and sum(num_images_list) == len(num_patches_list), \
+            f'got {len(questions)} questions with {sum(num_images_list)} images in total, but {len(num_patches_list)} entries in num_patches_list'
+        assert pixel_values is None or len(pixel_values) == sum(num_patches_list)
+        assert visual_features is None or len(visual_features) == sum(num_patches_list)
+
         img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
         self.img_context_token_id = img_context_token_id
 
+        use_expert = (expert_visual_features is not None or (len(expert_encoder_pixel_value_list)>0 and len(expert_encoder_attention_mask_list)>0)) \
+            and expert_domain_ids is not None
+        if use_expert:
+            expert_token_list = [f"<DOMAIN_{i}_CONTEXT>" for i in range(self.num_expert_encoder)]
+            self.set_domain_context_token_ids(tokenizer.convert_tokens_to_ids(expert_token_list))
+            assert len(expert_domain_ids) == len(num_patches_list), \
+                f'got {len(expert_domain_ids)} expert_domain_ids for {len(num_patches_list)} images'
+
         if verbose and pixel_values is not None:
             image_bs = pixel_values.shape[0]
             print(f'dynamic ViT batch size: {image_bs}')
 
-        queries = []
-        for idx, num_patches in enumerate(num_patches_list):
-            question = questions[idx]
-            if pixel_values is not None and '<image>' not in question:
-                question = '<image>\n' + question
-            template = get_conv_template(self.template)
-            template.system_message = self.system_message
-            template.append_message(template.roles[0], question)
-            template.append_message(template.roles[1], None)
-            query = template.get_prompt()
-
-            image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * self.num_image_token * num_patches + IMG_END_TOKEN
-            query = query.replace('<image>', image_tokens, 1)
-            queries.append(query)
-
-        tokenizer.padding_side = 'left'
-        model_inputs = tokenizer(queries, return_tensors='pt', padding=True)
-        input_ids = model_inputs['input_ids'].cuda()
-        attention_mask = model_inputs['attention_mask'].cuda()
+        prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+        queries, runs_list, template = self.build_queries(
+            tokenizer, questions, num_patches_list, num_images_list,
+            expert_domain_ids = expert_domain_ids if use_expert else None,
+            num_expert_token_all = num_expert_token_all,
+            IMG_START_TOKEN=IMG_START_TOKEN, IMG_END_TOKEN=IMG_END_TOKEN, IMG_CONTEXT_TOKEN=IMG_CONTEXT_TOKEN,
+            DOMAIN_START_TOKEN=DOMAIN_START_TOKEN, DOMAIN_END_TOKEN=DOMAIN_END_TOKEN)
+
+        model_inputs = prompt_builder.pad(
+            queries, padding_side='left', runs_list=runs_list, token_ids=self.context_token_ids())
+        input_ids = model_inputs['input_ids'].to(self.device)
+        attention_mask = model_inputs['attention_mask'].to(self.device)
+        placement_index = model_inputs['placement_index'].to(self.device)
         eos_token_id = tokenizer.convert_tokens_to_ids(template.sep)
         generation_config['eos_token_id'] = eos_token_id
         generation_output = self.generate(
             pixel_values=pixel_values,
             input_ids=input_ids,
             attention_mask=attention_mask,
+            visual_features=visual_features,
+            expert_encoder_pixel_value_list = expert_encoder_pixel_value_list if use_expert else [],
+            expert_encoder_attention_mask_list = expert_encoder_attention_mask_list if use_expert else [],
+            expert_visual_features = expert_visual_features if use_expert else None,
+            placement_index=placement_index,
+            streamer=streamer,
             **generation_config
         )
         responses = tokenizer.batch_decode(generation_output, skip_special_tokens=True)
@@ -439,6 +741,8 @@ class ChimeraChatModel(PreTrainedModel):
             expert_encoder_attention_mask_list: List[torch.FloatTensor] = [],
             thumbnail: torch.FloatTensor = None,
             num_expert_token_all: List = [],
+            expert_domain_ids: Optional[List[int]] = None,
+            visual_features: Optional[torch.FloatTensor] = None,
             history=None, 
             return_history=False,
             num_patches_list=None, 
@@ -449,7 +753,8 @@ class ChimeraChatModel(PreTrainedModel):
             DOMAIN_START_TOKEN = '<domain>',
             DOMAIN_END_TOKEN = '</domain>',
             
-            verbose=False
+            verbose=False,
+            streamer=None
              ):
     
         if history is None and pixel_values is not None and '<image>' not in question:
@@ -491,11 +796,19 @@ class ChimeraChatModel(PreTrainedModel):
             print(f'dynamic ViT batch size: {image_bs}')
 
         
+        num_expert_token_list = []
+        domain_context_token_list = []
         if len(expert_encoder_pixel_value_list)>0 and len(expert_encoder_attention_mask_list)>0 and thumbnail is not None:
-            num_expert_token_list = []
-            domain_context_token_list = []
-            route_logits = self.expert_route(thumbnail)
-            expert_domain_ids = torch.argmax(route_logits,dim=-1)
+            # expert_domain_ids给定时，说明已经先路由，expert输入只包含路由到该expert的图片，不需要再筛选
+            pre_routed = expert_domain_ids is not None
+            if not pre_routed:
+                with torch.no_grad():
+                    if pixel_values is not None and visual_features is None:
+                        # thumbnail即每张图的最后一个tile，路由和tile特征共用一次ViT前向
+                        visual_features, route_logits = self.extract_feature_and_route(pixel_values, num_patches_list)
+                    else:
+                        route_logits = self.route(thumbnail)
+                expert_domain_ids = torch.argmax(route_logits,dim=-1).tolist()
 
             expert_mask = torch.zeros((self.num_expert_encoder,len(thumbnail))).bool().to(device = self.device)
             for i, domain_id in enumerate(expert_domain_ids):
@@ -509,30 +822,38 @@ class ChimeraChatModel(PreTrainedModel):
                     num_expert_token_list.append(0)
             
             # pdb.set_trace()
-            for i in range(self.num_expert_encoder):
-                expert_encoder_pixel_value_list[i] = expert_encoder_pixel_value_list[i][expert_mask[i]]
-                expert_encoder_attention_mask_list[i] = expert_encoder_attention_mask_list[i][expert_mask[i]] if expert_encoder_attention_mask_list[i] is not None else expert_encoder_attention_mask_list[i]
+            if not pre_routed:
+                for i in range(self.num_expert_encoder):
+                    expert_encoder_pixel_value_list[i] = expert_encoder_pixel_value_list[i][expert_mask[i]]
+                    expert_encoder_attention_mask_list[i] = expert_encoder_attention_mask_list[i][expert_mask[i]] if expert_encoder_attention_mask_list[i] is not None else expert_encoder_attention_mask_list[i]
 
         
+        prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+        image_spans = []
         for i, num_patches in enumerate(num_patches_list):
             if domain_context_token_list and num_expert_token_list and num_expert_token_list[i]>0:
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * self.num_image_token * num_patches}{IMG_END_TOKEN}{DOMAIN_START_TOKEN}{domain_context_token_list[i] * num_expert_token_list[i]}{DOMAIN_END_TOKEN}'
+                domain_context_token, num_domain_token = domain_context_token_list[i], num_expert_token_list[i]
             else:
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * self.num_image_token * num_patches}{IMG_END_TOKEN}'
-            query = query.replace('<image>', image_tokens, 1)
-        
-
-
-        model_inputs = tokenizer(query, return_tensors='pt')
-        input_ids = model_inputs['input_ids'].cuda()
-        attention_mask = model_inputs['attention_mask'].cuda()
+                domain_context_token, num_domain_token = None, 0
+            image_spans.append(prompt_builder.image_span(
+                self.num_image_token * num_patches, domain_context_token, num_domain_token,
+                IMG_START_TOKEN=IMG_START_TOKEN, IMG_END_TOKEN=IMG_END_TOKEN, IMG_CONTEXT_TOKEN=IMG_CONTEXT_TOKEN,
+                DOMAIN_START_TOKEN=DOMAIN_START_TOKEN, DOMAIN_END_TOKEN=DOMAIN_END_TOKEN))
+
+        input_ids, runs = prompt_builder.encode(query, image_spans, return_runs=True)
+        placement_index = prompt_builder.placement_index([runs], self.context_token_ids(), input_ids.shape[0])
+        input_ids = input_ids[None].to(self.device)
+        attention_mask = torch.ones_like(input_ids)
         generation_config['eos_token_id'] = eos_token_id
         generation_output = self.generate(
             pixel_values=pixel_values,
             input_ids=input_ids,
             attention_mask=attention_mask,
+            visual_features=visual_features,
             expert_encoder_pixel_value_list = expert_encoder_pixel_value_list,
             expert_encoder_attention_mask_list = expert_encoder_attention_mask_list,
+            placement_index=placement_index.to(self.device),
+            streamer=streamer,
             **generation_config
         )
         response = tokenizer.batch_decode(generation_output, skip_special_tokens=True)[0]
@@ -541,13 +862,146 @@ class ChimeraChatModel(PreTrainedModel):
         if return_history:
             return response, history
         else:
-            query_to_print = query.replace(IMG_CONTEXT_TOKEN, '')
-            query_to_print = query_to_print.replace(f'{IMG_START_TOKEN}{IMG_END_TOKEN}', '<image>')
             if verbose:
-                print(query_to_print, response)
+                print(query, response)
             return response
         
 
+    def stream_chat(self, tokenizer, pixel_values, question, generation_config, **kwargs):
+        """
+        Generator version of `chat`, takes the same arguments and yields the response text incrementally while
+        `language_model.generate` produces tokens. Stops at `template.sep`.
+        """
+        template = get_conv_template(self.template)
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        return stream_generate(
+            lambda stopping_criteria: self.chat(
+                tokenizer, pixel_values, question, merge_stopping_criteria(generation_config, stopping_criteria),
+                streamer=streamer, **kwargs),
+            streamer,
+            template.sep)
+
+    def context_token_ids(self) -> List[int]:
+        """`<IMG_CONTEXT>` followed by every `<DOMAIN_i_CONTEXT>`: the order in which visual features are placed."""
+        return [self.img_context_token_id] + [
+            getattr(self, f'domain_{i}_context_token_id') for i in range(self.num_expert_encoder)]
+
+    def placement_index_from_ids(self, input_ids: torch.LongTensor, token_ids: List[int]) -> torch.LongTensor:
+        """Same as `PromptBuilder.placement_index`, recovered from `input_ids` with a single scan (and one sync)."""
+        token_ids = torch.tensor(token_ids, dtype=input_ids.dtype, device=input_ids.device)
+        # (num_source, B*N)按行nonzero，结果先按来源再按位置排序
+        return (input_ids.reshape(1, -1) == token_ids[:, None]).nonzero()[:, 1]
+
+    def get_input_embeds(
+            self,
+            input_ids: torch.LongTensor,
+            pixel_values: Optional[torch.FloatTensor] = None,
+            visual_features: Optional[torch.FloatTensor] = None,
+            expert_encoder_pixel_value_list: List[torch.FloatTensor] = [],
+            expert_encoder_attention_mask_list: List[torch.FloatTensor] = [],
+            expert_visual_features: Optional[List[torch.FloatTensor]] = None,
+            placement_index: Optional[torch.LongTensor] = None,
+    ) -> torch.FloatTensor:
+        """
+        Embed `input_ids` and replace the image/domain context tokens with the visual features.
+
+        `placement_index` holds the positions of all context tokens in the flattened (B * N) embeddings, grouped by
+        `context_token_ids()` (see `PromptBuilder.placement_index`); every visual source is then written with a single
+        `index_copy_`. Without it the index is recovered from `input_ids`.
+        """
+        # visual_features/expert_visual_features为已经编码好的特征(例如来自缓存)，给定时不再重新编码
+
+        assert self.img_context_token_id is not None
+        input_embeds = self.language_model.get_input_embeddings()(input_ids)
+        if pixel_values is None and visual_features is None:
+            return input_embeds
+
+        if visual_features is not None:
+            vit_embeds = visual_features
+        else:
+            vit_embeds = self.extract_feature(pixel_values)
+
+        domain_feature = expert_visual_features
+        if domain_feature is None and len(expert_encoder_pixel_value_list)>0 and len(expert_encoder_attention_mask_list)>0 :
+            domain_feature = []
+            for i, cur_domain_pixel in enumerate(expert_encoder_pixel_value_list):
+                if cur_domain_pixel is not None and cur_domain_pixel.size(0)>0:
+                    cur_domain_mask = expert_encoder_attention_mask_list[i]
+                    domain_feature.append(
+                        self.expert_encoder.uni_encode(
+                                            encoder_index = i,
+                                            pixel_values = cur_domain_pixel,
+                                            attention_mask = cur_domain_mask,
+                                            )
+                    )
+                else:
+                    domain_feature.append(None)
+
+        B, N, C = input_embeds.shape
+        # 按context_token_ids()的顺序拼接所有视觉特征，没有特征的expert在prompt中也没有对应的token
+        token_ids = [self.img_context_token_id]
+        features = [vit_embeds.reshape(-1, C)]
+        for i, cur_domain_feature in enumerate(domain_feature or []):
+            if cur_domain_feature is not None:
+                token_ids.append(getattr(self, f"domain_{i}_context_token_id"))
+                features.append(cur_domain_feature.reshape(-1, C))
+        features = features[0] if len(features) == 1 else torch.cat(features)
+
+        if placement_index is None:
+            placement_index = self.placement_index_from_ids(input_ids, token_ids)
+        placement_index = placement_index.to(input_embeds.device)
+        assert placement_index.shape[0] == features.shape[0], \
+            f'got {placement_index.shape[0]} context tokens but {features.shape[0]} visual features'
+
+        input_embeds = input_embeds.reshape(B * N, C)
+        input_embeds.index_copy_(0, placement_index, features.to(input_embeds.device, input_embeds.dtype))
+        return input_embeds.reshape(B, N, C)
+
+    def get_draft_inputs(
+            self,
+            draft_model,
+            input_ids: torch.LongTensor,
+            pixel_values: Optional[torch.FloatTensor] = None,
+            expert_encoder_pixel_value_list: List[torch.FloatTensor] = [],
+            expert_encoder_attention_mask_list: List[torch.FloatTensor] = [],
+            placement_index: Optional[torch.LongTensor] = None,
+    ) -> dict:
+        """
+        Prompt of the speculative-decoding drafter, built from the same preprocessed (and already routed) inputs as
+        the prompt of this model.
+
+        A `ChimeraChatModel` drafter encodes the images with its own vision encoders; the expert features are only
+        used if it has the same expert encoders, otherwise (and for a plain language model drafter) the context
+        tokens keep their text embeddings, which only lowers the acceptance rate. The context token ids of the drafter
+        are set once when it is attached (`Chimera4easyuse.load_draft_model`).
+        """
+        if not isinstance(draft_model, ChimeraChatModel):
+            return dict(draft_input_ids=input_ids)
+        # drafter的视觉token数和context token必须与prompt中的一致
+        if pixel_values is not None and draft_model.num_image_token != self.num_image_token:
+            logger.warning_once(
+                f'the drafter uses {draft_model.num_image_token} tokens per tile instead of {self.num_image_token}, '
+                f'drafting without the image features')
+            pixel_values = None
+        if pixel_values is not None and draft_model.img_context_token_id != self.img_context_token_id:
+            logger.warning_once('the drafter does not have the context token ids of the target, drafting without the '
+                                'image features')
+            pixel_values = None
+        if draft_model.num_expert_encoder != self.num_expert_encoder or \
+                draft_model.context_token_ids()[1:] != self.context_token_ids()[1:]:
+            expert_encoder_pixel_value_list, expert_encoder_attention_mask_list = [], []
+            placement_index = None
+        if pixel_values is None:
+            placement_index = None
+        draft_inputs_embeds = draft_model.get_input_embeds(
+            input_ids.to(draft_model.device),
+            pixel_values=pixel_values.to(draft_model.device, draft_model.dtype) if pixel_values is not None else None,
+            expert_encoder_pixel_value_list=expert_encoder_pixel_value_list,
+            expert_encoder_attention_mask_list=expert_encoder_attention_mask_list,
+            placement_index=placement_index,
+        )
+        return dict(draft_inputs_embeds=draft_inputs_embeds)
+
     @torch.no_grad()
     def generate(
             self,
@@ -560,57 +1014,46 @@ class ChimeraChatModel(PreTrainedModel):
             return_dict: Optional[bool] = None,
             expert_encoder_pixel_value_list: List[torch.FloatTensor] = [],
             expert_encoder_attention_mask_list: List[torch.FloatTensor] = [],
+            expert_visual_features: Optional[List[torch.FloatTensor]] = None,
+            placement_index: Optional[torch.LongTensor] = None,
             **generate_kwargs,
     ) -> torch.LongTensor:
+        input_embeds = self.get_input_embeds(
+            input_ids,
+            pixel_values=pixel_values,
+            visual_features=visual_features,
+            expert_encoder_pixel_value_list=expert_encoder_pixel_value_list,
+            expert_encoder_attention_mask_list=expert_encoder_attention_mask_list,
+            expert_visual_features=expert_visual_features,
+            placement_index=placement_index,
+        )
 
-        assert self.img_context_token_id is not None
-        if pixel_values is not None:
-            if visual_features is not None:
-                vit_embeds = visual_features
-            else:
-                vit_embeds = self.extract_feature(pixel_values)
-            input_embeds = self.language_model.get_input_embeddings()(input_ids)
-            B, N, C = input_embeds.shape
-            input_embeds = input_embeds.reshape(B * N, C)
-
-
-            input_ids = input_ids.reshape(B * N)
-            selected = (input_ids == self.img_context_token_id)
-            # assert selected.sum() != 0
-            if selected.sum() != 0:
-                input_embeds[selected] = vit_embeds.reshape(-1, C).to(input_embeds.device)
-    
-            
-            if len(expert_encoder_pixel_value_list)>0 and len(expert_encoder_attention_mask_list)>0 :
-                domain_feature = []
-                for i, cur_domain_pixel in enumerate(expert_encoder_pixel_value_list):
-                    if cur_domain_pixel.size(0)>0:
-                        cur_domain_mask = expert_encoder_attention_mask_list[i]
-                        domain_feature.append(
-                            self.expert_encoder.uni_encode(
-                                                encoder_index = i,
-                                                pixel_values = cur_domain_pixel,
-                                                attention_mask = cur_domain_mask,
-                                                )
-                        )
-                    else:
-                        domain_feature.append(None)
-                
-                for i in range(self.num_expert_encoder):
-                    cur_domain_feature = domain_feature[i]
-                    if cur_domain_feature is not None:
-                        # pdb.set_trace()
-                        cur_domain_context_token_id = getattr(self, f"domain_{i}_context_token_id")
-                        # (any, L, D)
-                        cur_selected = (input_ids == cur_domain_context_token_id)
-                        if cur_selected.sum() != 0:
-                            input_embeds[cur_selected] =  cur_domain_feature.reshape(-1, C).to(input_embeds.device)
-            
-
-            input_embeds = input_embeds.reshape(B, N, C)
-        else:
-            input_embeds = self.language_model.get_input_embeddings()(input_ids)
-
+        draft_model = generate_kwargs.pop('draft_model', None)
+        num_draft_tokens = generate_kwargs.pop('num_draft_tokens', 4)
+        if draft_model is not None:
+            # speculative_generate不用attention_mask：只支持单条没有padding的prompt
+            assert input_embeds.shape[0] == 1, \
+                f'speculative decoding supports batch size 1 but got {input_embeds.shape[0]}'
+            assert attention_mask is None or bool(attention_mask.all()), 'speculative decoding does not support padding'
+            draft_inputs = self.get_draft_inputs(
+                draft_model,
+                input_ids,
+                pixel_values=pixel_values,
+                expert_encoder_pixel_value_list=expert_encoder_pixel_value_list,
+                expert_encoder_attention_mask_list=expert_encoder_attention_mask_list,
+                placement_index=placement_index,
+            )
+            # 与language_model.generate相同的默认值(例如top_k)
+            generation_config = (generation_config or self.language_model.generation_config).to_dict()
+            generate_kwargs = {**{k: v for k, v in generation_config.items() if v is not None}, **generate_kwargs}
+            return speculative_generate(
+                self.language_model,
+                draft_model.language_model if isinstance(draft_model, ChimeraChatModel) else draft_model,
+                input_embeds,
+                num_draft_tokens=num_draft_tokens,
+                **draft_inputs,
+                **generate_kwargs,
+            )
 
         outputs = self.language_model.generate(
             inputs_embeds=input_embeds,
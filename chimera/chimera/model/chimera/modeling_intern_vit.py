@@ -26,6 +26,8 @@ except:
     print('FlashAttention is not installed.')
     has_flash_attn = False
 
+has_sdpa = hasattr(F, 'scaled_dot_product_attention')
+
 logger = logging.get_logger(__name__)
 
 
@@ -83,6 +85,12 @@ class InternVisionEmbeddings(nn.Module):
         self.num_positions = self.num_patches + 1
 
         self.position_embedding = nn.Parameter(torch.randn(1, self.num_positions, self.embed_dim))
+        # 插值后的position embedding按(H, W, dtype, device)缓存，position_embedding变化(原地更新、替换)后失效
+        self._pos_embed_cache = {}
+        self._pos_embed_cache_size = 8
+
+    def clear_pos_embed_cache(self):
+        self._pos_embed_cache.clear()
 
     def _get_pos_embed(self, pos_embed, H, W):
         target_dtype = pos_embed.dtype
@@ -99,13 +107,30 @@ class InternVisionEmbeddings(nn.Module):
         patch_embeds = patch_embeds.flatten(2).transpose(1, 2)
         class_embeds = self.class_embedding.expand(batch_size, 1, -1).to(target_dtype)
         embeddings = torch.cat([class_embeds, patch_embeds], dim=1)
-        position_embedding = torch.cat([
-            self.position_embedding[:, :1, :],
-            self._get_pos_embed(self.position_embedding[:, 1:, :], height, width)
-        ], dim=1)
-        embeddings = embeddings + position_embedding.to(target_dtype)
+        embeddings = embeddings + self._get_position_embedding(height, width, target_dtype)
         return embeddings
 
+    def _get_position_embedding(self, H, W, dtype):
+        pos_embed = self.position_embedding
+        # 需要对position_embedding求梯度时不能复用之前的计算图
+        use_cache = not (torch.is_grad_enabled() and pos_embed.requires_grad)
+        key = (H, W, dtype, pos_embed.device)
+        version = (id(pos_embed), pos_embed.data_ptr(), pos_embed._version)
+        if use_cache:
+            cached = self._pos_embed_cache.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        position_embedding = torch.cat([
+            pos_embed[:, :1, :],
+            self._get_pos_embed(pos_embed[:, 1:, :], H, W)
+        ], dim=1).to(dtype)
+        if use_cache:
+            if key not in self._pos_embed_cache and len(self._pos_embed_cache) >= self._pos_embed_cache_size:
+                self._pos_embed_cache.pop(next(iter(self._pos_embed_cache)))
+            self._pos_embed_cache[key] = (version, position_embedding)
+        return position_embedding
+
 
 class InternAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
@@ -118,6 +143,8 @@ class InternAttention(nn.Module):
         self.use_flash_attn = config.use_flash_attn and has_flash_attn
         if config.use_flash_attn and not has_flash_attn:
             print('Warning: Flash Attention is not available, use_flash_attn is set to False.')
+        # 没有flash attention时用SDPA，不显式构造B×H×N×N的attention矩阵
+        self.use_sdpa = has_sdpa
         self.head_dim = self.embed_dim // self.num_heads
         if self.head_dim * self.num_heads != self.embed_dim:
             raise ValueError(
@@ -159,6 +186,23 @@ class InternAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def _sdpa_attn(self, x):
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)
+
+        if self.qk_normalization:
+            B_, H_, N_, D_ = q.shape
+            q = self.q_norm(q.transpose(1, 2).flatten(-2, -1)).view(B_, N_, H_, D_).transpose(1, 2)
+            k = self.k_norm(k.transpose(1, 2).flatten(-2, -1)).view(B_, N_, H_, D_).transpose(1, 2)
+
+        x = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
     def _flash_attn(self, x, key_padding_mask=None, need_weights=False):
         qkv = self.qkv(x)
         qkv = rearrange(qkv, 'b s (three h d) -> b s three h d', three=3, h=self.num_heads)
@@ -177,8 +221,11 @@ class InternAttention(nn.Module):
         return outs
 
     def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
-        x = self._naive_attn(hidden_states) if not self.use_flash_attn else self._flash_attn(hidden_states)
-        return x
+        if self.use_flash_attn:
+            return self._flash_attn(hidden_states)
+        if self.use_sdpa:
+            return self._sdpa_attn(hidden_states)
+        return self._naive_attn(hidden_states)
 
 
 class InternMLP(nn.Module):
@@ -252,6 +299,7 @@ class InternVisionEncoder(nn.Module):
             inputs_embeds,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
+            num_layers: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutput]:
         r"""
         Args:
@@ -262,6 +310,8 @@ class InternVisionEncoder(nn.Module):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+            num_layers (`int`, *optional*):
+                Only run the first `num_layers` layers (early exit), all layers if None.
         """
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -271,7 +321,8 @@ class InternVisionEncoder(nn.Module):
         encoder_states = () if output_hidden_states else None
         hidden_states = inputs_embeds
 
-        for idx, encoder_layer in enumerate(self.layers):
+        layers = self.layers if num_layers is None else self.layers[:num_layers]
+        for idx, encoder_layer in enumerate(layers):
             if output_hidden_states:
                 encoder_states = encoder_states + (hidden_states,)
             if self.gradient_checkpointing and self.training:
@@ -316,6 +367,7 @@ class InternVisionModel(PreTrainedModel):
         pos_emb = torch.cat([cls_emb, pos_emb], dim=1)
         self.embeddings.position_embedding = nn.Parameter(pos_emb)
         self.embeddings.image_size = new_size
+        self.embeddings.clear_pos_embed_cache()
         logger.info('Resized position embeddings from {} to {}'.format(old_size, new_size))
 
     def get_input_embeddings(self):
@@ -327,6 +379,7 @@ class InternVisionModel(PreTrainedModel):
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
             pixel_embeds: Optional[torch.FloatTensor] = None,
+            num_layers: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPooling]:
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -347,6 +400,7 @@ class InternVisionModel(PreTrainedModel):
             inputs_embeds=hidden_states,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            num_layers=num_layers,
         )
         last_hidden_state = encoder_outputs.last_hidden_state
         pooled_output = last_hidden_state[:, 0, :]
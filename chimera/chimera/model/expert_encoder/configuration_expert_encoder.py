@@ -67,6 +67,9 @@ class ExpertEncoderConfig(PretrainedConfig):
             ]
         llm_hidden_size (`int`, defaults to 4096):
             hidden state dim of the llm.
+        packed_patches (`bool`, defaults to False):
+            run the pix2struct & Kosmos encoders on the real patches only (packed along `cu_seqlens`), instead of all
+            the `max_patches` padded positions.
     """
 
     model_type = 'expert_encoder'
@@ -76,6 +79,7 @@ class ExpertEncoderConfig(PretrainedConfig):
             # encoder_config_dicts: List[Dict] = [],
             config_list: List[Dict] = [],
             llm_hidden_size = 4096,
+            packed_patches = False,
             **kwargs,
     ):
         super().__init__(**kwargs)
@@ -86,6 +90,8 @@ class ExpertEncoderConfig(PretrainedConfig):
                 f"No encoder is added into the ExpertEncoder."
             )
         self.llm_hidden_size = llm_hidden_size
+        # pix2struct & Kosmos编码器只计算真实patch，padding位置的输出由每张图一个padding token给出
+        self.packed_patches = packed_patches
         
         self.config_list = config_list
         
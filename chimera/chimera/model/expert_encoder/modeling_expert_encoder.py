@@ -5,7 +5,7 @@ from transformers.utils import logging
 from transformers import Pix2StructVisionModel
 from transformers import CLIPVisionModel
 from chimera.model.chimera import InternVisionModel
-from chimera.model.kosmos2_5.modeling_kosmos2_5 import Kosmos2_5VisionModel
+from chimera.model.kosmos2_5.modeling_kosmos2_5 import Kosmos2_5VisionModel, pack_flattened_patches, packed_vision_forward
 from chimera.model.got import GotVisionConfig, GoTVisionModel, GOTImageProcessor
 
 import torch
@@ -134,7 +134,15 @@ class ExpertEncoder(PreTrainedModel):
             encoder_domain = None,
             pixel_values: Optional[torch.FloatTensor] = None,
             attention_mask: Optional[torch.Tensor] = None,
+            cu_seqlens: Optional[torch.Tensor] = None,
+            max_patches: Optional[int] = None,
     ):
+        r"""
+        For the pix2struct & Kosmos encoders, `pixel_values` is either the (B,L,D) padded patches, or the (T,D) real
+        patches packed along `cu_seqlens` (see `Kosmos2_5ImageProcessor.preprocess(packed=True)`). Packed inputs give
+        the (T,C) features of the real patches, or the (B,max_patches,C) padded features when `max_patches` is given.
+        With `config.packed_patches`, padded inputs are packed here and the padded features are restored.
+        """
 
         uni_encoder, mlp, select_layer = self.get_uni_encoder(encoder_domain,encoder_index)
         encoder_type = uni_encoder.config.model_type
@@ -153,7 +161,21 @@ class ExpertEncoder(PreTrainedModel):
                     return_dict=True).hidden_states[select_layer]
             visual_feature = visual_feature[:, 1:, :]
                 
-        if encoder_type in ('pix2struct_vision_model', "kosmos_2_5_vision_model"):
+        if encoder_type in ('pix2struct_vision_model', "kosmos_2_5_vision_model") and \
+                (cu_seqlens is not None or getattr(self.config, 'packed_patches', False)):
+            if cu_seqlens is None:
+                assert pixel_values.dim()==3, f"Input shape for pix2struct model should be (B,L,D), but got {pixel_values.shape}."
+                max_patches = pixel_values.shape[1]
+                pixel_values, cu_seqlens = pack_flattened_patches(pixel_values, attention_mask)
+            assert pixel_values.dim()==2, f"Packed input for pix2struct model should be (T,D), but got {pixel_values.shape}."
+            outputs = packed_vision_forward(
+                uni_encoder, pixel_values, cu_seqlens,
+                max_patches = max_patches,
+                output_hidden_states = select_layer != -1,
+                )
+            visual_feature = outputs.last_hidden_state if select_layer == -1 else outputs.hidden_states[select_layer]
+
+        elif encoder_type in ('pix2struct_vision_model', "kosmos_2_5_vision_model"):
             assert pixel_values.dim()==3, f"Input shape for pix2struct model should be (B,L,D), but got {pixel_values.shape}."
             if select_layer == -1:
                 visual_feature = uni_encoder(
@@ -178,11 +200,12 @@ class ExpertEncoder(PreTrainedModel):
        
         return visual_feature
     
-    # 调用所有的编码器对所有图片进行编码，用于训练，后续过程选择性取出每个图片对应的特征
+    # 训练时按路由标签只对每个domain的图片调用对应的编码器
     def forward(
             self,
             pixel_value_list: List[torch.FloatTensor] = None,
             attention_mask_list: List[torch.FloatTensor] = None,
+            domain_ids: Optional[torch.LongTensor] = None,
     ):
         r"""
         Args:
@@ -195,26 +218,44 @@ class ExpertEncoder(PreTrainedModel):
                 A list of tensor that specially prepared for pix2struct & Kosmos encoder input.
                 length: self.num_encoder
                 element of attention_mask is tensor of size or (B,L,D), the index of each element should match the encoder index of model, only the elements corresponding to pix2struct & Kosmos encoder is not None
+            domain_ids (`torch.LongTensor`, *optional*):
+                Encoder index of every image, of size (B,), -1 for images without domain. When given, encoder i (and its
+                mlp) only runs on the images with `domain_ids == i`, in their original order, and returns None when no
+                image is assigned to it. Otherwise every encoder encodes every image.
         """
         
         assert len(pixel_value_list)==self.num_encoder, f"Mismatched images, model has {self.num_encoder} encoder, but got {len(pixel_value_list)} images."
         
         res = []
 
+        if domain_ids is None:
+            for i, cur_pixel_value in enumerate(pixel_value_list):
+                cur_attention_mask = attention_mask_list[i]
+                cur_visual_feature = self.uni_encode(
+                                                    encoder_index = i,
+                                                    pixel_values = cur_pixel_value,
+                                                    attention_mask = cur_attention_mask,
+                                                    )
+                res.append(cur_visual_feature)
+            return res
+
+        # 稳定排序后每个domain的图片连续且保持原顺序，只需要一次同步取每个domain的图片数
+        order = torch.sort(domain_ids, stable=True).indices
+        counts = torch.bincount(domain_ids + 1, minlength=self.num_encoder + 1).tolist()
+        start = counts[0]
         for i, cur_pixel_value in enumerate(pixel_value_list):
+            num = counts[i + 1]
+            if num == 0:
+                res.append(None)
+                continue
+            cur_index = order[start:start + num].to(cur_pixel_value.device)
+            start += num
             cur_attention_mask = attention_mask_list[i]
             cur_visual_feature = self.uni_encode(
                                                 encoder_index = i,
-                                                pixel_values = cur_pixel_value,
-                                                attention_mask = cur_attention_mask,
+                                                pixel_values = cur_pixel_value.index_select(0, cur_index),
+                                                attention_mask = cur_attention_mask.index_select(0, cur_index) if cur_attention_mask is not None else None,
                                                 )
             res.append(cur_visual_feature)
-      
 
         return res
-
-
-
-    
-
-    
\ No newline at end of file
@@ -29,6 +29,7 @@ class GotVisionConfig(PretrainedConfig):
             window_size: int = 0,
             global_attn_indexes: Tuple[int, ...] = (),
             hidden_size = 1024,
+            attn_query_chunk_size: int = 1024,
             **kwargs,
         ):
        
@@ -49,6 +50,8 @@ class GotVisionConfig(PretrainedConfig):
         self.window_size = window_size
         self.global_attn_indexes = global_attn_indexes
         self.hidden_size = hidden_size
+        # 全局attention按query分块计算，每块最多attn_query_chunk_size个token(<=0不分块)
+        self.attn_query_chunk_size = attn_query_chunk_size
 
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path: Union[str, os.PathLike], **kwargs) -> 'PretrainedConfig':
@@ -68,6 +68,7 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        query_chunk_size: int = 0,
     ) -> None:
         """
         Args:
@@ -83,6 +84,7 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            query_chunk_size (int): Maximum number of queries attended at once, <= 0 for no limit.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -93,6 +95,7 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            query_chunk_size=query_chunk_size,
         )
 
         self.norm2 = norm_layer(dim)
@@ -130,6 +133,7 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        query_chunk_size: int = 0,
     ) -> None:
         """
         Args:
@@ -140,6 +144,7 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            query_chunk_size (int): Maximum number of queries attended at once, <= 0 for no limit.
         """
         super().__init__()
         self.num_heads = num_heads
@@ -157,11 +162,17 @@ class Attention(nn.Module):
             # initialize relative positional embeddings
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
+        # SDPA不构造softmax前后的attention矩阵，相对位置编码作为additive attn_mask传入
+        self.use_sdpa = hasattr(F, "scaled_dot_product_attention")
+        # 全局block的attention矩阵(及相对位置偏置)是(H·W)²，按query行分块后峰值显存只与块大小成正比
+        self.query_chunk_size = query_chunk_size
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
         qkv = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        if self.use_sdpa or 0 < self.query_chunk_size < H * W:
+            return self._chunked_attn(qkv, B, H, W)
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
@@ -176,6 +187,44 @@ class Attention(nn.Module):
 
         return x
 
+    def _chunked_attn(self, qkv: torch.Tensor, B: int, H: int, W: int) -> torch.Tensor:
+        """
+        Attention over tiles of whole query rows holding at most `query_chunk_size` queries, the relative position
+        bias is only built for the queries of the current tile.
+        """
+        # q, k, v with shape (B, nHead, H * W, C)
+        q, k, v = qkv.unbind(0)
+        rows = H
+        if 0 < self.query_chunk_size < H * W:
+            rows = max(self.query_chunk_size // W, 1)
+        if self.use_rel_pos:
+            Rh = get_rel_pos(H, H, self.rel_pos_h).to(q.dtype)
+            Rw = get_rel_pos(W, W, self.rel_pos_w).to(q.dtype)
+
+        outputs = []
+        for start in range(0, H, rows):
+            end = min(start + rows, H)
+            q_tile = q[:, :, start * W:end * W]
+            attn_mask = None
+            if self.use_rel_pos:
+                attn_mask = decomposed_rel_pos_bias(
+                    q_tile.reshape(B * self.num_heads, end - start, W, -1), Rh[start:end], Rw)
+                attn_mask = attn_mask.view(B, self.num_heads, (end - start) * W, H * W)
+            if self.use_sdpa:
+                # 相对位置编码作为additive attn_mask传入
+                outputs.append(F.scaled_dot_product_attention(q_tile, k, v, attn_mask=attn_mask))
+            else:
+                attn = (q_tile * self.scale) @ k.transpose(-2, -1)
+                if attn_mask is not None:
+                    attn = attn + attn_mask
+                outputs.append(attn.softmax(dim=-1) @ v)
+
+        x = torch.cat(outputs, dim=2) if len(outputs) > 1 else outputs[0]
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = self.proj(x)
+
+        return x
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -296,6 +345,26 @@ def add_decomposed_rel_pos(
     return attn
 
 
+def decomposed_rel_pos_bias(r_q: torch.Tensor, Rh: torch.Tensor, Rw: torch.Tensor) -> torch.Tensor:
+    """
+    The term `add_decomposed_rel_pos` adds to the attention map, as an additive mask for
+    scaled_dot_product_attention.
+    Args:
+        r_q (Tensor): query q in the attention layer with shape (B, q_h, q_w, C).
+        Rh (Tensor): relative position embeddings (q_h, k_h, C) of the query rows, see `get_rel_pos`.
+        Rw (Tensor): relative position embeddings (q_w, k_w, C) of the query columns.
+
+    Returns:
+        bias (Tensor): relative position bias with shape (B, q_h * q_w, k_h * k_w).
+    """
+    B, q_h, q_w, _ = r_q.shape
+    k_h, k_w = Rh.shape[1], Rw.shape[1]
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+
+    return (rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]).reshape(B, q_h * q_w, k_h * k_w)
+
+
 class PatchEmbed(nn.Module):
     """
     Image to Patch Embedding.
@@ -443,6 +512,7 @@ class GoTVisionModel(PreTrainedModel):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                query_chunk_size=getattr(config, 'attn_query_chunk_size', 0),
             )
             self.blocks.append(block)
 
@@ -24,6 +24,7 @@ import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
 from einops import rearrange
+from packaging import version
 from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 from transformers.activations import ACT2FN
@@ -40,40 +41,53 @@ try:
 except:  # noqa # pylint: disable=bare-except
     BaseStreamer = None
 
+from chimera.paged_kv_cache import PagedKVCache, PagedLayerCache
+from chimera.sequence_packing import get_max_seqlen, packed_causal_mask
+from chimera.static_kv_cache import StaticKVCache, StaticLayerCache
+
 from .configuration_internlm2 import InternLM2Config
 
 logger = logging.get_logger(__name__)
 
 _CONFIG_FOR_DOC = 'InternLM2Config'
 
-flash_attn_func, flash_attn_varlen_func = None, None
+flash_attn_func, flash_attn_varlen_func, flash_attn_with_kvcache = None, None, None
 pad_input, index_first_axis, unpad_input = None, None, None
 try:
     from flash_attn import flash_attn_func as _flash_attn_func
     from flash_attn import flash_attn_varlen_func as _flash_attn_varlen_func
+    from flash_attn import flash_attn_with_kvcache as _flash_attn_with_kvcache
     from flash_attn.bert_padding import index_first_axis as _index_first_axis
     from flash_attn.bert_padding import pad_input as _pad_input
     from flash_attn.bert_padding import unpad_input as _unpad_input
 
     flash_attn_func, flash_attn_varlen_func = _flash_attn_func, _flash_attn_varlen_func
+    flash_attn_with_kvcache = _flash_attn_with_kvcache
     pad_input, index_first_axis, unpad_input = _pad_input, _index_first_axis, _unpad_input
     has_flash_attn = True
 except:
     has_flash_attn = False
 
 
+# torch>=2.5的scaled_dot_product_attention可以直接按组广播k/v
+_sdpa_supports_gqa = version.parse(torch.__version__.split('+')[0]) >= version.parse('2.5')
+
+
 def _import_flash_attn():
-    global flash_attn_func, flash_attn_varlen_func
+    global flash_attn_func, flash_attn_varlen_func, flash_attn_with_kvcache
     global pad_input, index_first_axis, unpad_input
     try:
         from flash_attn import flash_attn_func as _flash_attn_func
         from flash_attn import \
             flash_attn_varlen_func as _flash_attn_varlen_func
+        from flash_attn import \
+            flash_attn_with_kvcache as _flash_attn_with_kvcache
         from flash_attn.bert_padding import \
             index_first_axis as _index_first_axis
         from flash_attn.bert_padding import pad_input as _pad_input
         from flash_attn.bert_padding import unpad_input as _unpad_input
         flash_attn_func, flash_attn_varlen_func = _flash_attn_func, _flash_attn_varlen_func
+        flash_attn_with_kvcache = _flash_attn_with_kvcache
         pad_input, index_first_axis, unpad_input = _pad_input, _index_first_axis, _unpad_input
     except ImportError:
         raise ImportError('flash_attn is not installed.')
@@ -389,17 +403,23 @@ class InternLM2Attention(nn.Module):
         value_states = value_states.transpose(1, 2)
 
         kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
+        if isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            kv_seq_len = past_key_value.get_kv_length(kv_seq_len)
+        elif past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            # 分页/静态cache：新的k/v原地写入，取回本次forward所需的完整k/v
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            past_key_value = (key_states, value_states) if use_cache else None
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -491,26 +511,45 @@ class InternLM2FlashAttention2(InternLM2Attention):
         value_states = value_states.transpose(1, 2)
 
         kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
+        if isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            kv_seq_len = past_key_value.get_kv_length(kv_seq_len)
+        elif past_key_value is not None:
             kv_seq_len += past_key_value[0].shape[-2]
 
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
+        use_block_table = isinstance(past_key_value, PagedLayerCache) and past_key_value.cache.supports_block_table
+        if use_block_table:
+            # 分页cache：新的k/v原地写入，flash attention按block table直接读取各block，不gather
+            past_key_value.write(key_states, value_states)
+        elif isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            # 分页/静态cache：新的k/v原地写入，取回本次forward所需的完整k/v
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            past_key_value = (key_states, value_states) if use_cache else None
 
         query_states = query_states.transpose(1, 2)
         key_states = key_states.transpose(1, 2)
         value_states = value_states.transpose(1, 2)
 
+        cache_kwargs = {}
+        if use_block_table:
+            key_states, value_states = past_key_value.get_blocks()
+            cache_kwargs = dict(
+                cache_seqlens=past_key_value.cache.cache_seqlens, block_table=past_key_value.cache.block_table)
+        elif isinstance(past_key_value, StaticLayerCache):
+            # 静态cache：key/value是整个buffer，按已写入长度读取，形状不随decode步数变化
+            cache_kwargs = dict(cache_seqlens=past_key_value.cache.seq_lens)
         attn_output = self._flash_attention_forward(
-            query_states, key_states, value_states, attention_mask, q_len
+            query_states, key_states, value_states, attention_mask, q_len,
+            cu_seqlens=kwargs.get('cu_seqlens'), max_seqlen=kwargs.get('max_seqlen'), **cache_kwargs,
         )
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
         attn_output = self.wo(attn_output)
@@ -521,7 +560,8 @@ class InternLM2FlashAttention2(InternLM2Attention):
         return attn_output, attn_weights, past_key_value
 
     def _flash_attention_forward(
-        self, query_states, key_states, value_states, attention_mask, query_length, dropout=0.0, softmax_scale=None
+        self, query_states, key_states, value_states, attention_mask, query_length, dropout=0.0, softmax_scale=None,
+        cu_seqlens=None, max_seqlen=None, cache_seqlens=None, block_table=None,
     ):
         """
         Calls the forward method of Flash Attention - if the input hidden states contain at least one padding token
@@ -541,10 +581,41 @@ class InternLM2FlashAttention2(InternLM2Attention):
                 Attention dropout
             softmax_scale (`float`, *optional*):
                 The scaling of QK^T before applying softmax. Default to 1 / sqrt(head_dim)
+            cu_seqlens (`torch.Tensor`, *optional*):
+                Boundaries of the packed samples over the flattened (batch_size * seq_len) tokens, see
+                `chimera.sequence_packing`; `max_seqlen` is the longest of them.
+            cache_seqlens (`torch.Tensor`, *optional*):
+                (batch_size,) int32 filled lengths of the (batch_size, max_length) key/value buffers of a
+                `StaticKVCache`; the queries are the last `query_length` filled positions.
+            block_table (`torch.Tensor`, *optional*):
+                (batch_size, max_blocks) int32 blocks of every sequence when the keys/values are the
+                (num_blocks, block_size) blocks of a `PagedKVCache`; `cache_seqlens` are then the sequence lengths and
+                `attention_mask` is not used.
         """
         # Contains at least one padding token in the sequence
         causal = self.is_causal and query_length != 1
-        if attention_mask is not None:
+        if cache_seqlens is not None:
+            attn_output = flash_attn_with_kvcache(
+                query_states, key_states, value_states,
+                cache_seqlens=cache_seqlens, block_table=block_table, softmax_scale=softmax_scale, causal=self.is_causal,
+            )
+        elif cu_seqlens is not None:
+            # 打包训练：所有行展平后按样本边界做varlen attention
+            batch_size = query_states.shape[0]
+            attn_output = flash_attn_varlen_func(
+                query_states.reshape(-1, *query_states.shape[2:]),
+                key_states.reshape(-1, *key_states.shape[2:]),
+                value_states.reshape(-1, *value_states.shape[2:]),
+                cu_seqlens_q=cu_seqlens,
+                cu_seqlens_k=cu_seqlens,
+                max_seqlen_q=max_seqlen,
+                max_seqlen_k=max_seqlen,
+                dropout_p=dropout,
+                softmax_scale=softmax_scale,
+                causal=causal,
+            )
+            attn_output = attn_output.view(batch_size, query_length, *attn_output.shape[1:])
+        elif attention_mask is not None:
             batch_size = query_states.shape[0]
             query_states, key_states, value_states, indices_q, cu_seq_lens, max_seq_lens = self._unpad_input(
                 query_states, key_states, value_states, attention_mask, query_length
@@ -614,9 +685,124 @@ class InternLM2FlashAttention2(InternLM2Attention):
         )
 
 
+class InternLM2SdpaAttention(InternLM2Attention):
+    """
+    InternLM2 attention module using torch.nn.functional.scaled_dot_product_attention. This module inherits from
+    `InternLM2Attention` as the weights of the module stays untouched. The attention weights are never materialized,
+    unpadded inputs use `is_causal` instead of a 4D mask, and the key/value heads are broadcast to their query groups
+    instead of being copied by `repeat_kv` where possible.
+    """
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        output_attentions: bool = False,
+        use_cache: bool = False,
+        **kwargs,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if output_attentions:
+            logger.warning_once(
+                'InternLM2Model is using InternLM2SdpaAttention, but `torch.nn.functional.scaled_dot_product_attention` '
+                'does not support `output_attentions=True`. Falling back to the eager attention implementation.'
+            )
+            return super().forward(
+                hidden_states=hidden_states,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_value=past_key_value,
+                output_attentions=output_attentions,
+                use_cache=use_cache,
+                **kwargs,
+            )
+
+        bsz, q_len, _ = hidden_states.size()
+
+        qkv_states = self.wqkv(hidden_states)
+
+        qkv_states = rearrange(
+            qkv_states,
+            'b q (h gs d) -> b q h gs d',
+            gs=2 + self.num_key_value_groups,
+            d=self.head_dim,
+        )
+
+        query_states = qkv_states[..., : self.num_key_value_groups, :]
+        query_states = rearrange(query_states, 'b q h gs d -> b q (h gs) d')
+        key_states = qkv_states[..., -2, :]
+        value_states = qkv_states[..., -1, :]
+
+        query_states = query_states.transpose(1, 2)
+        key_states = key_states.transpose(1, 2)
+        value_states = value_states.transpose(1, 2)
+
+        kv_seq_len = key_states.shape[-2]
+        if isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            kv_seq_len = past_key_value.get_kv_length(kv_seq_len)
+        elif past_key_value is not None:
+            kv_seq_len += past_key_value[0].shape[-2]
+        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
+
+        if isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        elif past_key_value is not None:
+            # reuse k, v, self_attention
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+        if not isinstance(past_key_value, (PagedLayerCache, StaticLayerCache)):
+            past_key_value = (key_states, value_states) if use_cache else None
+
+        if attention_mask is not None and attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+            raise ValueError(
+                f'Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}'
+            )
+
+        attn_kwargs = dict()
+        num_groups = self.num_key_value_groups
+        if num_groups > 1 and q_len == 1:
+            # decode：一个kv头对应的num_groups个query头当作num_groups个query位置，k/v不复制；
+            # (B, 1, 1, kv)的mask在这些位置上直接广播
+            query_states = query_states.view(bsz, self.num_key_value_heads, num_groups, self.head_dim)
+        elif num_groups > 1 and _sdpa_supports_gqa:
+            attn_kwargs['enable_gqa'] = True
+        else:
+            key_states = repeat_kv(key_states, num_groups)
+            value_states = repeat_kv(value_states, num_groups)
+
+        # SDPA with memory-efficient backend is bugged with non-contiguous inputs with custom attn_mask,
+        # Reference: https://github.com/pytorch/pytorch/issues/112577.
+        if query_states.device.type == 'cuda' and attention_mask is not None:
+            query_states = query_states.contiguous()
+            key_states = key_states.contiguous()
+            value_states = value_states.contiguous()
+
+        attn_output = F.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            # InternLM2Model只在没有padding、没有past时传入None的mask
+            is_causal=self.is_causal and attention_mask is None and q_len > 1,
+            **attn_kwargs,
+        )
+
+        attn_output = attn_output.reshape(bsz, self.num_heads, q_len, self.head_dim)
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+
+        attn_output = self.wo(attn_output)
+
+        return attn_output, None, past_key_value
+
+
 INTERNLM2_ATTENTION_CLASSES = {
     'eager': InternLM2Attention,
     'flash_attention_2': InternLM2FlashAttention2,
+    'sdpa': InternLM2SdpaAttention,
 }
 
 
@@ -822,9 +1008,9 @@ class InternLM2Model(InternLM2PreTrainedModel):
         self.padding_idx = config.pad_token_id
         self.vocab_size = config.vocab_size
         self.config = config
-        if not has_flash_attn:
-            self.config.attn_implementation = 'eager'
-            print('Warning: Flash attention is not available, using eager attention instead.')
+        if self.config.attn_implementation == 'flash_attention_2' and not has_flash_attn:
+            self.config.attn_implementation = 'sdpa'
+            print('Warning: Flash attention is not available, using sdpa attention instead.')
 
         self.tok_embeddings = nn.Embedding(config.vocab_size, config.hidden_size, self.padding_idx)
 
@@ -876,7 +1062,15 @@ class InternLM2Model(InternLM2PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cache_position: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
+        r"""
+        cu_seqlens (`torch.Tensor`, *optional*):
+            Boundaries of the samples packed into the rows, over the flattened (batch_size * seq_len) tokens (see
+            `chimera.sequence_packing`). Attention stays inside every sample; `position_ids` should restart at every
+            sample. Training only, without cache.
+        """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -900,7 +1094,18 @@ class InternLM2Model(InternLM2PreTrainedModel):
 
         seq_length_with_past = seq_length
         past_key_values_length = 0
-        if past_key_values is not None:
+        if isinstance(past_key_values, StaticKVCache):
+            # 静态cache：新token写在cache_position处，batch内的序列不做padding
+            if cache_position is None:
+                assert position_ids is not None, 'a StaticKVCache needs `cache_position` or `position_ids`'
+                cache_position = position_ids[0]
+            past_key_values.cache_position = cache_position
+            if position_ids is None:
+                position_ids = cache_position[None].expand(batch_size, -1)
+        elif isinstance(past_key_values, PagedKVCache):
+            past_key_values_length = past_key_values.get_usable_length(seq_length)
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_values is not None:
             past_key_values_length = past_key_values[0][0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
 
@@ -914,9 +1119,30 @@ class InternLM2Model(InternLM2PreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.tok_embeddings(input_ids)
 
-        if self.config.attn_implementation == 'flash_attention_2':
+        packed_kwargs = {}
+        if cu_seqlens is not None:
+            assert past_key_values is None, 'packed sequences do not support past_key_values'
+            # 打包训练：flash attention直接用cu_seqlens，其余实现用块对角的因果mask
+            if self.config.attn_implementation == 'flash_attention_2':
+                packed_kwargs = dict(
+                    cu_seqlens=cu_seqlens.to(inputs_embeds.device, torch.int32), max_seqlen=get_max_seqlen(cu_seqlens))
+                attention_mask = None
+            else:
+                attention_mask = packed_causal_mask(
+                    cu_seqlens, batch_size, seq_length, inputs_embeds.dtype, inputs_embeds.device)
+        elif isinstance(past_key_values, StaticKVCache):
+            # 因果关系只由cache_position决定：flash attention按cache的seq_lens读取，eager用固定形状的mask
+            if self.config.attn_implementation == 'flash_attention_2':
+                attention_mask = None
+            else:
+                attention_mask = past_key_values.causal_mask(cache_position, inputs_embeds.dtype)
+        elif self.config.attn_implementation == 'flash_attention_2':
             # 2d mask is passed through the layers
             attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
+        elif self.config.attn_implementation == 'sdpa' and (seq_length == 1 or past_key_values_length == 0) and (
+                attention_mask is None or 0 not in attention_mask):
+            # 没有padding时sdpa用is_causal(decode时不需要mask)，不构造4D mask
+            attention_mask = None
         else:
             if attention_mask is None:
                 attention_mask = torch.ones(
@@ -952,7 +1178,7 @@ class InternLM2Model(InternLM2PreTrainedModel):
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
                         # None for past_key_value
-                        return module(*inputs, output_attentions, None)
+                        return module(*inputs, output_attentions, None, **packed_kwargs)
 
                     return custom_forward
 
@@ -971,6 +1197,7 @@ class InternLM2Model(InternLM2PreTrainedModel):
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    **packed_kwargs,
                 )
 
             hidden_states = layer_outputs[0]
@@ -988,6 +1215,8 @@ class InternLM2Model(InternLM2PreTrainedModel):
             all_hidden_states += (hidden_states,)
 
         next_cache = next_decoder_cache if use_cache else None
+        if use_cache and isinstance(past_key_values, (PagedKVCache, StaticKVCache)):
+            next_cache = past_key_values
         if not return_dict:
             return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
         return BaseModelOutputWithPast(
@@ -1045,6 +1274,8 @@ class InternLM2ForCausalLM(InternLM2PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cache_position: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1089,6 +1320,8 @@ class InternLM2ForCausalLM(InternLM2PreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            cache_position=cache_position,
+            cu_seqlens=cu_seqlens,
         )
 
         hidden_states = outputs[0]
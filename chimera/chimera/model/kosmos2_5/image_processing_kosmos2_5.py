@@ -255,6 +255,7 @@ class Kosmos2_5ImageProcessor(BaseImageProcessor):
         return_tensors: Optional[Union[str, TensorType]] = None,
         data_format: ChannelDimension = ChannelDimension.FIRST,
         input_data_format: Optional[Union[str, ChannelDimension]] = None,
+        packed: bool = False,
         **kwargs,
     ) -> ImageInput:
         """
@@ -294,6 +295,9 @@ class Kosmos2_5ImageProcessor(BaseImageProcessor):
                 - `"channels_first"` or `ChannelDimension.FIRST`: image in (num_channels, height, width) format.
                 - `"channels_last"` or `ChannelDimension.LAST`: image in (height, width, num_channels) format.
                 - `"none"` or `ChannelDimension.NONE`: image in (height, width) format.
+            packed (`bool`, *optional*, defaults to `False`):
+                Return the (T, D) real patches of all the images concatenated, with the (B + 1) `cu_seqlens` instead of
+                the `attention_mask`, for the packed forward of the vision model.
         """
         do_normalize = do_normalize if do_normalize is not None else self.do_normalize
         do_convert_rgb = do_convert_rgb if do_convert_rgb is not None else self.do_convert_rgb
@@ -341,6 +345,21 @@ class Kosmos2_5ImageProcessor(BaseImageProcessor):
         # create attention mask in numpy
         attention_masks = [(image.sum(axis=-1) != 0).astype(np.float32) for image in images]
 
+        if packed:
+            # 只保留真实patch并拼接，第i张图占[cu_seqlens[i], cu_seqlens[i + 1])
+            lengths = [int(mask.sum()) for mask in attention_masks]
+            return BatchFeature(
+                data={
+                    "flattened_patches": np.concatenate([image[mask != 0] for image, mask in zip(images, attention_masks)]),
+                    "cu_seqlens": np.cumsum([0] + lengths).astype(np.int32),
+                    "width": width,
+                    "height": height,
+                    "rows": rows,
+                    "cols": cols,
+                },
+                tensor_type=return_tensors,
+            )
+
         encoded_outputs = BatchFeature(
             data={
                 "flattened_patches": images,
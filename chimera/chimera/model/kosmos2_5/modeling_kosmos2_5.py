@@ -69,6 +69,11 @@ from .configuration_kosmos2_5 import (
 
 logger = logging.get_logger(__name__)
 
+try:
+    from flash_attn import flash_attn_varlen_func
+except ImportError:
+    flash_attn_varlen_func = None
+
 _CONFIG_FOR_DOC = Kosmos2_5Config
 
 
@@ -766,14 +771,13 @@ class Kosmos2_5VisionLayer(nn.Module):
         # in  Kosmos2_5Vision, layernorm is applied before self-attention
         hidden_states = self.pre_attention_layer_norm(hidden_states)
         attention_mask = self._prepare_attention_mask(attention_mask, hidden_states.shape[:2], hidden_states)
-        self_attention_outputs, _ = self.attention(
+        attention_output, attn_weights = self.attention(
             hidden_states,
             attention_mask=attention_mask,
             layer_head_mask=head_mask,
             output_attentions=output_attentions,
         )
-        attention_output = self_attention_outputs[0]
-        outputs = self_attention_outputs[1:]  # add self attentions if we output attention weights
+        # attention返回(attn_output, attn_weights)，不能再取[0](会把第一张图的输出广播给整个batch)
 
         # first residual connection
         hidden_states = attention_output + residual
@@ -781,7 +785,7 @@ class Kosmos2_5VisionLayer(nn.Module):
         # in  Kosmos2_5Vision, layernorm is also applied after self-attention
         layer_output = self.pre_mlp_layer_norm(hidden_states)
         layer_output = self.mlp(layer_output) + hidden_states  # second residual connection
-        return layer_output, outputs
+        return layer_output, attn_weights
 
 
 # Copied from transformers.models.pix2struct.modeling_pix2struct.Pix2StructVisionEncoder with Pix2Struct->Kosmos2_5
@@ -838,6 +842,120 @@ class Kosmos2_5VisionEncoder(nn.Module):
         )
 
 
+def pack_flattened_patches(flattened_patches: torch.Tensor, attention_mask: Optional[torch.Tensor] = None):
+    """
+    Drop the padding of (B, max_patches, D) processor outputs. Returns the (T, D) real patches of all the images and the
+    (B + 1) int32 `cu_seqlens` (image i owns rows `cu_seqlens[i]:cu_seqlens[i + 1]`).
+    """
+    if attention_mask is None:
+        attention_mask = flattened_patches.sum(dim=-1) != 0
+    attention_mask = attention_mask.bool()
+    lengths = attention_mask.sum(dim=-1)
+    cu_seqlens = nn.functional.pad(lengths.cumsum(0, dtype=torch.int32), (1, 0))
+    return flattened_patches[attention_mask], cu_seqlens
+
+
+def _packed_attention(attention, hidden_states, key_index, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, bounds):
+    """
+    Self-attention of a packed sequence: the queries of image i are rows `cu_seqlens_q[i]:cu_seqlens_q[i + 1]`, its
+    keys/values the rows `key_index[cu_seqlens_k[i]:cu_seqlens_k[i + 1]]`. `bounds` holds `cu_seqlens_q` and
+    `cu_seqlens_k` as python lists for the SDPA fallback.
+    """
+    num_heads, head_dim = attention.n_heads, attention.key_value_proj_dim
+    key_states = hidden_states.index_select(0, key_index)
+    query_states = attention.query(hidden_states).view(-1, num_heads, head_dim)
+    value_states = attention.value(key_states).view(-1, num_heads, head_dim)
+    key_states = attention.key(key_states).view(-1, num_heads, head_dim)
+    dropout = attention.dropout if attention.training else 0.0
+    # Kosmos-2.5按1/sqrt(d)缩放；Pix2Struct沿用T5，不缩放
+    softmax_scale = None if isinstance(attention, Kosmos2_5VisionAttention) else 1.0
+
+    if flash_attn_varlen_func is not None and hidden_states.is_cuda and hidden_states.dtype in (torch.float16, torch.bfloat16):
+        attn_output = flash_attn_varlen_func(
+            query_states, key_states, value_states,
+            cu_seqlens_q = cu_seqlens_q,
+            cu_seqlens_k = cu_seqlens_k,
+            max_seqlen_q = max_seqlen_q,
+            max_seqlen_k = max_seqlen_k,
+            dropout_p = dropout,
+            softmax_scale = softmax_scale,
+            causal = False)
+    else:
+        # 块对角attention逐块计算：每张图一次不带mask的SDPA，不计算图片之间被mask掉的部分
+        outputs = []
+        bounds_q, bounds_k = bounds
+        if softmax_scale is not None:
+            # torch<2.1的SDPA没有scale参数，预先缩放q抵消SDPA内部的1/sqrt(d)
+            query_states = query_states * (softmax_scale * math.sqrt(head_dim))
+        for i in range(len(bounds_q) - 1):
+            q = query_states[bounds_q[i]:bounds_q[i + 1]].transpose(0, 1)[None]
+            k = key_states[bounds_k[i]:bounds_k[i + 1]].transpose(0, 1)[None]
+            v = value_states[bounds_k[i]:bounds_k[i + 1]].transpose(0, 1)[None]
+            outputs.append(nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=dropout)[0].transpose(0, 1))
+        attn_output = torch.cat(outputs)
+    return attention.output(attn_output.reshape(-1, num_heads * head_dim))
+
+
+def packed_vision_forward(
+    vision_model,
+    flattened_patches: torch.Tensor,
+    cu_seqlens: torch.Tensor,
+    max_patches: Optional[int] = None,
+    output_hidden_states: bool = False,
+) -> BaseModelOutput:
+    """
+    Run a `Kosmos2_5VisionModel` or `Pix2StructVisionModel` on the (T, D) real patches of a batch packed along
+    `cu_seqlens` (see `pack_flattened_patches`), so that the cost follows the real patches instead of `max_patches`.
+
+    In the padded model every padding row has the same input (an all-zero patch) and attends to the real patches only,
+    so all the padding rows of an image share one output. Each image gets one such padding token as an extra query
+    (never used as a key); with `max_patches` the outputs are scattered back to the (B, max_patches, C) padded layout
+    and match the eager/sdpa padded forward. Otherwise the (T, C) outputs of the real patches are returned.
+    """
+    device = flattened_patches.device
+    cu_seqlens = cu_seqlens.to(device=device, dtype=torch.int32)
+    lengths = cu_seqlens[1:] - cu_seqlens[:-1]
+    batch_size, num_patches = lengths.shape[0], flattened_patches.shape[0]
+    # 分块边界只在这里同步一次，所有层共用
+    bounds_k = cu_seqlens.tolist()
+    bounds_q = [bound + i for i, bound in enumerate(bounds_k)]
+    lengths_list = [end - start for start, end in zip(bounds_k[:-1], bounds_k[1:])]
+    assert min(lengths_list) > 0, 'every image needs at least one patch'
+
+    # 打包后第i张图占[cu_seqlens[i] + i, cu_seqlens[i + 1] + i)，最后一行是padding token
+    image_ids = torch.repeat_interleave(torch.arange(batch_size, device=device), lengths)
+    key_index = torch.arange(num_patches, device=device) + image_ids
+    pad_index = cu_seqlens[1:].long() + torch.arange(batch_size, device=device)
+    inputs = flattened_patches.new_zeros(num_patches + batch_size, flattened_patches.shape[-1])
+    inputs = inputs.index_copy(0, key_index, flattened_patches)
+    cu_seqlens_q = cu_seqlens + torch.arange(batch_size + 1, device=device, dtype=torch.int32)
+
+    def unpack(states):
+        if max_patches is None:
+            return states.index_select(0, key_index)
+        channels = states.shape[-1]
+        dest = (torch.arange(max_patches, device=device)[None] < lengths[:, None]).flatten().nonzero().squeeze(-1)
+        padded = states.index_select(0, pad_index)[:, None].expand(batch_size, max_patches, channels)
+        padded = padded.reshape(-1, channels).index_copy(0, dest, states.index_select(0, key_index))
+        return padded.view(batch_size, max_patches, channels)
+
+    hidden_states = vision_model.embeddings(inputs[None])[0]
+    all_hidden_states = () if output_hidden_states else None
+    max_seqlen = max(lengths_list)
+    for layer in vision_model.encoder.layer:
+        if output_hidden_states:
+            all_hidden_states = all_hidden_states + (unpack(hidden_states),)
+        residual = hidden_states
+        hidden_states = layer.pre_attention_layer_norm(hidden_states)
+        hidden_states = _packed_attention(
+            layer.attention, hidden_states, key_index, cu_seqlens_q, cu_seqlens, max_seqlen + 1, max_seqlen, (bounds_q, bounds_k)) + residual
+        hidden_states = layer.mlp(layer.pre_mlp_layer_norm(hidden_states)) + hidden_states
+    if output_hidden_states:
+        all_hidden_states = all_hidden_states + (unpack(hidden_states),)
+    hidden_states = vision_model.layernorm(hidden_states)
+    return BaseModelOutput(last_hidden_state=unpack(hidden_states), hidden_states=all_hidden_states)
+
+
 # Pix2StructVisionModel -> Kosmos2_5VisionModel
 class Kosmos2_5VisionModel(PreTrainedModel):
     _no_split_modules = ["Kosmos2_5VisionEmbeddings", "Kosmos2_5VisionLayer", "Kosmos2_5LayerNorm"]
@@ -870,7 +988,14 @@ class Kosmos2_5VisionModel(PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_patches: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPooling]:
+        r"""
+        cu_seqlens (`torch.Tensor`, *optional*):
+            When given, `flattened_patches` holds the (T, D) real patches of the batch packed along `cu_seqlens`, see
+            `packed_vision_forward`; `max_patches` then restores the padded (B, max_patches, C) outputs.
+        """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -880,6 +1005,11 @@ class Kosmos2_5VisionModel(PreTrainedModel):
         if flattened_patches is None:
             raise ValueError("You have to specify flattened_patches")
 
+        if cu_seqlens is not None:
+            outputs = packed_vision_forward(
+                self, flattened_patches, cu_seqlens, max_patches=max_patches, output_hidden_states=output_hidden_states)
+            return outputs if return_dict else outputs.to_tuple()
+
         if attention_mask is None:
             # check where `flattened_patches` is not 0
             attention_mask = (flattened_patches.sum(dim=-1) != 0).float()
@@ -14,6 +14,7 @@
 
 """ PyTorch Phi-3 model."""
 
+import functools
 import inspect
 import math
 import warnings
@@ -40,6 +41,9 @@ from transformers.utils import (add_code_sample_docstrings,
                                 is_flash_attn_greater_or_equal_2_10, logging,
                                 replace_return_docstrings)
 
+from chimera.paged_kv_cache import PagedKVCache
+from chimera.sequence_packing import get_max_seqlen, packed_causal_mask
+
 from .configuration_phi3 import Phi3Config
 
 logger = logging.get_logger(__name__)
@@ -48,7 +52,8 @@ logger = logging.get_logger(__name__)
 # if is_flash_attn_2_available():
 _flash_supports_window_size = False
 try:
-    from flash_attn import flash_attn_func, flash_attn_varlen_func
+    from flash_attn import (flash_attn_func, flash_attn_varlen_func,
+                            flash_attn_with_kvcache)
     from flash_attn.bert_padding import (index_first_axis, pad_input,  # noqa
                                          unpad_input)
 
@@ -500,11 +505,14 @@ class Phi3FlashAttention2(Phi3Attention):
             and kv_seq_len > self.config.sliding_window
         )
 
+        use_block_table = isinstance(past_key_value, PagedKVCache) and past_key_value.supports_block_table
         if past_key_value is not None:
             # Activate slicing cache only if the config has a value `sliding_windows` attribute
             cache_has_contents = past_key_value.get_seq_length(self.layer_idx) > 0
+            # 分页cache按block存放，不做切片；滑窗由flash attention的window_size处理
             if (
-                getattr(self.config, 'sliding_window', None) is not None
+                not isinstance(past_key_value, PagedKVCache)
+                and getattr(self.config, 'sliding_window', None) is not None
                 and kv_seq_len > self.config.sliding_window
                 and cache_has_contents
             ):
@@ -527,7 +535,11 @@ class Phi3FlashAttention2(Phi3Attention):
                     attention_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, -1:])], dim=-1)
 
             cache_kwargs = {'sin': sin, 'cos': cos}  # Specific to RoPE models
-            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
+            if use_block_table:
+                # 分页cache：新的k/v原地写入，flash attention按block table直接读取各block，不gather
+                past_key_value.write(key_states, value_states, self.layer_idx)
+            else:
+                key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -565,6 +577,11 @@ class Phi3FlashAttention2(Phi3Attention):
         key_states = key_states.transpose(1, 2)
         value_states = value_states.transpose(1, 2)
 
+        cache_kwargs = {}
+        if use_block_table:
+            key_states, value_states = past_key_value.get_blocks(self.layer_idx)
+            cache_kwargs = dict(cache_seqlens=past_key_value.cache_seqlens, block_table=past_key_value.block_table)
+
         attn_output = self._flash_attention_forward(
             query_states,
             key_states,
@@ -573,6 +590,9 @@ class Phi3FlashAttention2(Phi3Attention):
             q_len,
             dropout=attn_dropout,
             use_sliding_windows=use_sliding_windows,
+            cu_seqlens=kwargs.get('cu_seqlens'),
+            max_seqlen=kwargs.get('max_seqlen'),
+            **cache_kwargs,
         )
 
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
@@ -594,6 +614,10 @@ class Phi3FlashAttention2(Phi3Attention):
         dropout=0.0,
         softmax_scale=None,
         use_sliding_windows=False,
+        cu_seqlens=None,
+        max_seqlen=None,
+        cache_seqlens=None,
+        block_table=None,
     ):
         """
         Calls the forward method of Flash Attention - if the input hidden states contain at least one padding token
@@ -615,6 +639,12 @@ class Phi3FlashAttention2(Phi3Attention):
                 The scaling of QK^T before applying softmax. Default to 1 / sqrt(head_dim)
             use_sliding_windows (`bool`, *optional*):
                 Whether to activate sliding window attention.
+            cu_seqlens (`torch.Tensor`, *optional*):
+                Boundaries of the packed samples over the flattened (batch_size * seq_len) tokens, see
+                `chimera.sequence_packing`; `max_seqlen` is the longest of them.
+            cache_seqlens / block_table (`torch.Tensor`, *optional*):
+                (batch_size,) sequence lengths and (batch_size, max_blocks) block tables when the keys/values are the
+                (num_blocks, block_size) blocks of a `PagedKVCache`; `attention_mask` is then not used.
         """
         if not self._flash_attn_uses_top_left_mask:
             causal = self.is_causal
@@ -622,8 +652,40 @@ class Phi3FlashAttention2(Phi3Attention):
             # TODO: Remove the `query_length != 1` check once Flash Attention for RoCm is bumped to 2.1. For details, please see the comment in LlamaFlashAttention2 __init__.
             causal = self.is_causal and query_length != 1
 
+        if block_table is not None:
+            window_kwargs = dict(window_size=(self.config.sliding_window, self.config.sliding_window)) \
+                if use_sliding_windows else {}
+            attn_output = flash_attn_with_kvcache(
+                query_states,
+                key_states,
+                value_states,
+                cache_seqlens=cache_seqlens,
+                block_table=block_table,
+                softmax_scale=softmax_scale,
+                causal=self.is_causal,
+                **window_kwargs,
+            )
+        elif cu_seqlens is not None:
+            # 打包训练：所有行展平后按样本边界做varlen attention
+            batch_size = query_states.shape[0]
+            window_kwargs = dict(window_size=(self.config.sliding_window, self.config.sliding_window)) \
+                if use_sliding_windows else {}
+            attn_output = flash_attn_varlen_func(
+                query_states.reshape(-1, *query_states.shape[2:]),
+                key_states.reshape(-1, *key_states.shape[2:]),
+                value_states.reshape(-1, *value_states.shape[2:]),
+                cu_seqlens_q=cu_seqlens,
+                cu_seqlens_k=cu_seqlens,
+                max_seqlen_q=max_seqlen,
+                max_seqlen_k=max_seqlen,
+                dropout_p=dropout,
+                softmax_scale=softmax_scale,
+                causal=causal,
+                **window_kwargs,
+            )
+            attn_output = attn_output.view(batch_size, query_length, *attn_output.shape[1:])
         # Contains at least one padding token in the sequence
-        if attention_mask is not None:
+        elif attention_mask is not None:
             batch_size = query_states.shape[0]
             query_states, key_states, value_states, indices_q, cu_seq_lens, max_seq_lens = self._upad_input(
                 query_states, key_states, value_states, attention_mask, query_length
@@ -877,6 +939,8 @@ class Phi3DecoderLayer(nn.Module):
         hidden_states = self.input_layernorm(hidden_states)
 
         # Self Attention
+        # 打包训练时cu_seqlens/max_seqlen交给flash attention的varlen接口
+        packed_kwargs = {k: kwargs[k] for k in ('cu_seqlens', 'max_seqlen') if k in kwargs}
         attn_outputs, self_attn_weights, present_key_value = self.self_attn(
             hidden_states=hidden_states,
             attention_mask=attention_mask,
@@ -884,6 +948,7 @@ class Phi3DecoderLayer(nn.Module):
             past_key_value=past_key_value,
             output_attentions=output_attentions,
             use_cache=use_cache,
+            **packed_kwargs,
         )
 
         hidden_states = residual + self.resid_attn_dropout(attn_outputs)
@@ -932,7 +997,7 @@ class Phi3PreTrainedModel(PreTrainedModel):
     _no_split_modules = ['Phi3DecoderLayer']
     _skip_keys_device_placement = 'past_key_values'
     _supports_flash_attn_2 = True
-    _supports_sdpa = False
+    _supports_sdpa = True
     _supports_cache_class = True
 
     _version = '0.0.5'
@@ -1066,7 +1131,14 @@ class Phi3Model(Phi3PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
+        r"""
+        cu_seqlens (`torch.Tensor`, *optional*):
+            Boundaries of the samples packed into the rows, over the flattened (batch_size * seq_len) tokens (see
+            `chimera.sequence_packing`). Attention stays inside every sample; `position_ids` should restart at every
+            sample. Training only, without cache.
+        """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
@@ -1121,7 +1193,19 @@ class Phi3Model(Phi3PreTrainedModel):
                     " call `tokenizer.padding_side  = 'left'` before tokenizing the input. "
                 )
 
-        if self._attn_implementation == 'flash_attention_2':
+        packed_kwargs = {}
+        if cu_seqlens is not None:
+            assert past_key_values_length == 0, 'packed sequences do not support past_key_values'
+            # 打包训练：flash attention直接用cu_seqlens，其余实现用块对角的因果mask
+            if self._attn_implementation == 'flash_attention_2':
+                packed_kwargs = dict(
+                    cu_seqlens=cu_seqlens.to(inputs_embeds.device, torch.int32), max_seqlen=get_max_seqlen(cu_seqlens))
+                attention_mask = None
+            else:
+                attention_mask = packed_causal_mask(
+                    cu_seqlens, batch_size, seq_length, inputs_embeds.dtype, inputs_embeds.device,
+                    sliding_window=self.config.sliding_window)
+        elif self._attn_implementation == 'flash_attention_2':
             # 2d mask is passed through the layers
             attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
         else:
@@ -1147,7 +1231,7 @@ class Phi3Model(Phi3PreTrainedModel):
 
             if self.gradient_checkpointing and self.training:
                 layer_outputs = self._gradient_checkpointing_func(
-                    decoder_layer.__call__,
+                    functools.partial(decoder_layer.__call__, **packed_kwargs),
                     hidden_states,
                     attention_mask,
                     position_ids,
@@ -1163,6 +1247,7 @@ class Phi3Model(Phi3PreTrainedModel):
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    **packed_kwargs,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1244,6 +1329,7 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1289,6 +1375,7 @@ class Phi3ForCausalLM(Phi3PreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            cu_seqlens=cu_seqlens,
         )
 
         hidden_states = outputs[0]
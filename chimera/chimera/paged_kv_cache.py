@@ -0,0 +1,274 @@
+"""
+Block-based paged KV cache for the InternLM2 and Phi3 decoders.
+
+The legacy `(key, value)` tuples grow with `torch.cat` at every step (an O(n) copy per token per layer) and every
+sequence of a batch is padded to the longest one. `PagedKVCache` instead keeps, per layer, one preallocated pool of
+fixed-size blocks of `block_size` token slots. Each sequence owns a block table (the list of its blocks, in order) and
+only gets a new block when the previous one is full, so new tokens are written in place and the memory of a finished
+session is handed back to the pool with `free_sequence`.
+
+Usage, for one forward of the decoder over the sequences `seq_ids`:
+
+    attention_mask = cache.prepare(seq_ids, num_new_tokens)
+    model(inputs_embeds=..., attention_mask=attention_mask, position_ids=..., past_key_values=cache, use_cache=True)
+    cache.commit()
+
+`prepare` allocates the blocks for the new tokens and fixes the layout of this forward: the new tokens of every
+sequence are right aligned in the (B, q_len) input (left padding). The sequence lengths only grow with `commit`, after
+the forward succeeded; if the forward raises, the next `prepare` writes the same slots again. flash_attention_2 reads
+the blocks in place with `flash_attn_with_kvcache`, given the block tables and the sequence lengths (`block_table`,
+`cache_seqlens`); its paged kernel needs a `block_size` multiple of 256 (`supports_block_table`).
+
+Otherwise, and for eager/sdpa, the attention layers see the cached keys/values of each sequence gathered from its
+blocks, left padded to the longest one, together with the returned 2D mask. That gather still copies the whole past
+of every sequence in every layer at every step, i.e. it removes the `torch.cat` reallocation and the re-packing when
+sequences join or leave, but not the O(n) copy per token; only the block table path reads the cache in place.
+"""
+
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache
+
+
+class BlockAllocator:
+    """Free list of the `num_blocks` KV cache blocks."""
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.free_blocks = deque(range(num_blocks))
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    def can_allocate(self, num_blocks: int) -> bool:
+        return num_blocks <= len(self.free_blocks)
+
+    def allocate(self, num_blocks: int) -> List[int]:
+        if not self.can_allocate(num_blocks):
+            raise RuntimeError(
+                f'out of KV cache blocks: {num_blocks} needed, {len(self.free_blocks)} of {self.num_blocks} free')
+        return [self.free_blocks.popleft() for _ in range(num_blocks)]
+
+    def free(self, blocks: List[int]):
+        self.free_blocks.extend(blocks)
+
+    def utilization(self) -> float:
+        """Fraction of the blocks in use."""
+        return self.num_used_blocks / self.num_blocks
+
+
+class PagedLayerCache:
+    """View of one layer of a `PagedKVCache`, passed to the InternLM2 attention layers as `past_key_value`."""
+
+    def __init__(self, cache: 'PagedKVCache', layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def get_kv_length(self, q_len: int) -> int:
+        return self.cache.get_usable_length(q_len, self.layer_idx) + q_len
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache.update(key_states, value_states, self.layer_idx)
+
+    def write(self, key_states: torch.Tensor, value_states: torch.Tensor):
+        self.cache.write(key_states, value_states, self.layer_idx)
+
+    def get_blocks(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache.get_blocks(self.layer_idx)
+
+
+class PagedKVCache(Cache):
+    """
+    Paged KV cache shared by all the sequences of a decoder.
+
+    Args:
+        num_layers / num_key_value_heads / head_dim: shape of the decoder, see `from_config`.
+        num_blocks: size of the block pool of every layer.
+        block_size: number of token slots of a block.
+    """
+
+    def __init__(
+            self,
+            num_layers: int,
+            num_key_value_heads: int,
+            head_dim: int,
+            num_blocks: int,
+            block_size: int = 16,
+            dtype: torch.dtype = torch.float16,
+            device: Optional[torch.device] = None):
+        super().__init__()
+        self.num_layers = num_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = device
+        # 每层一块扁平的slot池，第i个block占[i * block_size, (i + 1) * block_size)；
+        # 用0初始化，保证padding位置gather出来的是有限值(mask后权重为0)
+        shape = (num_blocks * block_size, num_key_value_heads, head_dim)
+        self.key_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lens: Dict[int, int] = {}
+
+        # prepare()确定的本次forward的布局
+        self._slot_mapping = None
+        self._new_token_index = None
+        self._gather_index = None
+        self._past_length = 0
+        self._pending_lens = []
+        # 供flash_attn_with_kvcache原地读取block：(B, max_blocks)的block table和(B,)的序列长度(含新token)
+        self.block_table = None
+        self.cache_seqlens = None
+
+    @classmethod
+    def from_config(cls, config, num_blocks: int, block_size: int = 16, dtype=torch.float16, device=None):
+        """Build the cache for an `InternLM2Config` or `Phi3Config`."""
+        num_key_value_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+        return cls(
+            num_layers = config.num_hidden_layers,
+            num_key_value_heads = num_key_value_heads,
+            head_dim = config.hidden_size // config.num_attention_heads,
+            num_blocks = num_blocks,
+            block_size = block_size,
+            dtype = dtype,
+            device = device)
+
+    @property
+    def supports_block_table(self) -> bool:
+        # flash attention的paged kernel要求block大小是256的倍数
+        return self.block_size % 256 == 0
+
+    def __len__(self):
+        return self.num_layers
+
+    def __getitem__(self, layer_idx: int) -> PagedLayerCache:
+        return PagedLayerCache(self, layer_idx)
+
+    def add_sequence(self, seq_id: int):
+        assert seq_id not in self.block_tables, f'sequence {seq_id} is already in the cache'
+        self.block_tables[seq_id] = []
+        self.seq_lens[seq_id] = 0
+
+    def free_sequence(self, seq_id: int):
+        """Return the blocks of `seq_id` to the pool."""
+        self.allocator.free(self.block_tables.pop(seq_id))
+        self.seq_lens.pop(seq_id)
+
+    def num_blocks_needed(self, seq_id: int, num_new_tokens: int) -> int:
+        """Number of blocks `prepare` would allocate for `num_new_tokens` more tokens of `seq_id`."""
+        num_tokens = self.seq_lens.get(seq_id, 0) + num_new_tokens
+        return -(-num_tokens // self.block_size) - len(self.block_tables.get(seq_id, []))
+
+    def prepare(self, seq_ids: List[int], num_new_tokens: List[int]) -> torch.LongTensor:
+        """
+        Allocate the blocks for `num_new_tokens[i]` new tokens of `seq_ids[i]` (new sequences are added) and return
+        the (B, past + q_len) attention mask of the next forward, where q_len = max(num_new_tokens). The new tokens
+        count towards the sequence lengths once the forward succeeded and `commit` is called.
+        """
+        assert len(seq_ids) == len(num_new_tokens), f'{len(seq_ids)} sequences but {len(num_new_tokens)} lengths'
+        num_blocks = sum(max(self.num_blocks_needed(x, n), 0) for x, n in zip(seq_ids, num_new_tokens))
+        if not self.allocator.can_allocate(num_blocks):
+            raise RuntimeError(
+                f'out of KV cache blocks: {num_blocks} needed, {self.allocator.num_free_blocks} free')
+        for seq_id, n in zip(seq_ids, num_new_tokens):
+            if seq_id not in self.block_tables:
+                self.add_sequence(seq_id)
+            num_blocks = self.num_blocks_needed(seq_id, n)
+            if num_blocks > 0:
+                self.block_tables[seq_id] += self.allocator.allocate(num_blocks)
+
+        device = self.key_cache[0].device
+        past_lens = torch.tensor([self.seq_lens[x] for x in seq_ids], dtype=torch.long, device=device)
+        new_lens = torch.tensor(num_new_tokens, dtype=torch.long, device=device)
+        total_lens = past_lens + new_lens
+        q_len = max(num_new_tokens)
+        max_length = max(self.seq_lens[x] + n for x, n in zip(seq_ids, num_new_tokens))
+        max_table = max(len(self.block_tables[x]) for x in seq_ids)
+        block_tables = torch.tensor(
+            [self.block_tables[x] + [0] * (max_table - len(self.block_tables[x])) for x in seq_ids],
+            dtype=torch.long, device=device)
+
+        # 每行第j列对应序列中的位置j - (max_length - total_len)，负数为左padding
+        positions = torch.arange(max_length, device=device)[None] - (max_length - total_lens)[:, None]
+        valid = positions >= 0
+        positions = positions.clamp(min=0)
+        slots = block_tables.gather(1, positions // self.block_size) * self.block_size + positions % self.block_size
+        self._gather_index = torch.where(valid, slots, torch.zeros_like(slots)).flatten()
+
+        # 新token在(B * q_len)输入中的下标及其要写入的slot
+        is_new = valid & (positions >= past_lens[:, None])
+        rows, cols = is_new.nonzero(as_tuple=True)
+        self._new_token_index = rows * q_len + cols - (max_length - q_len)
+        self._slot_mapping = slots[rows, cols]
+
+        self._batch_shape = (len(seq_ids), max_length)
+        self._past_length = max_length - q_len
+        self.block_table = block_tables.to(torch.int32)
+        self.cache_seqlens = total_lens.to(torch.int32)
+        self._pending_lens = list(zip(seq_ids, num_new_tokens))
+        return valid.long()
+
+    def commit(self):
+        """Count the tokens written by the forward after the last `prepare` in the sequence lengths."""
+        for seq_id, n in self._pending_lens:
+            self.seq_lens[seq_id] += n
+        self._pending_lens = []
+
+    def write(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int):
+        """Write the (B, H, q_len, D) new keys/values in place."""
+        bsz, num_heads, q_len, head_dim = key_states.shape
+        for states, cache in ((key_states, self.key_cache[layer_idx]), (value_states, self.value_cache[layer_idx])):
+            states = states.transpose(1, 2).reshape(bsz * q_len, num_heads, head_dim)
+            cache.index_copy_(0, self._slot_mapping, states.index_select(0, self._new_token_index).to(cache.dtype))
+
+    def get_blocks(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The (num_blocks, block_size, H, D) key/value blocks of a layer, the paged layout of `flash_attn_with_kvcache`."""
+        return tuple(x[layer_idx].view(self.num_blocks, self.block_size, *x[layer_idx].shape[1:])
+                     for x in (self.key_cache, self.value_cache))
+
+    def update(
+            self,
+            key_states: torch.Tensor,
+            value_states: torch.Tensor,
+            layer_idx: int,
+            cache_kwargs=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write the (B, H, q_len, D) new keys/values in place, return the (B, H, past + q_len, D) keys/values."""
+        self.write(key_states, value_states, layer_idx)
+        _, num_heads, _, head_dim = key_states.shape
+        outputs = []
+        for cache in (self.key_cache[layer_idx], self.value_cache[layer_idx]):
+            states = cache.index_select(0, self._gather_index).view(*self._batch_shape, num_heads, head_dim)
+            outputs.append(states.transpose(1, 2).to(key_states.dtype))
+        return tuple(outputs)
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._past_length
+
+    def get_usable_length(self, new_seq_length: int, layer_idx: Optional[int] = 0) -> int:
+        return self._past_length
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def stats(self) -> Dict[str, float]:
+        """Block and token slot utilization of the pool."""
+        num_tokens = sum(self.seq_lens.values())
+        num_used_blocks = self.allocator.num_used_blocks
+        return dict(
+            num_sequences = len(self.block_tables),
+            num_tokens = num_tokens,
+            num_blocks = self.num_blocks,
+            used_blocks = num_used_blocks,
+            free_blocks = self.allocator.num_free_blocks,
+            block_utilization = self.allocator.utilization(),
+            # 已分配block中真正存了token的比例(只有每个序列最后一个block可能不满)
+            slot_utilization = num_tokens / (num_used_blocks * self.block_size) if num_used_blocks > 0 else 0.0,
+            memory_bytes = 2 * sum(x.numel() * x.element_size() for x in self.key_cache))
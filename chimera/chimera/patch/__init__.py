@@ -2,7 +2,8 @@ from .llama2_flash_attn_monkey_patch import replace_llama2_attn_with_flash_attn
 from .llama_flash_attn_monkey_patch import replace_llama_attn_with_flash_attn
 from .llama_rmsnorm_monkey_patch import \
     replace_llama_rmsnorm_with_fused_rmsnorm
-from .pad_data_collator import concat_pad_data_collator, pad_data_collator
+from .pad_data_collator import (concat_pad_data_collator, packed_data_collator,
+                                pad_data_collator)
 from .train_sampler_patch import replace_train_sampler
 
 __all__ = ['replace_llama_attn_with_flash_attn',
@@ -10,4 +11,5 @@ __all__ = ['replace_llama_attn_with_flash_attn',
            'replace_llama2_attn_with_flash_attn',
            'replace_train_sampler',
            'pad_data_collator',
-           'concat_pad_data_collator']
+           'concat_pad_data_collator',
+           'packed_data_collator']
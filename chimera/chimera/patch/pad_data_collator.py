@@ -2,9 +2,31 @@ import numpy as np
 import torch
 import pdb
 
+from chimera.prompt_builder import PromptBuilder
+from chimera.sequence_packing import pack_samples
+
 IGNORE_INDEX = -100
 
 
+def context_placement_index(runs_list, seq_length):
+    """
+    `placement_index` of a batch (see `ChimeraChatModel.forward`) from the `context_runs` of its rows, the
+    (token_id, start, length) runs of the context tokens in each row of `seq_length` tokens.
+
+    Positions are grouped by ascending token id; the model concatenates the features of its visual sources in the
+    same order, so it neither scans `input_ids` nor syncs with the host to place them.
+    """
+    runs_list = [[tuple(run) for run in runs.tolist()] for runs in runs_list]
+    token_ids = sorted({run[0] for runs in runs_list for run in runs})
+    return PromptBuilder.placement_index(runs_list, token_ids, seq_length)
+
+
+def _pop_context_runs(features):
+    # 所有样本都带context_runs时才能给出整个batch的placement_index
+    runs_list = [feat.pop('context_runs', None) for feat in features]
+    return runs_list if all(x is not None for x in runs_list) else None
+
+
 def pad_data_collator(features, pad_id=0):
 
     first = features[0]
@@ -12,6 +34,9 @@ def pad_data_collator(features, pad_id=0):
 
     batch_lens = [feat['input_ids'].shape for feat in features]
     max_item_length = max(batch_lens)[0]
+    runs_list = _pop_context_runs(features)
+    if runs_list is not None:
+        batch['placement_index'] = context_placement_index(runs_list, max_item_length)
     for idx in range(len(features)):
         feat = features[idx]
         temp_input_ids = torch.LongTensor([pad_id] * max_item_length)
@@ -56,6 +81,10 @@ def concat_pad_data_collator(features, pad_id=0):
 
     batch_lens = [feat['input_ids'].shape for feat in features]
     max_item_length = max(batch_lens)[0]
+    runs_list = _pop_context_runs(features)
+    if runs_list is not None:
+        # 右padding，样本i的位置从i * max_item_length开始
+        batch['placement_index'] = context_placement_index(runs_list, max_item_length)
     for idx in range(len(features)):
         feat = features[idx]
 
@@ -73,7 +102,87 @@ def concat_pad_data_collator(features, pad_id=0):
         temp_attention_mask[:feat['attention_mask'].shape[0]] = feat['attention_mask']
         feat['attention_mask'] = temp_attention_mask
         
+    return _concat_collate(features, batch)
+
+
+def packed_data_collator(features, pad_id=0, max_packed_tokens=None):
+    """
+    Concatenate the samples into rows of at most `max_packed_tokens` tokens instead of padding each of them, see
+    `chimera.sequence_packing`. Position ids restart at every sample and `cu_seqlens` gives the sample boundaries over
+    the flattened rows; the visual inputs are concatenated as in `concat_pad_data_collator`.
+    """
+    lengths = [feat['input_ids'].shape[0] for feat in features]
+    rows = pack_samples(lengths, max_packed_tokens)
+    max_row_length = max(sum(lengths[i] for i in row) for row in rows)
+    runs_list = _pop_context_runs(features)
+    row_runs_list = []
 
+    input_ids = torch.full((len(rows), max_row_length), pad_id, dtype=torch.long)
+    labels = torch.full((len(rows), max_row_length), IGNORE_INDEX, dtype=torch.long)
+    position_ids = torch.zeros((len(rows), max_row_length), dtype=torch.long)
+    seqlens = []
+    for r, row in enumerate(rows):
+        offset = 0
+        row_runs = []
+        for i in row:
+            feat, length = features[i], lengths[i]
+            input_ids[r, offset:offset + length] = feat['input_ids']
+            labels[r, offset:offset + length] = feat['labels']
+            # 位置编号在每个样本内从0开始
+            position_ids[r, offset:offset + length] = feat['position_ids'].reshape(-1) \
+                if feat.get('position_ids') is not None else torch.arange(length)
+            seqlens.append(length)
+            if runs_list is not None:
+                row_runs.append(runs_list[i] + torch.tensor([0, offset, 0]))
+            offset += length
+        row_runs_list.append(torch.cat(row_runs) if row_runs else torch.zeros(0, 3, dtype=torch.long))
+        if offset < max_row_length:
+            # 行尾的padding单独作为一个样本，不参与其他样本的attention
+            position_ids[r, offset:] = torch.arange(max_row_length - offset)
+            seqlens.append(max_row_length - offset)
+
+    batch = {
+        'input_ids': input_ids,
+        'labels': labels,
+        'position_ids': position_ids,
+        'cu_seqlens': torch.tensor(np.cumsum([0] + seqlens), dtype=torch.int32),
+    }
+    if runs_list is not None:
+        # 每个样本的run平移到它在行内的位置
+        batch['placement_index'] = context_placement_index(row_runs_list, max_row_length)
+    # 样本顺序不变，视觉输入按样本顺序拼接后仍与各行的context token一一对应
+    features = [{k: v for k, v in feat.items() if k not in ('input_ids', 'labels', 'attention_mask', 'position_ids')}
+                for feat in features]
+    return _concat_collate(features, batch)
+
+
+def find_thumbnail_indices(pixel_values, thumbnail):
+    """
+    Rows of `pixel_values` holding each image's `thumbnail` (its last tile, see `dynamic_preprocess`), or None if some
+    thumbnail is not one of the tiles, e.g. when it was augmented separately.
+    """
+    indices, row = [], 0
+    for image_thumbnail in thumbnail:
+        # 图片按顺序排列，每个thumbnail只需从上一个匹配位置之后查找
+        while row < pixel_values.shape[0] and not torch.equal(pixel_values[row], image_thumbnail):
+            row += 1
+        if row == pixel_values.shape[0]:
+            return None
+        indices.append(row)
+        row += 1
+    return torch.tensor(indices, dtype=torch.long)
+
+
+def _concat_collate(features, batch):
+    first = features[0]
+
+    # 数据集没有给出thumbnail_indices时按内容找出thumbnail所在的tile，训练时router复用tile的ViT前向
+    if isinstance(first.get('thumbnail'), torch.Tensor) and isinstance(first.get('pixel_values'), torch.Tensor) and \
+            first.get('thumbnail_indices') is None:
+        thumbnail_indices = [find_thumbnail_indices(f['pixel_values'], f['thumbnail']) for f in features]
+        if all(x is not None for x in thumbnail_indices):
+            for f, x in zip(features, thumbnail_indices):
+                f['thumbnail_indices'] = x
 
     # Special handling for labels.
     # Ensure that tensor is created with the correct type
@@ -92,7 +201,7 @@ def concat_pad_data_collator(features, pad_id=0):
     # Handling of all other possible keys.
     # Again, we will use the first element to figure out which key/values are not None for this model.
     for k, v in first.items():
-        if k not in ('label', 'label_ids', 'pixel_values', 'image_flags', 'thumbnail', 'sci_domain_ids', "sci_encoder_pixel_value_list" , "sci_encoder_attention_mask_list") and \
+        if k not in ('label', 'label_ids', 'pixel_values', 'image_flags', 'thumbnail', 'thumbnail_indices', 'sci_domain_ids', "sci_encoder_pixel_value_list" , "sci_encoder_attention_mask_list") and \
                 v is not None and not isinstance(v, str):
             if isinstance(v, torch.Tensor):
                 batch[k] = torch.stack([f[k] for f in features])
@@ -109,6 +218,11 @@ def concat_pad_data_collator(features, pad_id=0):
             else:
                 batch[k] = torch.concat([f[k] for f in features])
 
+        # thumbnail在样本内pixel_values中的行号，拼接后需要加上之前样本的tile数
+        if k == 'thumbnail_indices':
+            offsets = np.cumsum([0] + [f['pixel_values'].shape[0] for f in features[:-1]])
+            batch[k] = torch.concat([f[k] + int(offset) for f, offset in zip(features, offsets)])
+
         
         if k in ("sci_encoder_pixel_value_list" , "sci_encoder_attention_mask_list"):
             num_sci_encoder = len(first["sci_encoder_pixel_value_list"])
@@ -0,0 +1,229 @@
+"""
+Token-level prompt builder.
+
+Multimodal prompts contain thousands of placeholder tokens (`<IMG_CONTEXT>` for every ViT token and
+`<DOMAIN_i_CONTEXT>` for every expert token). Instead of expanding them into a string and running it through the
+tokenizer, the prompt is kept with `<image>` placeholders, only the text pieces between them are tokenized
+(memoized, so the constant template prefix is tokenized once), and the placeholder spans are emitted directly as
+runs of token ids.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import torch
+
+IMAGE_PLACEHOLDER = '<image>'
+
+# A span is a list of (token_id, repeat) runs, e.g. [(<img>, 1), (<IMG_CONTEXT>, 256), (</img>, 1)].
+Span = List[Tuple[int, int]]
+
+
+class PromptBuilder:
+    """Build `input_ids` for prompts whose `<image>` placeholders expand to runs of context tokens.
+
+    The output is identical to tokenizing the fully expanded string: every span starts and ends with an added
+    special token, so the tokenizer would split the text around it anyway. Text following a span is tokenized
+    behind the span's closing token to reproduce the in-context tokenization of sentencepiece tokenizers that do
+    not add a prefix space after special tokens.
+    """
+
+    def __init__(self, tokenizer, cache_size: int = 1024):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._text_cache = OrderedDict()
+        self._token_ids = {}
+
+        # special tokens the tokenizer adds around a sequence, e.g. [<s>] and []
+        with_special = tokenizer('a', add_special_tokens=True).input_ids
+        without_special = tokenizer('a', add_special_tokens=False).input_ids
+        for start in range(len(with_special) - len(without_special) + 1):
+            if with_special[start:start + len(without_special)] == without_special:
+                break
+        else:
+            start = 0
+        self.prefix_ids = with_special[:start]
+        self.suffix_ids = with_special[start + len(without_special):]
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> 'PromptBuilder':
+        """Return the builder shared by every caller of `tokenizer`, so the text cache is reused."""
+        # 缓存在tokenizer上：与tokenizer同生命周期，不会因为id复用拿到别的tokenizer的builder
+        builder = getattr(tokenizer, '_prompt_builder', None)
+        if not isinstance(builder, cls):
+            builder = cls(tokenizer)
+            tokenizer._prompt_builder = builder
+        return builder
+
+    def token_id(self, token: str) -> int:
+        if token not in self._token_ids:
+            self._token_ids[token] = self.tokenizer.convert_tokens_to_ids(token)
+        return self._token_ids[token]
+
+    def image_span(
+            self,
+            num_image_token: int,
+            domain_context_token: Optional[str] = None,
+            num_domain_token: int = 0,
+            IMG_START_TOKEN='<img>',
+            IMG_END_TOKEN='</img>',
+            IMG_CONTEXT_TOKEN='<IMG_CONTEXT>',
+            DOMAIN_START_TOKEN='<domain>',
+            DOMAIN_END_TOKEN='</domain>',
+    ) -> Span:
+        """Runs for `<img>{ctx * n}</img>`, followed by `<domain>{domain_ctx * m}</domain>` when `m > 0`."""
+        span = [
+            (self.token_id(IMG_START_TOKEN), 1),
+            (self.token_id(IMG_CONTEXT_TOKEN), num_image_token),
+            (self.token_id(IMG_END_TOKEN), 1),
+        ]
+        if domain_context_token is not None and num_domain_token > 0:
+            span += [
+                (self.token_id(DOMAIN_START_TOKEN), 1),
+                (self.token_id(domain_context_token), num_domain_token),
+                (self.token_id(DOMAIN_END_TOKEN), 1),
+            ]
+        return span
+
+    def _encode_text(self, text: str, anchor: Optional[int]) -> List[int]:
+        key = (text, anchor)
+        ids = self._text_cache.get(key)
+        if ids is not None:
+            self._text_cache.move_to_end(key)
+            return ids
+        if anchor is None:
+            ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        else:
+            anchor_token = self.tokenizer.convert_ids_to_tokens(anchor)
+            ids = self.tokenizer(anchor_token + text, add_special_tokens=False).input_ids[1:]
+        self._text_cache[key] = ids
+        if len(self._text_cache) > self.cache_size:
+            self._text_cache.popitem(last=False)
+        return ids
+
+    def _segments(self, text: str, spans: Union[Sequence[Span], Iterable[Span]], anchor: Optional[int] = None):
+        """Yield `(ids, None)` for text and `(token_id, repeat)` for runs, consuming one span per placeholder.
+
+        Placeholders left over once `spans` is exhausted stay in the text, like `str.replace(..., 1)` did.
+        """
+        spans = iter(spans)
+        pieces = text.split(IMAGE_PLACEHOLDER)
+        pending = pieces[0]
+        for piece in pieces[1:]:
+            span = next(spans, None)
+            if span is None:
+                pending += IMAGE_PLACEHOLDER + piece
+                continue
+            if pending:
+                yield self._encode_text(pending, anchor), None
+            for token_id, repeat in span:
+                if repeat > 0:
+                    yield token_id, repeat
+            pending, anchor = piece, span[-1][0]
+        if pending:
+            yield self._encode_text(pending, anchor), None
+
+    def num_tokens(
+            self,
+            text: str,
+            spans: Union[Sequence[Span], Iterable[Span]] = (),
+            add_special_tokens: bool = True,
+    ) -> int:
+        """Equivalent to `len(tokenizer(expanded_text).input_ids)`, without building the ids."""
+        num = sum(len(ids) if repeat is None else repeat for ids, repeat in self._segments(text, spans))
+        if add_special_tokens:
+            num += len(self.prefix_ids) + len(self.suffix_ids)
+        return num
+
+    def encode(
+            self,
+            text: str,
+            spans: Union[Sequence[Span], Iterable[Span]] = (),
+            add_special_tokens: bool = True,
+            max_length: Optional[int] = None,
+            anchor: Optional[int] = None,
+            return_runs: bool = False,
+    ):
+        """Equivalent to `tokenizer(expanded_text, truncation=max_length is not None).input_ids[0]`.
+
+        `anchor` is the special token id preceding `text`, for text that continues an already tokenized sequence.
+        With `return_runs=True` also return the `(token_id, start, length)` of every run emitted for the spans,
+        which `placement_index` turns into the positions the visual features are written to.
+        """
+        prefix = self.prefix_ids if add_special_tokens else []
+        suffix = self.suffix_ids if add_special_tokens else []
+        segments, runs = [], []
+        offset = len(prefix)
+        for ids, repeat in self._segments(text, spans, anchor):
+            if repeat is None:
+                segments.append(torch.tensor(ids, dtype=torch.long))
+                offset += len(ids)
+            else:
+                segments.append(torch.full((repeat,), ids, dtype=torch.long))
+                runs.append((ids, offset, repeat))
+                offset += repeat
+
+        input_ids = torch.cat(segments) if segments else torch.zeros(0, dtype=torch.long)
+        if max_length is not None and input_ids.shape[0] + len(prefix) + len(suffix) > max_length:
+            input_ids = input_ids[:max(max_length - len(prefix) - len(suffix), 0)]
+            # 截断后只保留落在序列内的部分
+            end = len(prefix) + input_ids.shape[0]
+            runs = [(token_id, start, min(length, end - start)) for token_id, start, length in runs if start < end]
+        if prefix or suffix:
+            input_ids = torch.cat([
+                torch.tensor(prefix, dtype=torch.long), input_ids, torch.tensor(suffix, dtype=torch.long)])
+        if return_runs:
+            return input_ids, runs
+        return input_ids
+
+    @staticmethod
+    def placement_index(
+            runs_list: List[List[Tuple[int, int, int]]],
+            token_ids: Sequence[int],
+            seq_length: int,
+            offsets: Optional[Sequence[int]] = None,
+    ) -> torch.LongTensor:
+        """Positions in the flattened (batch * seq_length) embeddings of every run of `token_ids`.
+
+        Positions are grouped by `token_ids` in the given order and row-major within a group, i.e. the order in
+        which the visual features of each source are concatenated. `offsets[i]` is the left padding of sample `i`.
+        """
+        positions = OrderedDict((token_id, []) for token_id in token_ids)
+        for i, runs in enumerate(runs_list):
+            base = i * seq_length + (offsets[i] if offsets is not None else 0)
+            for token_id, start, length in runs:
+                if token_id in positions:
+                    positions[token_id].append(torch.arange(base + start, base + start + length))
+        positions = [x for group in positions.values() for x in group]
+        return torch.cat(positions) if positions else torch.zeros(0, dtype=torch.long)
+
+    def pad(
+            self,
+            input_ids_list: List[torch.LongTensor],
+            padding_side: str = 'left',
+            runs_list: Optional[List[List[Tuple[int, int, int]]]] = None,
+            token_ids: Sequence[int] = (),
+    ):
+        """Stack variable-length `input_ids` into a batch, like `tokenizer(..., padding=True)`.
+
+        When the `runs_list` returned by `encode` is given, the result also holds the `placement_index` of
+        `token_ids` in the padded batch.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        max_length = max(x.shape[0] for x in input_ids_list)
+        input_ids = torch.full((len(input_ids_list), max_length), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids_list), max_length), dtype=torch.long)
+        offsets = []
+        for i, ids in enumerate(input_ids_list):
+            if padding_side == 'left':
+                input_ids[i, max_length - ids.shape[0]:] = ids
+                attention_mask[i, max_length - ids.shape[0]:] = 1
+                offsets.append(max_length - ids.shape[0])
+            else:
+                input_ids[i, :ids.shape[0]] = ids
+                attention_mask[i, :ids.shape[0]] = 1
+                offsets.append(0)
+        model_inputs = dict(input_ids=input_ids, attention_mask=attention_mask)
+        if runs_list is not None:
+            model_inputs['placement_index'] = self.placement_index(runs_list, token_ids, max_length, offsets)
+        return model_inputs
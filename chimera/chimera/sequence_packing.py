@@ -0,0 +1,64 @@
+"""
+Sequence packing for training.
+
+With dynamic tiles a multimodal sample is anywhere between a few hundred and 8k+ tokens, so padding every sample to
+the longest one of the batch wastes most of the LLM compute. Instead the samples of a batch are concatenated into
+rows of at most `max_packed_tokens` tokens (`pack_samples`), the position ids restart at 0 for every sample, and the
+sample boundaries are given to the language model as `cu_seqlens` over the flattened (B * N) tokens: sample i owns
+tokens `cu_seqlens[i]:cu_seqlens[i + 1]`, and the padding at the end of a row is a sample of its own.
+
+Attention must not cross the boundaries: flash attention gets `cu_seqlens` through `flash_attn_varlen_func`, the
+other implementations the block-diagonal causal mask of `packed_causal_mask`.
+
+The visual inputs need no remapping: the samples keep their order, so the images, thumbnails and expert inputs of the
+batch, concatenated in sample order, still line up with the context tokens of the packed rows.
+"""
+
+from typing import List, Optional
+
+import torch
+
+
+def pack_samples(lengths: List[int], max_packed_tokens: Optional[int] = None) -> List[List[int]]:
+    """
+    Group consecutive samples into rows of at most `max_packed_tokens` tokens (all the samples in one row if None).
+    A sample longer than the budget gets a row of its own. Returns the sample indices of every row, in order.
+    """
+    rows, row_length = [], 0
+    for i, length in enumerate(lengths):
+        if not rows or (max_packed_tokens is not None and row_length + length > max_packed_tokens):
+            rows.append([])
+            row_length = 0
+        rows[-1].append(i)
+        row_length += length
+    return rows
+
+
+def get_max_seqlen(cu_seqlens: torch.Tensor) -> int:
+    return (cu_seqlens[1:] - cu_seqlens[:-1]).max().item()
+
+
+def packed_causal_mask(
+        cu_seqlens: torch.Tensor,
+        batch_size: int,
+        seq_length: int,
+        dtype: torch.dtype,
+        device: torch.device,
+        sliding_window: Optional[int] = None) -> torch.Tensor:
+    """
+    The (B, 1, N, N) additive mask of causal attention inside every packed sample, 0 where attention is allowed and
+    the dtype minimum elsewhere. With `sliding_window` a token only sees the last `sliding_window` tokens.
+    """
+    cu_seqlens = cu_seqlens.to(device)
+    assert cu_seqlens[-1].item() == batch_size * seq_length, \
+        f'cu_seqlens covers {cu_seqlens[-1].item()} tokens, but the input has {batch_size} x {seq_length}'
+    # 每个token所属样本的编号
+    token_index = torch.arange(batch_size * seq_length, dtype=cu_seqlens.dtype, device=device)
+    sample_ids = torch.searchsorted(cu_seqlens[1:], token_index, right=True)
+    sample_ids = sample_ids.view(batch_size, seq_length)
+    position = torch.arange(seq_length, device=device)
+    allowed = (sample_ids[:, :, None] == sample_ids[:, None, :]) & (position[None, :] <= position[:, None])
+    if sliding_window is not None:
+        allowed = allowed & (position[:, None] - position[None, :] <= sliding_window)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=device)
+    return mask.masked_fill_(~allowed, torch.finfo(dtype).min)[:, None]
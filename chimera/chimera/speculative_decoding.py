@@ -0,0 +1,242 @@
+"""
+Speculative decoding for the Chimera language models.
+
+Plain decoding runs the target model once per generated token. Here a smaller drafter (a smaller `ChimeraChatModel`,
+or only a language model sharing the tokenizer) proposes `num_draft_tokens` tokens autoregressively, and the target
+scores the last accepted token and all the proposals in a single forward. The proposals are then accepted left to
+right against the target distribution, and the first position that is not accepted is resampled from the target, so
+every round yields between 1 and `num_draft_tokens + 1` tokens for one target forward.
+
+Acceptance keeps the output distribution of the target:
+  - greedy: a proposal is accepted while it equals the argmax of the target, the first mismatch is replaced by the
+    target argmax, so the output is the one of greedy `generate` on the target;
+  - sampling: proposal x drafted with probability q(x) is accepted with probability min(1, p(x) / q(x)); on rejection
+    the token is sampled from max(0, p - q) renormalized, and if all proposals are accepted a bonus token is sampled
+    from p at the next position.
+p and q are computed after the same logits processors as HF `generate` (repetition penalty, no-repeat n-grams, bad
+words, min_new_tokens, temperature, top-k/p); other generation options are rejected unless they keep their default.
+
+Both models keep legacy `(key, value)` tuple caches, which are cropped back to the accepted prefix after every round.
+Only batch size 1 is supported.
+"""
+
+from typing import Dict, List, Optional, Union
+
+import torch
+from transformers import GenerationConfig
+from transformers.generation.logits_process import (
+    LogitsProcessorList, MinNewTokensLengthLogitsProcessor, NoBadWordsLogitsProcessor, NoRepeatNGramLogitsProcessor)
+
+from chimera.generation_engine import build_logits_processor
+
+# 不影响num_beams=1时生成结果的选项(token id、cache、只对beam search生效的选项等)；max_length被max_new_tokens覆盖
+_IGNORED_OPTIONS = {
+    'pad_token_id', 'bos_token_id', 'use_cache', 'max_length', 'length_penalty', 'early_stopping', 'num_beam_groups',
+    'return_legacy_cache', 'num_assistant_tokens', 'num_assistant_tokens_schedule', 'generation_kwargs',
+    '_from_model_config', 'transformers_version'}
+
+
+def _check_options(kwargs):
+    """Reject the generation options `speculative_generate` does not implement, unless they keep their default."""
+    defaults = GenerationConfig().to_dict()
+    unsupported = sorted(k for k, v in kwargs.items() if k not in _IGNORED_OPTIONS and defaults.get(k) != v)
+    assert len(unsupported) == 0, f'speculative decoding does not support the generation options {unsupported}'
+
+
+def _forward(language_model, past_key_values, input_ids=None, inputs_embeds=None, num_logits: int = 1):
+    """One cached forward, returns the float logits of the last `num_logits` positions and the legacy cache."""
+    outputs = language_model(
+        input_ids=input_ids,
+        inputs_embeds=inputs_embeds,
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=True)
+    past_key_values = outputs.past_key_values
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        past_key_values = past_key_values.to_legacy_cache()
+    return outputs.logits[0, -num_logits:].float(), past_key_values
+
+
+def _crop(past_key_values, length: int):
+    """Keep the first `length` positions of a legacy cache."""
+    if past_key_values[0][0].shape[2] == length:
+        return past_key_values
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def _process(logits_processor: LogitsProcessorList, output_ids: List[int], logits: torch.FloatTensor):
+    """Apply the logits processors to the (vocab,) logits following the generated tokens `output_ids`."""
+    if len(logits_processor) == 0:
+        return logits
+    output_ids = torch.tensor([output_ids], dtype=torch.long, device=logits.device)
+    return logits_processor(output_ids, logits[None])[0]
+
+
+def _align_vocab(logits: torch.FloatTensor, vocab_size: int) -> torch.FloatTensor:
+    """Crop or pad (with -inf) the drafter logits to the vocabulary of the target."""
+    if logits.shape[-1] >= vocab_size:
+        return logits[..., :vocab_size]
+    pad = logits.new_full((*logits.shape[:-1], vocab_size - logits.shape[-1]), float('-inf'))
+    return torch.cat([logits, pad], dim=-1)
+
+
+@torch.no_grad()
+def speculative_generate(
+        target_model,
+        draft_model,
+        inputs_embeds: torch.FloatTensor,
+        draft_inputs_embeds: Optional[torch.FloatTensor] = None,
+        draft_input_ids: Optional[torch.LongTensor] = None,
+        num_draft_tokens: int = 4,
+        max_new_tokens: int = 512,
+        eos_token_id: Union[int, List[int], None] = None,
+        do_sample: bool = False,
+        temperature: float = 1.0,
+        top_k: int = 0,
+        top_p: float = 1.0,
+        repetition_penalty: float = 1.0,
+        min_new_tokens: Optional[int] = None,
+        no_repeat_ngram_size: int = 0,
+        bad_words_ids: Optional[List[List[int]]] = None,
+        stopping_criteria=None,
+        streamer=None,
+        stats: Optional[Dict[str, int]] = None,
+        **kwargs) -> torch.LongTensor:
+    """
+    Generate up to `max_new_tokens` tokens with `target_model` for the (1, L) prompt `inputs_embeds`, drafting with
+    `draft_model`. Returns the (1, T) generated tokens, like `generate` called with `inputs_embeds`.
+
+    Args:
+        target_model / draft_model: the two language models (`InternLM2ForCausalLM`, `Phi3ForCausalLM`, ...), with
+            the same tokenizer.
+        draft_inputs_embeds / draft_input_ids: the same prompt for the drafter, as embeddings or token ids.
+        stopping_criteria: a `StoppingCriteriaList`, checked on the generated tokens after every round.
+        stats: if given, `rounds`, `drafted` and `accepted` are accumulated into it.
+        kwargs: other `generate` options, which must keep their default value.
+    """
+    assert inputs_embeds.shape[0] == 1, f'speculative decoding supports batch size 1, got {inputs_embeds.shape[0]}'
+    assert (draft_inputs_embeds is None) != (draft_input_ids is None), \
+        'exactly one of draft_inputs_embeds and draft_input_ids is needed'
+    assert kwargs.get('num_beams', 1) == 1, 'speculative decoding does not support beam search'
+    _check_options(kwargs)
+    assert num_draft_tokens >= 1, f'num_draft_tokens must be positive, got {num_draft_tokens}'
+    eos_token_ids = set([] if eos_token_id is None else [eos_token_id] if isinstance(eos_token_id, int) else eos_token_id)
+    logits_processor = build_logits_processor(do_sample, temperature, top_k, top_p, repetition_penalty)
+    # 与HF generate相同的顺序：重复惩罚之后、temperature/top-k/top-p之前
+    processors = []
+    if no_repeat_ngram_size is not None and no_repeat_ngram_size > 0:
+        processors.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+    if bad_words_ids is not None:
+        processors.append(NoBadWordsLogitsProcessor(bad_words_ids, eos_token_id))
+    if min_new_tokens is not None and min_new_tokens > 0 and len(eos_token_ids) > 0:
+        processors.append(MinNewTokensLengthLogitsProcessor(0, min_new_tokens, list(eos_token_ids), device=inputs_embeds.device))
+    index = 1 if repetition_penalty is not None and repetition_penalty != 1.0 else 0
+    logits_processor[index:index] = processors
+    vocab_size = target_model.get_output_embeddings().weight.shape[0]
+    draft_device = draft_model.get_input_embeddings().weight.device
+    if stats is None:
+        stats = {}
+    for key in ('rounds', 'drafted', 'accepted'):
+        stats.setdefault(key, 0)
+
+    def choose(logits):
+        if do_sample:
+            probs = logits.softmax(-1)
+            return torch.multinomial(probs, num_samples=1).item(), probs
+        return logits.argmax(-1).item(), None
+
+    if streamer is not None:
+        # 与HF generate一致：先put空的prompt
+        streamer.put(torch.empty((1, 0), dtype=torch.long))
+
+    # prefill：target给出第一个token，drafter只建立cache
+    logits, target_past = _forward(target_model, None, inputs_embeds=inputs_embeds)
+    token, _ = choose(_process(logits_processor, [], logits[-1]))
+    _, draft_past = _forward(
+        draft_model, None,
+        input_ids=draft_input_ids.to(draft_device) if draft_input_ids is not None else None,
+        inputs_embeds=draft_inputs_embeds.to(draft_device) if draft_inputs_embeds is not None else None)
+    target_prompt = inputs_embeds.shape[1]
+    draft_prompt = (draft_input_ids if draft_input_ids is not None else draft_inputs_embeds).shape[1]
+    target_length, draft_length = target_prompt, draft_prompt
+    output_ids = [token]
+    if streamer is not None:
+        streamer.put(torch.tensor([token]))
+
+    def should_stop():
+        if stopping_criteria is None:
+            return False
+        return bool(stopping_criteria(torch.tensor([output_ids], device=inputs_embeds.device), None).all())
+
+    while len(output_ids) < max_new_tokens and output_ids[-1] not in eos_token_ids and not should_stop():
+        # 最后一轮只需要剩余的token数，target总会额外给出1个
+        num_draft = min(num_draft_tokens, max_new_tokens - len(output_ids) - 1)
+
+        # drafter逐个提议；第一步输入它cache中还没有的所有token(1个或2个)
+        draft_ids, draft_probs = [], []
+        pending = output_ids[draft_length - draft_prompt:]
+        for _ in range(num_draft):
+            logits, draft_past = _forward(
+                draft_model, draft_past, input_ids=torch.tensor([pending], dtype=torch.long, device=draft_device))
+            draft_length += len(pending)
+            logits = _align_vocab(logits[-1].to(inputs_embeds.device), vocab_size)
+            token, probs = choose(_process(logits_processor, output_ids + draft_ids, logits))
+            draft_ids.append(token)
+            draft_probs.append(probs)
+            pending = [token]
+
+        # target一次前向验证：输入最后一个token和全部提议，得到num_draft + 1个位置的logits
+        verify_ids = output_ids[target_length - target_prompt:] + draft_ids
+        logits, target_past = _forward(
+            target_model, target_past,
+            input_ids=torch.tensor([verify_ids], dtype=torch.long, device=inputs_embeds.device),
+            num_logits=num_draft + 1)
+        target_length += len(verify_ids)
+
+        new_ids = []
+        for i in range(num_draft + 1):
+            target_logits = _process(logits_processor, output_ids + new_ids, logits[i])
+            if i == num_draft:
+                # 全部接受，从target的下一个位置额外取一个token
+                new_ids.append(choose(target_logits)[0])
+                break
+            if not do_sample:
+                token = target_logits.argmax(-1).item()
+                new_ids.append(token)
+                if token != draft_ids[i]:
+                    break
+                continue
+            p, q = target_logits.softmax(-1), draft_probs[i]
+            x = draft_ids[i]
+            if torch.rand(()).item() * q[x].item() < p[x].item():
+                new_ids.append(x)
+                continue
+            # 拒绝：从max(0, p - q)重新采样
+            residual = (p - q).clamp(min=0)
+            if residual.sum() <= 0:
+                residual = p
+            new_ids.append(torch.multinomial(residual, num_samples=1).item())
+            break
+        stats['rounds'] += 1
+        stats['drafted'] += num_draft
+        stats['accepted'] += len(new_ids) - 1
+
+        for i, token in enumerate(new_ids):
+            if token in eos_token_ids:
+                new_ids = new_ids[:i + 1]
+                break
+        new_ids = new_ids[:max_new_tokens - len(output_ids)]
+        output_ids += new_ids
+        if streamer is not None:
+            streamer.put(torch.tensor(new_ids))
+
+        # 两个cache都只保留已接受的前缀，最后一个输出的token下一轮再输入
+        valid_length = len(output_ids) - 1
+        target_length = min(target_length, target_prompt + valid_length)
+        target_past = _crop(target_past, target_length)
+        draft_length = min(draft_length, draft_prompt + valid_length)
+        draft_past = _crop(draft_past, draft_length)
+
+    if streamer is not None:
+        streamer.end()
+    return torch.tensor([output_ids], dtype=torch.long, device=inputs_embeds.device)
@@ -0,0 +1,182 @@
+"""
+Preallocated (static) KV cache and a compile-friendly decode loop for InternLM2.
+
+With the legacy `(key, value)` tuples every decode step re-allocates the keys/values of every layer with `torch.cat`
+and `InternLM2Model` rebuilds the 4D mask from the 2D one. `StaticKVCache` allocates (B, H, max_length, D) buffers
+once; each forward writes its keys/values in place at `cache_position` and the attention layers always see the whole
+buffer, so every decode step has the same shapes. The sequences of a batch are not padded: causality follows from
+`cache_position` alone (a fixed-shape comparison in eager attention; flash attention reads the whole buffer with
+`flash_attn_with_kvcache` and the filled length `seq_lens`, a device tensor, as `cache_seqlens`).
+
+`StaticCacheDecoder` runs greedy generation on top of it; with `compile=True` the single-token decode step is wrapped
+with `torch.compile` and is compiled once, since only the values (not the shapes) of its inputs change between steps.
+"""
+
+from typing import List, Optional, Tuple, Union
+
+import torch
+from transformers.cache_utils import Cache
+
+
+class StaticLayerCache:
+    """View of one layer of a `StaticKVCache`, passed to the InternLM2 attention layers as `past_key_value`."""
+
+    def __init__(self, cache: 'StaticKVCache', layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def get_kv_length(self, q_len: int) -> int:
+        return self.cache.max_length
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache.update(key_states, value_states, self.layer_idx)
+
+
+class StaticKVCache(Cache):
+    """
+    KV cache preallocated to `max_length` tokens for `batch_size` unpadded sequences.
+
+    `InternLM2Model.forward` sets `cache_position` (the positions of the new tokens) before running the layers.
+    """
+
+    def __init__(
+            self,
+            num_layers: int,
+            num_key_value_heads: int,
+            head_dim: int,
+            max_length: int,
+            batch_size: int = 1,
+            dtype: torch.dtype = torch.float16,
+            device: Optional[torch.device] = None):
+        super().__init__()
+        self.num_layers = num_layers
+        self.max_length = max_length
+        self.batch_size = batch_size
+        shape = (batch_size, num_key_value_heads, max_length, head_dim)
+        self.key_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.key_positions = torch.arange(max_length, device=device)
+        # 已写入的长度，放在device上避免host同步；flash attention直接用作cache_seqlens
+        self.seq_lens = torch.zeros(batch_size, dtype=torch.int32, device=device)
+
+        # 本次forward的状态，由InternLM2Model.forward设置
+        self.cache_position = None
+
+    @classmethod
+    def from_config(cls, config, max_length: int, batch_size: int = 1, dtype=torch.float16, device=None):
+        num_key_value_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+        return cls(
+            num_layers = config.num_hidden_layers,
+            num_key_value_heads = num_key_value_heads,
+            head_dim = config.hidden_size // config.num_attention_heads,
+            max_length = max_length,
+            batch_size = batch_size,
+            dtype = dtype,
+            device = device)
+
+    def __len__(self):
+        return self.num_layers
+
+    def __getitem__(self, layer_idx: int) -> StaticLayerCache:
+        return StaticLayerCache(self, layer_idx)
+
+    def causal_mask(self, cache_position: torch.LongTensor, dtype: torch.dtype) -> torch.Tensor:
+        """(B, 1, q_len, max_length) additive mask: query at position p sees the keys at positions <= p."""
+        mask = self.key_positions[None, :] > cache_position[:, None]
+        mask = torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(mask, torch.finfo(dtype).min)
+        return mask[None, None].expand(self.batch_size, 1, -1, -1)
+
+    def update(
+            self,
+            key_states: torch.Tensor,
+            value_states: torch.Tensor,
+            layer_idx: int,
+            cache_kwargs=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write the (B, H, q_len, D) new keys/values at `cache_position`, return the (B, H, max_length, D) buffers."""
+        k_out, v_out = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        k_out.index_copy_(2, self.cache_position, key_states.to(k_out.dtype))
+        v_out.index_copy_(2, self.cache_position, value_states.to(v_out.dtype))
+        if layer_idx == 0:
+            # cache复用时从头写入，长度取本次最后一个位置而不是历史最大值
+            self.seq_lens = (self.cache_position.max() + 1).to(torch.int32).repeat(self.batch_size)
+        return k_out, v_out
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return int(self.seq_lens[0])
+
+    def get_max_length(self) -> Optional[int]:
+        return self.max_length
+
+
+class StaticCacheDecoder:
+    """
+    Greedy generation for `InternLM2ForCausalLM` on a `StaticKVCache` reused across calls.
+
+    Args:
+        language_model: the InternLM2 backbone.
+        max_length: prompt + generated tokens the cache can hold.
+        compile: wrap the decode step with `torch.compile`.
+    """
+
+    def __init__(self, language_model, max_length: int, batch_size: int = 1, compile: bool = False, **compile_kwargs):
+        self.language_model = language_model
+        self.device = language_model.get_input_embeddings().weight.device
+        self.cache = StaticKVCache.from_config(
+            language_model.config, max_length,
+            batch_size = batch_size,
+            dtype = language_model.get_input_embeddings().weight.dtype,
+            device = self.device)
+        self.decode_step = self._decode_step
+        if compile:
+            compile_kwargs.setdefault('dynamic', False)
+            self.decode_step = torch.compile(self._decode_step, **compile_kwargs)
+
+    def _forward(self, cache_position, input_ids=None, inputs_embeds=None):
+        batch_size = (input_ids if input_ids is not None else inputs_embeds).shape[0]
+        outputs = self.language_model(
+            input_ids=input_ids,
+            inputs_embeds=inputs_embeds,
+            position_ids=cache_position[None].expand(batch_size, -1),
+            cache_position=cache_position,
+            past_key_values=self.cache,
+            use_cache=True,
+            return_dict=True)
+        return outputs.logits[:, -1, :].argmax(-1)
+
+    def _decode_step(self, input_ids: torch.LongTensor, cache_position: torch.LongTensor) -> torch.LongTensor:
+        return self._forward(cache_position, input_ids=input_ids)
+
+    @torch.no_grad()
+    def generate(
+            self,
+            input_ids: Optional[torch.LongTensor] = None,
+            inputs_embeds: Optional[torch.FloatTensor] = None,
+            max_new_tokens: int = 512,
+            eos_token_id: Union[int, List[int], None] = None) -> torch.LongTensor:
+        """Generate up to `max_new_tokens` for the (B, L) `input_ids` or (B, L, C) `inputs_embeds`, returns (B, T)."""
+        assert (inputs_embeds is None) != (input_ids is None), 'exactly one of inputs_embeds and input_ids is needed'
+        prompt = input_ids if input_ids is not None else inputs_embeds
+        batch_size, length = prompt.shape[:2]
+        assert batch_size == self.cache.batch_size, \
+            f'the cache was allocated for {self.cache.batch_size} sequences, got {batch_size}'
+        assert length + max_new_tokens <= self.cache.max_length, \
+            f'{length} prompt + {max_new_tokens} new tokens do not fit in a cache of {self.cache.max_length}'
+        eos_token_ids = [] if eos_token_id is None else [eos_token_id] if isinstance(eos_token_id, int) else eos_token_id
+        eos_token_ids = torch.tensor(eos_token_ids, dtype=torch.long, device=self.device)
+
+        token = self._forward(torch.arange(length, device=self.device), input_ids=input_ids, inputs_embeds=inputs_embeds)
+        output_ids = [token]
+        finished = torch.isin(token, eos_token_ids)
+        # cache_position放在device上逐步原地+1，decode step的输入形状不变
+        cache_position = torch.tensor([length], dtype=torch.long, device=self.device)
+        for _ in range(max_new_tokens - 1):
+            if finished.all():
+                break
+            token = self.decode_step(token[:, None], cache_position.clone()).clone()
+            # 已结束的序列继续输出eos
+            if len(eos_token_ids) > 0:
+                token = torch.where(finished, eos_token_ids[0], token)
+            output_ids.append(token)
+            finished |= torch.isin(token, eos_token_ids)
+            cache_position += 1
+        return torch.stack(output_ids, dim=1)
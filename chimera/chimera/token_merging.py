@@ -0,0 +1,75 @@
+"""
+Similarity-based merging of the visual tokens of a tile.
+
+Every InternViT tile gives `num_image_token` (256) tokens after `pixel_shuffle`, and the LLM prefill and KV cache
+scale with them. Neighbouring tokens of documents and charts are often near duplicates (blank margins, flat
+backgrounds), so `merge_tokens` merges the most similar ones down to a fixed budget with bipartite soft matching
+(ToMe): the tokens are split into two alternating sets, every token of the first set is matched to its most similar
+(cosine) token of the second one, and the `r` best matched pairs are averaged. A round removes at most half of the
+tokens; rounds are repeated until the budget is met.
+
+Merged tokens are size weighted averages (a token standing for k original tokens counts k times in later merges)
+and the kept tokens stay in raster order, so the LLM still sees the tile row by row.
+"""
+
+from typing import Optional, Tuple
+
+import torch
+
+
+def _bipartite_merge(
+        x: torch.Tensor,
+        size: torch.Tensor,
+        position: torch.Tensor,
+        r: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Merge `r` tokens of every (T, C) row of `x` into their most similar token, one round of ToMe."""
+    batch_size, _, channels = x.shape
+    metric = x / x.norm(dim=-1, keepdim=True).clamp(min=1e-6)
+    scores = metric[:, ::2] @ metric[:, 1::2].transpose(1, 2)
+    node_max, node_idx = scores.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    # 相似度最高的r个源token合并进对应的目标token，其余源token保留
+    unmerged_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]
+    dst_idx = node_idx.gather(1, src_idx)
+
+    x_a, x_b = x[:, ::2], x[:, 1::2]
+    size_a, size_b = size[:, ::2], size[:, 1::2]
+    weighted_src = (x_a * size_a).gather(1, src_idx[..., None].expand(-1, -1, channels))
+    size_src = size_a.gather(1, src_idx[..., None])
+    x_b = (x_b * size_b).scatter_add(1, dst_idx[..., None].expand(-1, -1, channels), weighted_src)
+    size_b = size_b.scatter_add(1, dst_idx[..., None], size_src)
+    x_b = x_b / size_b
+
+    x = torch.cat([x_a.gather(1, unmerged_idx[..., None].expand(-1, -1, channels)), x_b], dim=1)
+    size = torch.cat([size_a.gather(1, unmerged_idx[..., None]), size_b], dim=1)
+    position = torch.cat([position[:, ::2].gather(1, unmerged_idx), position[:, 1::2]], dim=1)
+    # 按原始位置排序，保持光栅顺序
+    order = position.argsort(dim=-1)
+    x = x.gather(1, order[..., None].expand(-1, -1, channels))
+    size = size.gather(1, order[..., None])
+    return x, size, position.gather(1, order)
+
+
+def merge_tokens(x: torch.Tensor, budget: int, size: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Merge the (N, T, C) tokens of every tile down to (N, budget, C).
+
+    Args:
+        x: token features, also used as the similarity metric.
+        budget: number of tokens kept per tile.
+        size: (N, T, 1) number of original tokens each token stands for, all ones by default.
+    """
+    batch_size, num_tokens, _ = x.shape
+    assert 0 < budget, f'the visual token budget must be positive, got {budget}'
+    if num_tokens <= budget:
+        return x
+    dtype = x.dtype
+    # 相似度和加权平均用fp32计算
+    x = x.float()
+    size = x.new_ones(batch_size, num_tokens, 1) if size is None else size.float()
+    position = torch.arange(num_tokens, device=x.device).expand(batch_size, -1)
+    while num_tokens > budget:
+        r = min(num_tokens - budget, num_tokens // 2)
+        x, size, position = _bipartite_merge(x, size, position, r)
+        num_tokens -= r
+    return x.to(dtype)
@@ -16,6 +16,8 @@ import torchvision.transforms as T
 import transformers
 from decord import VideoReader
 from chimera.conversation import get_conv_template
+from chimera.image_tiling import find_closest_aspect_ratio, get_target_ratios
+from chimera.prompt_builder import IMAGE_PLACEHOLDER, PromptBuilder
 from PIL import Image
 from torch.utils.data import ConcatDataset, WeightedRandomSampler
 from torchvision.transforms.functional import InterpolationMode
@@ -35,6 +37,7 @@ try:
 except ImportError as E:
     print('petrel_client is not installed. If you read data locally instead of from ceph, ignore it.')
 import sys
+from itertools import islice
 
 
 def get_frame_indices(num_frames, vlen, sample='rand', fix_start=None, input_fps=1, max_num_frames=-1):
@@ -289,6 +292,58 @@ def build_transform(is_train, input_size, pad2square=False, normalize_type='imag
     return transform
 
 
+def build_image_spans(
+        prompt_builder: PromptBuilder,
+        num_image: int,
+        num_image_token_list: list,
+        domain_context_token = None,
+        num_sci_token_list = None,
+) -> list:
+    image_spans = []
+    for i in range(num_image):
+        if domain_context_token and num_sci_token_list and num_sci_token_list[i]:
+            num_domain_token = num_sci_token_list[i]
+        else:
+            num_domain_token = 0
+        image_spans.append(prompt_builder.image_span(
+            num_image_token_list[i], domain_context_token, num_domain_token,
+            IMG_START_TOKEN=IMG_START_TOKEN, IMG_END_TOKEN=IMG_END_TOKEN, IMG_CONTEXT_TOKEN=IMG_CONTEXT_TOKEN,
+            DOMAIN_START_TOKEN=DOMAIN_START_TOKEN, DOMAIN_END_TOKEN=DOMAIN_END_TOKEN))
+    return image_spans
+
+
+def encode_conversations(prompt_builder: PromptBuilder, conversations: list, image_spans: list, max_length: int):
+    """
+    Stacked `input_ids` of the conversations, and the (R, 3) (token_id, start, length) runs of the context tokens
+    (`<IMG_CONTEXT>` and the domain context token) in the first one, from which the collators build the
+    `placement_index` of the batch.
+    """
+    # span为[<img>, ctx, </img>, <domain>, domain ctx, </domain>]
+    context_token_ids = {token_id for span in image_spans for token_id, _ in span[1::3]}
+    input_ids, context_runs = [], None
+    for conversation in conversations:
+        ids, runs = prompt_builder.encode(conversation, image_spans, max_length=max_length, return_runs=True)
+        input_ids.append(ids)
+        if context_runs is None:
+            runs = [run for run in runs if run[0] in context_token_ids and run[2] > 0]
+            context_runs = torch.tensor(runs, dtype=torch.long).reshape(-1, 3)
+    return torch.stack(input_ids), context_runs
+
+
+def build_outputs(input_ids, targets, pad_token_id, use_packed_ds: bool = False, context_runs=None) -> Dict:
+    outputs = dict(
+        input_ids=input_ids,
+        labels=targets,
+        attention_mask=input_ids.ne(pad_token_id),
+    )
+    if context_runs is not None:
+        outputs['context_runs'] = context_runs
+    if use_packed_ds:
+        # 打包训练(packed_data_collator)按样本拼接，位置编号在每个样本内从0开始
+        outputs['position_ids'] = torch.arange(input_ids.shape[1]).expand_as(input_ids)
+    return outputs
+
+
 def preprocess(
         template_name,
         sources,
@@ -317,24 +372,12 @@ def preprocess(
             conv.append_message(role, sentence['value'])
         conversations.append(conv.get_prompt())
 
-    if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
+    # Image placeholders are expanded into token-id runs by the prompt builder instead of the tokenizer
+    prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+    image_spans = [] if text_only else build_image_spans(prompt_builder, num_image, num_image_token_list)
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
-        # padding=False if group_by_length or use_packed_ds else 'max_length',
-        padding=False ,
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    input_ids, context_runs = encode_conversations(prompt_builder, conversations, image_spans, tokenizer.model_max_length)
     targets = input_ids.clone()
 
     # assert conv.sep_style == SeparatorStyle.ADD_COLON_TWO
@@ -343,6 +386,7 @@ def preprocess(
     sep = conv.sep + conv.roles[1] + ': '
     for conversation, target in zip(conversations, targets):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())
+        image_iter = iter(image_spans)
 
         turns = conversation.split(conv.sep2)
         cur_len = 1
@@ -350,14 +394,15 @@ def preprocess(
         for i, turn in enumerate(turns):
             if turn == '':
                 break
-            turn_len = len(tokenizer(turn).input_ids)
+            turn_spans = list(islice(image_iter, turn.count(IMAGE_PLACEHOLDER)))
+            turn_len = prompt_builder.num_tokens(turn, turn_spans)
 
             parts = turn.split(sep)
             if len(parts) != 2:
                 break
             parts[0] += sep
             # "-2" is hardcoded for the Llama tokenizer to make the offset correct.
-            instruction_len = len(tokenizer(parts[0]).input_ids) - 2
+            instruction_len = prompt_builder.num_tokens(parts[0], turn_spans) - 2
 
             if i != 0 and not tokenizer.legacy:
                 # The legacy and non-legacy modes handle special tokens differently
@@ -388,11 +433,7 @@ def preprocess(
                 )
                 sys.stdout.flush()
 
-    return dict(
-        input_ids=input_ids,
-        labels=targets,
-        attention_mask=input_ids.ne(tokenizer.pad_token_id),
-    )
+    return build_outputs(input_ids, targets, tokenizer.pad_token_id, use_packed_ds, context_runs)
 
 
 def preprocess_mpt(
@@ -428,37 +469,20 @@ def preprocess_mpt(
             conv.append_message(role, sentence['value'])
         conversations.append(conv.get_prompt())
 
-    if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-
-                
-                if domain_context_token and num_sci_token_list and num_sci_token_list[i]:
-                    image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}{DOMAIN_START_TOKEN}{domain_context_token * num_sci_token_list[i]}{DOMAIN_END_TOKEN}'
-                else:
-                    image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                
-                # image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
+    # Image placeholders are expanded into token-id runs by the prompt builder instead of the tokenizer
+    prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+    image_spans = [] if text_only else build_image_spans(
+        prompt_builder, num_image, num_image_token_list, domain_context_token, num_sci_token_list)
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
-        # padding=False if group_by_length or use_packed_ds else 'max_length',
-        padding=False ,
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    input_ids, context_runs = encode_conversations(prompt_builder, conversations, image_spans, tokenizer.model_max_length)
     targets = input_ids.clone()
 
     # Mask targets. Only compute loss on the assistant outputs.
     sep = conv.sep + conv.roles[1]  # <|im_end|><|im_start|>assistant\n
     for conversation, target in zip(conversations, targets):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())
+        image_iter = iter(image_spans)
 
         turns = conversation.split(conv.sep)
         re_turns = [conv.sep.join(turns[:3])]  # system + user + gpt
@@ -469,13 +493,14 @@ def preprocess_mpt(
         for i, turn in enumerate(re_turns):
             if turn == '':
                 break
-            turn_len = len(tokenizer(turn).input_ids) + 1
+            turn_spans = list(islice(image_iter, turn.count(IMAGE_PLACEHOLDER)))
+            turn_len = prompt_builder.num_tokens(turn, turn_spans) + 1
 
             parts = turn.split(sep)
             if len(parts) != 2:
                 break
             parts[0] += sep
-            instruction_len = len(tokenizer(parts[0]).input_ids)
+            instruction_len = prompt_builder.num_tokens(parts[0], turn_spans)
 
             # Ignore the user instructions
             target[cur_len: cur_len + instruction_len] = IGNORE_TOKEN_ID
@@ -495,11 +520,7 @@ def preprocess_mpt(
                 )
                 sys.stdout.flush()
 
-    return dict(
-        input_ids=input_ids,
-        labels=targets,
-        attention_mask=input_ids.ne(tokenizer.pad_token_id),
-    )
+    return build_outputs(input_ids, targets, tokenizer.pad_token_id, use_packed_ds, context_runs)
 
 
 # def preprocess_phi3(
@@ -645,37 +666,20 @@ def preprocess_phi3(
         conversations.append(conv.get_prompt())
 
 
-    if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                
-                if domain_context_token and num_sci_token_list and num_sci_token_list[i]:
-                    image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}{DOMAIN_START_TOKEN}{domain_context_token * num_sci_token_list[i]}{DOMAIN_END_TOKEN}'
-                else:
-                    image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
-
+    # Image placeholders are expanded into token-id runs by the prompt builder instead of the tokenizer
+    prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+    image_spans = [] if text_only else build_image_spans(
+        prompt_builder, num_image, num_image_token_list, domain_context_token, num_sci_token_list)
 
     # Tokenize conversations
-    tokenizer.padding_side = 'right'
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
-        # padding=False if group_by_length or use_packed_ds else 'max_length',
-        padding=False ,
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    input_ids, context_runs = encode_conversations(prompt_builder, conversations, image_spans, tokenizer.model_max_length)
     targets = input_ids.clone()
 
     # Mask targets. Only compute loss on the assistant outputs.
     sep = conv.sep + conv.roles[1]  # <|end|>\n<|assistant|>
     for conversation, target in zip(conversations, targets):
         total_len = int(target.ne(int(tokenizer.pad_token_id)).sum())
+        image_iter = iter(image_spans)
 
         turns = conversation.split(conv.sep)
         re_turns = [conv.sep.join(turns[:3])]  # system + user + gpt
@@ -689,19 +693,20 @@ def preprocess_phi3(
         for i, turn in enumerate(re_turns):
             if turn == '':
                 break
+            turn_spans = list(islice(image_iter, turn.count(IMAGE_PLACEHOLDER)))
             if i == 0:
-                turn_len = len(tokenizer(turn).input_ids)
+                turn_len = prompt_builder.num_tokens(turn, turn_spans)
             else:
-                turn_len = len(tokenizer(turn).input_ids) - 1
+                turn_len = prompt_builder.num_tokens(turn, turn_spans) - 1
             parts = turn.split(sep)
             if len(parts) != 2:
                 break
             parts[0] += sep
 
             if i == 0:
-                instruction_len = len(tokenizer(parts[0]).input_ids) - 1
+                instruction_len = prompt_builder.num_tokens(parts[0], turn_spans) - 1
             else:
-                instruction_len = len(tokenizer(parts[0]).input_ids) - 2
+                instruction_len = prompt_builder.num_tokens(parts[0], turn_spans) - 2
 
             # Ignore the user instructions
             target[cur_len: cur_len + instruction_len] = IGNORE_TOKEN_ID
@@ -726,11 +731,7 @@ def preprocess_phi3(
                 )
                 sys.stdout.flush()
 
-    return dict(
-        input_ids=input_ids,
-        labels=targets,
-        attention_mask=input_ids.ne(tokenizer.pad_token_id),
-    )
+    return build_outputs(input_ids, targets, tokenizer.pad_token_id, use_packed_ds, context_runs)
 
 def preprocess_internlm(
         template_name,
@@ -767,30 +768,13 @@ def preprocess_internlm(
         conversations.append(conv.get_prompt())
 
 
-    if not text_only:
-        new_conversations = []
-        for conversation in conversations:
-            for i in range(num_image):
-                
-                if domain_context_token and num_sci_token_list and num_sci_token_list[i]:
-                    image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}{DOMAIN_START_TOKEN}{domain_context_token * num_sci_token_list[i]}{DOMAIN_END_TOKEN}'
-                else:
-                    image_tokens = f'{IMG_START_TOKEN}{IMG_CONTEXT_TOKEN * num_image_token_list[i]}{IMG_END_TOKEN}'
-                
-                conversation = conversation.replace('<image>', image_tokens, 1)
-            new_conversations.append(conversation)
-        conversations = new_conversations
-    
+    # Image placeholders are expanded into token-id runs by the prompt builder instead of the tokenizer
+    prompt_builder = PromptBuilder.from_tokenizer(tokenizer)
+    image_spans = [] if text_only else build_image_spans(
+        prompt_builder, num_image, num_image_token_list, domain_context_token, num_sci_token_list)
 
     # Tokenize conversations
-    input_ids = tokenizer(
-        conversations,
-        return_tensors='pt',
-        # padding=False if group_by_length or use_packed_ds else 'max_length',
-        padding=False ,
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-    ).input_ids
+    input_ids, context_runs = encode_conversations(prompt_builder, conversations, image_spans, tokenizer.model_max_length)
 
     
     # if input_ids.size(1)>max_len:
@@ -800,25 +784,27 @@ def preprocess_internlm(
 
     for conversation, target in zip(conversations, targets):
         total_len = int(target.ne(tokenizer.pad_token_id).sum())  # 浦语里面 pad_token_id = eos_token_id
+        # 各段按顺序消耗对应的image span
+        image_iter = iter(image_spans)
         cur_len = 1
         target[:cur_len] = IGNORE_TOKEN_ID  # <s>
         parts = conversation.split(conv.roles[1])  # [UNUSED_TOKEN_146]assistant\n
         info = parts[0] + conv.roles[1]
-        temp_len = len(tokenizer(info).input_ids) - 1  # 去除tokenizer的<s>
+        temp_len = prompt_builder.num_tokens(info, image_iter) - 1  # 去除tokenizer的<s>
         target[cur_len: cur_len + temp_len] = IGNORE_TOKEN_ID
         cur_len = cur_len + temp_len
 
         for index in range(1, len(parts) - 1):
             info = parts[index]
             part1, part2 = info.split(conv.roles[0])
-            temp_len = len(tokenizer(part1).input_ids) - 1
+            temp_len = prompt_builder.num_tokens(part1, image_iter) - 1
             cur_len = cur_len + temp_len
             part = conv.roles[0] + part2 + conv.roles[1]
-            temp_len = len(tokenizer(part).input_ids) - 1
+            temp_len = prompt_builder.num_tokens(part, image_iter) - 1
             target[cur_len: cur_len + temp_len] = IGNORE_TOKEN_ID
             cur_len = cur_len + temp_len
         last_info = parts[-1]
-        temp_len = len(tokenizer(last_info).input_ids) - 1
+        temp_len = prompt_builder.num_tokens(last_info, image_iter) - 1
         cur_len = cur_len + temp_len
 
         target[cur_len:] = IGNORE_TOKEN_ID
@@ -834,28 +820,7 @@ def preprocess_internlm(
                 print(f'WARNING: tokenization mismatch: {cur_len} vs. {total_len}. This dataset is {ds_name}.')
                 sys.stdout.flush()
 
-    return dict(
-        input_ids=input_ids,
-        labels=targets,
-        attention_mask=input_ids.ne(tokenizer.pad_token_id),
-    )
-
-
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
-    return best_ratio
+    return build_outputs(input_ids, targets, tokenizer.pad_token_id, use_packed_ds, context_runs)
 
 
 def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
@@ -863,10 +828,7 @@ def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnai
     aspect_ratio = orig_width / orig_height
 
     # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_ratios = get_target_ratios(min_num, max_num)
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
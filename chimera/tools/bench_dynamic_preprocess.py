@@ -0,0 +1,57 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from chimera.chimera_infer import build_transform, dynamic_preprocess, load_image
+from PIL import Image
+
+argparse = argparse.ArgumentParser()
+argparse.add_argument('--image', type=str, nargs='*', default=[], help='images to benchmark, random images if empty')
+argparse.add_argument('--max-num', type=int, default=12)
+argparse.add_argument('--input-size', type=int, default=448)
+argparse.add_argument('--repeat', type=int, default=10)
+argparse.add_argument('--num-threads', type=int, default=None)
+
+args = argparse.parse_args()
+
+if args.num_threads is not None:
+    torch.set_num_threads(args.num_threads)
+
+
+def load_image_pil(image, input_size=448, max_num=12):
+    # 原始实现：PIL切tile后逐个tile做transform
+    transform = build_transform(input_size=input_size)
+    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
+    return torch.stack([transform(image) for image in images])
+
+
+if args.image:
+    images = [Image.open(x).convert('RGB') for x in args.image]
+else:
+    rng = np.random.RandomState(0)
+    sizes = [(448, 448), (800, 600), (1280, 720), (1920, 1080), (1000, 3000), (2480, 3508)]
+    images = [Image.fromarray(rng.randint(0, 255, (h, w, 3), dtype=np.uint8)) for w, h in sizes]
+
+
+def bench(fn, image):
+    fn(image, input_size=args.input_size, max_num=args.max_num)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        out = fn(image, input_size=args.input_size, max_num=args.max_num)
+    return (time.perf_counter() - start) / args.repeat * 1000, out
+
+
+print(f'{"size":>12} {"tiles":>6} {"pil(ms)":>9} {"tensor(ms)":>11} {"speedup":>8} {"max|diff|":>10} {"mean|diff|":>11}')
+total_pil, total_tensor = 0, 0
+for image in images:
+    t_pil, ref = bench(load_image_pil, image)
+    t_tensor, out = bench(load_image, image)
+    total_pil += t_pil
+    total_tensor += t_tensor
+    assert ref.shape == out.shape, f'shape mismatch: {ref.shape} vs {out.shape}'
+    diff = (ref - out).abs()
+    size = f'{image.size[0]}x{image.size[1]}'
+    print(f'{size:>12} {out.shape[0]:>6} {t_pil:>9.2f} {t_tensor:>11.2f} {t_pil / t_tensor:>7.2f}x '
+          f'{diff.max().item():>10.4f} {diff.mean().item():>11.5f}')
+print(f'total: pil {total_pil:.2f} ms, tensor {total_tensor:.2f} ms, speedup {total_pil / total_tensor:.2f}x')
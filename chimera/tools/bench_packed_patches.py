@@ -0,0 +1,74 @@
+import argparse
+import time
+
+import torch
+from chimera.model.kosmos2_5.configuration_kosmos2_5 import Kosmos2_5VisionConfig
+from chimera.model.kosmos2_5.modeling_kosmos2_5 import Kosmos2_5VisionModel, pack_flattened_patches
+
+argparse = argparse.ArgumentParser(description='padded vs packed forward of the Kosmos-2.5 vision encoder')
+argparse.add_argument('--model-path', type=str, default=None, help='Kosmos-2.5 vision encoder, a random one if empty')
+argparse.add_argument('--hidden-size', type=int, default=768)
+argparse.add_argument('--num-layers', type=int, default=4)
+argparse.add_argument('--max-patches', type=int, default=4096)
+argparse.add_argument('--batch-size', type=int, default=4)
+argparse.add_argument('--fill', type=float, nargs='+', default=[0.1, 0.25, 0.5, 1.0], help='fraction of real patches')
+argparse.add_argument('--attn-implementation', type=str, default='sdpa')
+argparse.add_argument('--repeat', type=int, default=3)
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+if args.model_path is not None:
+    model = Kosmos2_5VisionModel.from_pretrained(args.model_path, attn_implementation=args.attn_implementation)
+else:
+    torch.manual_seed(0)
+    config = Kosmos2_5VisionConfig(
+        hidden_size = args.hidden_size,
+        intermediate_size = args.hidden_size * 4,
+        num_attention_heads = args.hidden_size // 64,
+        num_hidden_layers = args.num_layers,
+        max_num_patches = args.max_patches)
+    config._attn_implementation = args.attn_implementation
+    model = Kosmos2_5VisionModel(config)
+model = model.eval().to(device, dtype)
+patch_dim = model.config.patch_embed_hidden_size
+
+
+def make_batch(fill):
+    # 每张图的真实patch数在[fill / 2, fill] * max_patches之间，其余位置为0
+    flattened_patches = torch.zeros(args.batch_size, args.max_patches, patch_dim + 2)
+    for i in range(args.batch_size):
+        n = max(1, int(args.max_patches * fill * (0.5 + 0.5 * (i + 1) / args.batch_size)))
+        cols = int(n ** 0.5) + 1
+        flattened_patches[i, :n, 0] = torch.arange(n) // cols + 1
+        flattened_patches[i, :n, 1] = torch.arange(n) % cols + 1
+        flattened_patches[i, :n, 2:] = torch.randn(n, patch_dim)
+    return flattened_patches.to(device, dtype)
+
+
+def bench(fn):
+    with torch.no_grad():
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeat * 1000, out
+
+
+print(f'max_patches {args.max_patches}, batch {args.batch_size}, {args.attn_implementation}, {device.type}')
+print(f'{"fill":>6} {"real patches":>13} {"padded ms":>10} {"packed ms":>10} {"speedup":>8} {"max diff":>9}')
+for fill in args.fill:
+    flattened_patches = make_batch(fill)
+    attention_mask = (flattened_patches.sum(dim=-1) != 0).float()
+    patches, cu_seqlens = pack_flattened_patches(flattened_patches, attention_mask)
+    t_padded, padded = bench(lambda: model(flattened_patches=flattened_patches, attention_mask=attention_mask).last_hidden_state)
+    t_packed, packed = bench(lambda: model(
+        flattened_patches=patches, cu_seqlens=cu_seqlens, max_patches=args.max_patches).last_hidden_state)
+    diff = (padded.float() - packed.float()).abs().max().item()
+    print(f'{fill:>6.2f} {patches.shape[0]:>13} {t_padded:>10.1f} {t_packed:>10.1f} {t_padded / t_packed:>7.2f}x {diff:>9.2e}')
@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import torch
+from chimera.model.internlm2.configuration_internlm2 import InternLM2Config
+from chimera.model.internlm2.modeling_internlm2 import InternLM2ForCausalLM
+from chimera.patch import packed_data_collator, pad_data_collator
+
+argparse = argparse.ArgumentParser(description='padding waste and training step time of padded vs packed batches')
+argparse.add_argument('--hidden-size', type=int, default=512)
+argparse.add_argument('--num-layers', type=int, default=4)
+argparse.add_argument('--batch-size', type=int, default=8)
+argparse.add_argument('--min-length', type=int, default=300)
+argparse.add_argument('--max-length', type=int, default=8192)
+argparse.add_argument('--max-packed-tokens', type=int, nargs='+', default=[8192, 16384])
+argparse.add_argument('--attn-implementation', type=str, default='flash_attention_2' if torch.cuda.is_available() else 'sdpa')
+argparse.add_argument('--repeat', type=int, default=3)
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+torch.manual_seed(0)
+model = InternLM2ForCausalLM(InternLM2Config(
+    vocab_size = 1000,
+    hidden_size = args.hidden_size,
+    intermediate_size = args.hidden_size * 2,
+    num_hidden_layers = args.num_layers,
+    num_attention_heads = args.hidden_size // 64,
+    num_key_value_heads = args.hidden_size // 128,
+    max_position_embeddings = args.max_length,
+    attn_implementation = args.attn_implementation)).to(device, dtype)
+
+# 动态tile下样本长度从几百到8k+不等，这里按对数均匀采样
+lengths = torch.exp(torch.empty(args.batch_size).uniform_(
+    torch.log(torch.tensor(float(args.min_length))), torch.log(torch.tensor(float(args.max_length))))).long().tolist()
+features = []
+for length in lengths:
+    input_ids = torch.randint(3, 1000, (length,))
+    features.append(dict(input_ids=input_ids, labels=input_ids.clone()))
+
+
+def step(batch):
+    batch = {k: v.to(device) for k, v in batch.items()}
+    model.zero_grad()
+    model(**batch).loss.backward()
+
+
+def bench(batch):
+    step(batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        step(batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeat * 1000
+
+
+print(f'{args.batch_size} samples, {sum(lengths)} tokens, lengths {min(lengths)}~{max(lengths)}, {args.attn_implementation}')
+print(f'{"":>14} {"rows x length":>14} {"padding":>8} {"ms/step":>9} {"speedup":>8}')
+padded = pad_data_collator([dict(f) for f in features])
+t_padded = bench(padded)
+padding = 1 - sum(lengths) / padded['input_ids'].numel()
+print(f'{"padded":>14} {" x ".join(map(str, padded["input_ids"].shape)):>14} {padding:>8.1%} {t_padded:>9.1f} {1:>7.2f}x')
+for budget in args.max_packed_tokens:
+    packed = packed_data_collator([dict(f) for f in features], max_packed_tokens=budget)
+    t_packed = bench(packed)
+    padding = 1 - sum(lengths) / packed['input_ids'].numel()
+    print(f'{f"packed {budget}":>14} {" x ".join(map(str, packed["input_ids"].shape)):>14} {padding:>8.1%} '
+          f'{t_packed:>9.1f} {t_padded / t_packed:>7.2f}x')
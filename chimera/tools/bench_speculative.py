@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import torch
+from chimera.model.internlm2.configuration_internlm2 import InternLM2Config
+from chimera.model.internlm2.modeling_internlm2 import InternLM2ForCausalLM
+from chimera.speculative_decoding import speculative_generate
+from transformers import AutoModelForCausalLM
+
+argparse = argparse.ArgumentParser(description='acceptance rate and decode speed of speculative decoding')
+argparse.add_argument('--model-path', type=str, default=None, help='target language model, a random tiny InternLM2 if empty')
+argparse.add_argument('--draft-model-path', type=str, default=None,
+                      help='drafter language model, the first --draft-layers layers of the target if empty')
+argparse.add_argument('--draft-layers', type=int, default=1)
+argparse.add_argument('--hidden-size', type=int, default=256)
+argparse.add_argument('--num-layers', type=int, default=8)
+argparse.add_argument('--prompt-length', type=int, default=128)
+argparse.add_argument('--max-new-tokens', type=int, default=128)
+argparse.add_argument('--num-draft-tokens', type=int, nargs='+', default=[2, 4, 6])
+argparse.add_argument('--do-sample', action='store_true')
+argparse.add_argument('--repeat', type=int, default=3)
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+
+
+def load(path):
+    return AutoModelForCausalLM.from_pretrained(path, torch_dtype=dtype, trust_remote_code=True)
+
+
+if args.model_path is not None:
+    target = load(args.model_path)
+else:
+    torch.manual_seed(0)
+    target = InternLM2ForCausalLM(InternLM2Config(
+        vocab_size = 1000,
+        hidden_size = args.hidden_size,
+        intermediate_size = args.hidden_size * 2,
+        num_hidden_layers = args.num_layers,
+        num_attention_heads = 8,
+        num_key_value_heads = 2,
+        attn_implementation = 'eager'))
+if args.draft_model_path is not None:
+    draft = load(args.draft_model_path)
+else:
+    # 没有小模型时用target的前几层(共享embedding和输出层)作为drafter
+    draft = InternLM2ForCausalLM(target.config.__class__(**{**target.config.to_dict(), 'num_hidden_layers': args.draft_layers}))
+    draft.load_state_dict(target.state_dict(), strict=False)
+target = target.eval().to(device, dtype)
+draft = draft.eval().to(device, dtype)
+
+input_ids = torch.randint(3, target.config.vocab_size, (1, args.prompt_length), device=device)
+inputs_embeds = target.get_input_embeddings()(input_ids).detach()
+
+
+def bench(fn):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / args.repeat
+    return out.shape[1] / elapsed, out
+
+
+def generate_plain():
+    with torch.no_grad():
+        return target.generate(
+            inputs_embeds=inputs_embeds, attention_mask=torch.ones_like(input_ids), max_new_tokens=args.max_new_tokens,
+            min_new_tokens=args.max_new_tokens, do_sample=args.do_sample, pad_token_id=0)
+
+
+print(f'prompt {args.prompt_length}, new tokens {args.max_new_tokens}, do_sample {args.do_sample}')
+print(f'{"":>10} {"tokens/s":>9} {"speedup":>8} {"accepted":>9} {"tokens/round":>13} {"same output":>12}')
+base, reference = bench(generate_plain)
+print(f'{"plain":>10} {base:>9.1f} {1:>7.2f}x {"":>9} {"":>13} {"":>12}')
+for k in args.num_draft_tokens:
+    stats = {}
+    speed, out = bench(lambda: speculative_generate(
+        target, draft, inputs_embeds, draft_input_ids=input_ids, num_draft_tokens=k,
+        max_new_tokens=args.max_new_tokens, do_sample=args.do_sample, stats=stats))
+    same = '-' if args.do_sample else str(out.shape == reference.shape and bool((out == reference).all()))
+    print(f'{f"k={k}":>10} {speed:>9.1f} {speed / base:>7.2f}x {stats["accepted"] / max(stats["drafted"], 1):>9.2f} '
+          f'{(stats["accepted"] + stats["rounds"]) / max(stats["rounds"], 1):>13.2f} {same:>12}')
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import torch
+from chimera.model.internlm2.configuration_internlm2 import InternLM2Config
+from chimera.model.internlm2.modeling_internlm2 import InternLM2ForCausalLM
+from chimera.static_kv_cache import StaticCacheDecoder
+
+argparse = argparse.ArgumentParser()
+argparse.add_argument('--model-path', type=str, default=None, help='InternLM2 checkpoint, a random tiny model if empty')
+argparse.add_argument('--hidden-size', type=int, default=256)
+argparse.add_argument('--num-layers', type=int, default=4)
+argparse.add_argument('--prompt-length', type=int, default=128)
+argparse.add_argument('--max-new-tokens', type=int, default=128)
+argparse.add_argument('--batch-size', type=int, default=1)
+argparse.add_argument('--repeat', type=int, default=3)
+argparse.add_argument('--no-compile', action='store_true')
+argparse.add_argument('--num-threads', type=int, default=None)
+argparse.add_argument('--device', type=str, default='cpu')
+
+args = argparse.parse_args()
+
+if args.num_threads is not None:
+    torch.set_num_threads(args.num_threads)
+device = torch.device(args.device)
+
+if args.model_path is not None:
+    dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+    model = InternLM2ForCausalLM.from_pretrained(args.model_path, torch_dtype=dtype)
+else:
+    torch.manual_seed(0)
+    config = InternLM2Config(
+        vocab_size = 1000,
+        hidden_size = args.hidden_size,
+        intermediate_size = args.hidden_size * 2,
+        num_hidden_layers = args.num_layers,
+        num_attention_heads = 8,
+        num_key_value_heads = 2,
+        attn_implementation = 'eager')
+    model = InternLM2ForCausalLM(config)
+model = model.eval().to(device)
+
+input_ids = torch.randint(3, model.config.vocab_size, (args.batch_size, args.prompt_length), device=device)
+max_length = args.prompt_length + args.max_new_tokens
+
+
+def generate_legacy():
+    # 原始实现：legacy tuple cache，每步torch.cat并重建4D mask
+    with torch.no_grad():
+        output = model.generate(
+            input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=args.max_new_tokens,
+            min_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=0)
+    return output[:, args.prompt_length:]
+
+
+def bench(fn):
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / args.repeat
+    return args.batch_size * args.max_new_tokens / elapsed, out
+
+
+static = StaticCacheDecoder(model, max_length, batch_size=args.batch_size)
+candidates = [('legacy cache', generate_legacy),
+              ('static cache', lambda: static.generate(input_ids, max_new_tokens=args.max_new_tokens))]
+if not args.no_compile:
+    compiled = StaticCacheDecoder(model, max_length, batch_size=args.batch_size, compile=True)
+    candidates.append(('static + compile', lambda: compiled.generate(input_ids, max_new_tokens=args.max_new_tokens)))
+
+print(f'prompt {args.prompt_length}, new tokens {args.max_new_tokens}, batch {args.batch_size}')
+print(f'{"":>16} {"tokens/s":>9} {"speedup":>8} {"same output":>12}')
+reference, base = None, None
+for name, fn in candidates:
+    speed, out = bench(fn)
+    if reference is None:
+        reference, base = out, speed
+    same = out.shape == reference.shape and bool((out == reference).all())
+    print(f'{name:>16} {speed:>9.1f} {speed / base:>7.2f}x {str(same):>12}')
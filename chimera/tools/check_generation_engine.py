@@ -0,0 +1,109 @@
+import argparse
+
+import torch
+from chimera.generation_engine import ContinuousBatchingEngine
+from chimera.model.internlm2.configuration_internlm2 import InternLM2Config
+from chimera.model.internlm2.modeling_internlm2 import InternLM2ForCausalLM
+from chimera.model.phi3.configuration_phi3 import Phi3Config
+from chimera.model.phi3.modeling_phi3 import Phi3ForCausalLM
+from chimera.paged_kv_cache import PagedKVCache
+
+argparse = argparse.ArgumentParser(
+    description='greedy parity of ContinuousBatchingEngine with language_model.generate on tiny random InternLM2/Phi3')
+argparse.add_argument('--num-prompts', type=int, default=10)
+argparse.add_argument('--max-batch-size', type=int, default=4)
+argparse.add_argument('--max-prompt-length', type=int, default=40)
+argparse.add_argument('--max-new-tokens', type=int, default=24)
+argparse.add_argument('--num-layers', type=int, default=2)
+argparse.add_argument('--hidden-size', type=int, default=64)
+argparse.add_argument('--attn', type=str, nargs='*', default=['eager', 'sdpa'])
+argparse.add_argument('--num-kv-blocks', type=int, default=48, help='pool of the PagedKVCache run, small enough to make requests wait')
+argparse.add_argument('--kv-block-size', type=int, default=4)
+argparse.add_argument('--seed', type=int, default=0)
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.float32
+vocab_size = 512
+
+
+def build_model(llm, attn):
+    torch.manual_seed(args.seed)
+    common = dict(
+        vocab_size = vocab_size,
+        hidden_size = args.hidden_size,
+        intermediate_size = 2 * args.hidden_size,
+        num_hidden_layers = args.num_layers,
+        num_attention_heads = 4,
+        pad_token_id = 0,
+        bos_token_id = 1,
+        eos_token_id = 2)
+    if llm == 'internlm2':
+        config = InternLM2Config(num_key_value_heads=2, attn_implementation=attn, **common)
+        model = InternLM2ForCausalLM(config)
+    else:
+        config = Phi3Config(num_key_value_heads=4, max_position_embeddings=4096, original_max_position_embeddings=4096, **common)
+        config._attn_implementation = attn
+        model = Phi3ForCausalLM(config)
+    return model.eval().to(device, dtype)
+
+
+def make_requests(model):
+    # 长度不同的prompt和答案混在同一个batch里；部分请求以生成过程中出现的token为eos提前结束
+    generator = torch.Generator().manual_seed(args.seed)
+    prompts, configs, references = [], [], []
+    for i in range(args.num_prompts):
+        length = int(torch.randint(1, args.max_prompt_length + 1, (1,), generator=generator))
+        input_ids = torch.randint(3, vocab_size, (length,), generator=generator).to(device)
+        inputs_embeds = model.get_input_embeddings()(input_ids).detach()
+        config = dict(max_new_tokens=int(torch.randint(1, args.max_new_tokens + 1, (1,), generator=generator)),
+                      do_sample=False, eos_token_id=None)
+        if i % 3 == 0:
+            output_ids = reference(model, inputs_embeds, config)
+            config['eos_token_id'] = output_ids[len(output_ids) // 2]
+        prompts.append(inputs_embeds)
+        configs.append(config)
+        references.append(reference(model, inputs_embeds, config))
+    return prompts, configs, references
+
+
+def reference(model, inputs_embeds, config):
+    with torch.no_grad():
+        output_ids = model.generate(
+            inputs_embeds=inputs_embeds[None],
+            attention_mask=torch.ones(1, inputs_embeds.shape[0], dtype=torch.long, device=device),
+            pad_token_id=0,
+            **config)
+    return output_ids[0].tolist()
+
+
+def run_engine(model, prompts, configs, kv_cache=None):
+    engine = ContinuousBatchingEngine(model, max_batch_size=args.max_batch_size, kv_cache=kv_cache)
+    request_ids = [engine.add_request(inputs_embeds=x, **config) for x, config in zip(prompts, configs)]
+    outputs, max_running = {}, 0
+    while engine.has_unfinished_requests():
+        for request in engine.step():
+            outputs[request.request_id] = request.output_ids
+        max_running = max(max_running, len(engine.running))
+    return [outputs[x] for x in request_ids], engine.num_steps, max_running
+
+
+print(f'{"model":>10} {"attn":>6} {"cache":>6} {"steps":>6} {"batch":>6} {"mismatch":>9}')
+for llm in ['internlm2', 'phi3']:
+    for attn in args.attn:
+        model = build_model(llm, attn)
+        prompts, configs, references = make_requests(model)
+        for cache_name in ['tuple', 'paged']:
+            kv_cache = None
+            if cache_name == 'paged':
+                kv_cache = PagedKVCache.from_config(
+                    model.config, args.num_kv_blocks, block_size=args.kv_block_size, dtype=dtype, device=device)
+            outputs, num_steps, max_running = run_engine(model, prompts, configs, kv_cache)
+            mismatch = [i for i, (x, y) in enumerate(zip(outputs, references)) if x != y]
+            print(f'{llm:>10} {attn:>6} {cache_name:>6} {num_steps:>6} {max_running:>6} {len(mismatch):>9}')
+            assert not mismatch, f'{llm}/{attn}/{cache_name}: requests {mismatch} differ from generate'
+            if kv_cache is not None:
+                assert kv_cache.allocator.num_used_blocks == 0, 'finished requests did not free their blocks'
+print('ok')
@@ -0,0 +1,93 @@
+import argparse
+import time
+
+import torch
+from chimera.model.chimera.configuration_intern_vit import InternVisionConfig
+from chimera.model.chimera.modeling_intern_vit import InternAttention, InternVisionModel
+from chimera.model.got.configuration_got_vit import GotVisionConfig
+from chimera.model.got.modeling_got_vit import Attention, GoTVisionModel
+
+argparse = argparse.ArgumentParser(
+    description='parity and cost of the SDPA attention of InternViT and the GOT encoder against the naive attention')
+argparse.add_argument('--batch-size', type=int, default=1)
+argparse.add_argument('--vit-layers', type=int, default=4, help='layers of the InternViT-300M sized test model')
+argparse.add_argument('--got-depth', type=int, default=3, help='blocks of the GOT ViT-B sized test model (block 2 is global)')
+argparse.add_argument('--got-query-chunk-size', type=int, default=1024, help='attn_query_chunk_size of the SDPA run')
+argparse.add_argument('--repeat', type=int, default=2)
+argparse.add_argument('--atol', type=float, default=None)
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.float32
+atol = args.atol if args.atol is not None else 1e-4
+
+
+def set_sdpa(model, attention_class, use_sdpa):
+    # 参考实现：naive attention，GOT的全局block也不分块
+    for module in model.modules():
+        if isinstance(module, attention_class):
+            module.use_sdpa = use_sdpa
+            if hasattr(module, 'query_chunk_size'):
+                module.query_chunk_size = args.got_query_chunk_size if use_sdpa else 0
+
+
+def run(fn):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(args.repeat):
+            out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    memory = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return (time.perf_counter() - start) / args.repeat * 1000, memory, out
+
+
+def compare(name, model, attention_class, fn):
+    set_sdpa(model, attention_class, False)
+    t_naive, m_naive, ref = run(fn)
+    set_sdpa(model, attention_class, True)
+    t_sdpa, m_sdpa, out = run(fn)
+    diff = (ref - out).abs().max().item()
+    print(f'{name:>10} {t_naive:>10.1f} {t_sdpa:>9.1f} {m_naive:>11.1f} {m_sdpa:>10.1f} {diff:>10.2e}')
+    assert diff < atol, f'{name}: max |diff| {diff} >= {atol}'
+
+
+torch.manual_seed(0)
+vit_config = InternVisionConfig(
+    image_size = 448,
+    patch_size = 14,
+    hidden_size = 1024,
+    num_attention_heads = 16,
+    intermediate_size = 4096,
+    num_hidden_layers = args.vit_layers,
+    qk_normalization = False,
+    norm_type = 'layer_norm',
+    use_flash_attn = False)
+vit = InternVisionModel(vit_config).eval().to(device, dtype)
+pixel_values = torch.randn(args.batch_size, 3, 448, 448, device=device, dtype=dtype)
+
+got_config = GotVisionConfig(
+    img_size = 1024,
+    depth = args.got_depth,
+    use_rel_pos = True,
+    window_size = 14,
+    global_attn_indexes = [x for x in (2, 5, 8, 11) if x < args.got_depth],
+    attn_query_chunk_size = args.got_query_chunk_size)
+got = GoTVisionModel(got_config).eval().to(device, dtype)
+# 相对位置编码默认零初始化，随机化后才能检验偏置的正确性
+for module in got.modules():
+    if isinstance(module, Attention) and module.use_rel_pos:
+        module.rel_pos_h.data.normal_(std=0.02)
+        module.rel_pos_w.data.normal_(std=0.02)
+images = torch.randn(args.batch_size, 3, 1024, 1024, device=device, dtype=dtype)
+
+print(f'{"":>10} {"naive(ms)":>10} {"sdpa(ms)":>9} {"naive(MiB)":>11} {"sdpa(MiB)":>10} {"max|diff|":>10}')
+compare('InternViT', vit, InternAttention, lambda: vit(pixel_values=pixel_values).last_hidden_state)
+compare('GOT', got, Attention, lambda: got(images).last_hidden_state)
+print('ok')
@@ -0,0 +1,107 @@
+import argparse
+import glob
+import os
+import time
+
+import torch
+from chimera.chimera_infer import select_attn_implementation
+from chimera.image_tiling import dynamic_preprocess_tensor
+from chimera.model.chimera import ChimeraChatConfig, ChimeraChatModel
+from PIL import Image
+
+argparse = argparse.ArgumentParser()
+argparse.add_argument('--model-path', type=str, required=True)
+argparse.add_argument('--image', type=str, nargs='*', default=[])
+argparse.add_argument('--image-dir', type=str, default=None)
+argparse.add_argument('--exit-layer', type=int, default=-1, help='hidden_states index of the ViT layer to route on')
+argparse.add_argument('--image-size', type=int, default=None, help='thumbnail resolution of the fast router')
+argparse.add_argument('--thresholds', type=float, nargs='*', default=[0.0, 0.5, 0.7, 0.9])
+argparse.add_argument('--batch-size', type=int, default=16)
+argparse.add_argument('--repeat', type=int, default=5)
+argparse.add_argument('--fit-steps', type=int, default=0,
+                      help='distill the fast router head from expert_router on the first --fit-ratio of the images')
+argparse.add_argument('--fit-ratio', type=float, default=0.5)
+argparse.add_argument('--lr', type=float, default=1e-3)
+argparse.add_argument('--save', type=str, default=None,
+                      help='save the distilled fast_expert_router weights, see ChimeraChatModel.load_fast_router')
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+
+config = ChimeraChatConfig.from_pretrained(args.model_path)
+config.router_exit_layer = args.exit_layer
+config.router_image_size = args.image_size
+config = select_attn_implementation(config, device)
+model = ChimeraChatModel.from_pretrained(args.model_path, config=config, torch_dtype=dtype).eval().to(device)
+assert model.expert_router is not None, 'the model has no expert encoder to route to'
+
+paths = list(args.image)
+if args.image_dir is not None:
+    paths += sorted(x for x in glob.glob(os.path.join(args.image_dir, '*')) if x.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')))
+assert len(paths) > 0, 'no image given'
+images = [Image.open(x).convert('RGB') for x in paths]
+
+thumbnail = torch.cat([dynamic_preprocess_tensor(x, max_num=1) for x in images]).to(device, dtype)
+
+
+def batched(fn, x):
+    return torch.cat([fn(x[i:i + args.batch_size]) for i in range(0, len(x), args.batch_size)])
+
+
+def timed(fn):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeat * 1000 / len(images), out
+
+
+with torch.no_grad():
+    t_full, full_logits = timed(lambda: batched(lambda x: model.expert_route(x), thumbnail))
+    reference = full_logits.argmax(-1)
+
+eval_indices = torch.arange(len(images))
+if args.fit_steps > 0 and model.fast_expert_router is not None:
+    # 中间层的router需要单独的权重：在前fit_ratio的图片上用完整router的结果蒸馏
+    num_fit = max(int(len(images) * args.fit_ratio), 1)
+    eval_indices = torch.arange(num_fit, len(images)) if num_fit < len(images) else eval_indices
+    with torch.no_grad():
+        features = batched(lambda x: model.fast_route_feature(x), thumbnail[:num_fit]).float()
+    head = torch.nn.Linear(features.shape[-1], full_logits.shape[-1], bias=False).to(device)
+    head.weight.data.copy_(model.expert_router.weight.float())
+    optimizer = torch.optim.Adam(head.parameters(), lr=args.lr)
+    for step in range(args.fit_steps):
+        loss = torch.nn.functional.cross_entropy(head(features), reference[:num_fit])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.load_fast_router({'weight': head.weight.to(dtype)})
+    print(f'distilled fast router on {num_fit} images, final loss {loss.item():.4f}, evaluating on {len(eval_indices)} images')
+    if args.save is not None:
+        torch.save(model.fast_expert_router.state_dict(), args.save)
+elif model.fast_expert_router is not None and model.fast_router_ready:
+    print('warning: routing on an intermediate layer with fast_expert_router weights from the checkpoint')
+elif model.fast_expert_router is not None:
+    print('warning: the checkpoint has no fast_expert_router weights, the fast router falls back to the full one; '
+          'distill them with --fit-steps')
+
+print(f'images: {len(images)}, exit layer: {args.exit_layer}, router image size: {args.image_size or 448}')
+print(f'full router: {t_full:.2f} ms/image')
+print(f'{"threshold":>9} {"agreement":>10} {"fallback":>9} {"ms/image":>9} {"speedup":>8}')
+with torch.no_grad():
+    for threshold in args.thresholds:
+        def route(x):
+            logits, fallback = model.route(x, confidence_threshold=threshold, return_fallback=True)
+            return torch.stack([logits.argmax(-1), fallback.long()], dim=-1)
+
+        t_fast, out = timed(lambda: batched(route, thumbnail))
+        agreement = (out[eval_indices, 0] == reference[eval_indices]).float().mean().item()
+        fallback_rate = out[eval_indices, 1].float().mean().item()
+        print(f'{threshold:>9.2f} {agreement:>10.2%} {fallback_rate:>9.2%} {t_fast:>9.2f} {t_full / t_fast:>7.2f}x')
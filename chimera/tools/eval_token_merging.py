@@ -0,0 +1,65 @@
+import argparse
+import glob
+import os
+import time
+
+import torch
+from chimera.chimera_infer import Chimera4easyuse, load_image
+from PIL import Image
+
+argparse = argparse.ArgumentParser(description='prefill cost and answer drift of visual token merging')
+argparse.add_argument('--model-path', type=str, required=True)
+argparse.add_argument('--image', type=str, nargs='*', default=[])
+argparse.add_argument('--image-dir', type=str, default=None)
+argparse.add_argument('--question', type=str, default='Describe the image in detail.')
+argparse.add_argument('--budgets', type=int, nargs='*', default=[192, 128, 64], help='visual tokens kept per tile')
+argparse.add_argument('--max-new-tokens', type=int, default=64)
+argparse.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+args = argparse.parse_args()
+
+device = torch.device(args.device)
+dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+easy = Chimera4easyuse(args.model_path, dtype=dtype, device=device,
+                       generation_config=dict(max_new_tokens=args.max_new_tokens, do_sample=False))
+
+paths = list(args.image)
+if args.image_dir is not None:
+    paths += sorted(x for x in glob.glob(os.path.join(args.image_dir, '*')) if x.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')))
+assert len(paths) > 0, 'no image given'
+images = [Image.open(x).convert('RGB') for x in paths]
+num_tiles = [load_image(x, max_num=12).shape[0] for x in images]
+
+
+def run(budget):
+    easy.model.set_visual_token_budget(budget)
+    responses, elapsed = [], 0.0
+    for image in images:
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        responses.append(easy.get_response(args.question, [image]))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+    return responses, elapsed / len(paths) * 1000
+
+
+def common_prefix(a, b):
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    return n / max(len(a), len(b), 1)
+
+
+reference, t_full = run(None)
+full_tokens = easy.model.num_image_token_full * sum(num_tiles) / len(paths)
+print(f'images: {len(paths)}, tiles/image: {sum(num_tiles) / len(paths):.1f}')
+print(f'{"budget":>7} {"visual tokens":>14} {"ms/image":>9} {"speedup":>8} {"same answer":>12} {"common prefix":>14}')
+print(f'{"full":>7} {full_tokens:>14.0f} {t_full:>9.1f} {1:>7.2f}x {1:>12.2%} {1:>14.2%}')
+for budget in args.budgets:
+    responses, elapsed = run(budget)
+    same = sum(x == y for x, y in zip(responses, reference)) / len(paths)
+    prefix = sum(common_prefix(x, y) for x, y in zip(responses, reference)) / len(paths)
+    print(f'{budget:>7} {budget * sum(num_tiles) / len(paths):>14.0f} {elapsed:>9.1f} {t_full / elapsed:>7.2f}x '
+          f'{same:>12.2%} {prefix:>14.2%}')